@@ -4,11 +4,25 @@ pystats: Flask app to get system metrics on page load with request
 logging for testing K8s Load Balancers, Statefulsets, and
 Persistent Volumes or custom prometheus metrics endpoint.
 """
+import time
+
+# taken before the other imports so the startup report covers them
+STARTED = time.perf_counter()
+
+# pylint: disable=wrong-import-position
 import os
+import sys
 import atexit
-import yaml
+import signal
+import socket
+import threading
+from functools import partial
+from datetime import datetime, timezone
+from markupsafe import Markup
 from flask import (
     Flask,
+    Response,
+    g,
     jsonify,
     make_response,
     render_template,
@@ -16,17 +30,159 @@ from flask import (
     send_from_directory,
 )
 from waitress import serve
+from werkzeug.http import is_resource_modified
 from src.stats import Stats
-from src.logger import get_logger
+from src.serialized import SerializedStats
+from src.metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from src.pagecache import PageCache
+from src.stream import StatsStream
+from src.logger import configure_logging, get_logger
 from src.cli import parse_cfg
-from src.requests import Requests
+from src.backend import get_backend
+from src.sampling import Sampler
+from src.analytics import ANALYTICS_GROUPS
+from src.timings import get_startup, get_timings
+# pylint: enable=wrong-import-position
 
 
+STARTUP = get_startup()
+STARTUP.origin = STARTED
+STARTUP.add("imports", STARTED)
 LOG = get_logger()
-CFG = parse_cfg()
-STATS = Stats()
-REQS = Requests(CFG.db_path)
-app = Flask(__name__)
+with STARTUP.phase("config"):
+    CFG = parse_cfg()
+    configure_logging(CFG.log_level, CFG.log_format, CFG.log_dedup_interval)
+TIMINGS = get_timings()
+TIMINGS.enabled = CFG.timings
+with STARTUP.phase("stats"):
+    STATS = Stats(
+        cpu_interval=CFG.cpu_interval,
+        uptime_ttl=CFG.uptime_ttl,
+        mem_ttl=CFG.mem_ttl,
+        cpu_ttl=CFG.cpu_ttl,
+        history_tiers=CFG.history_tiers,
+        collector=CFG.collector,
+    )
+with STARTUP.phase("requests"):
+    # --fast-start moves schema setup and server registration off the startup path
+    SAMPLER = None
+    if CFG.sample_every > 1 or CFG.sample_per_second > 0:
+        SAMPLER = Sampler(CFG.sample_every, CFG.sample_per_second, CFG.sample_key)
+    REQS = get_backend(
+        CFG.backend,
+        CFG.db_path,
+        memory_rows=CFG.memory_rows,
+        sampler=SAMPLER,
+        checkpoint_interval=CFG.checkpoint_interval,
+        intern_cache_size=CFG.intern_cache_size,
+        write_behind=CFG.write_behind,
+        batch_size=CFG.batch_size,
+        flush_interval=CFG.flush_interval,
+        queue_size=CFG.queue_size,
+        db_synchronous=CFG.db_synchronous,
+        db_cache_size=CFG.db_cache_size,
+        db_mmap_size=CFG.db_mmap_size,
+        db_busy_timeout=CFG.db_busy_timeout,
+        # prefork workers leave retention to the supervisor
+        retention_max_age=CFG.retention_max_age if CFG.worker_fd is None else 0,
+        retention_max_rows=CFG.retention_max_rows if CFG.worker_fd is None else 0,
+        retention_interval=CFG.retention_interval,
+        retention_batch_size=CFG.retention_batch_size,
+        partition_by=CFG.partition_by,
+        partition_rows=CFG.partition_rows,
+        # like retention, prefork workers leave folding to the supervisor
+        analytics_interval=CFG.analytics_interval if CFG.worker_fd is None else 0,
+        defer_init=CFG.fast_start and CFG.command is None,
+    )
+with STARTUP.phase("app"):
+    PAGE_CACHE = PageCache(CFG.page_cache_size) if CFG.page_cache_size > 0 else None
+    STREAM = None
+    if CFG.stream_interval > 0 and CFG.command is None:
+        STREAM = StatsStream(STATS, CFG.stream_interval, CFG.stream_clients)
+        if CFG.stream_clients >= CFG.threads:
+            LOG.warning(
+                "stream: %s --stream-clients can hold all %s --threads, pages may stall",
+                CFG.stream_clients, CFG.threads,
+            )
+    METRICS = Metrics(STATS, REQS, CFG.labels, page_cache=PAGE_CACHE, stream=STREAM)
+    SERIALIZED = SerializedStats(STATS)
+    app = Flask(__name__)
+
+
+def conditional(etag, last_modified, render):
+    """ answer with 304 when the client copy is current, otherwise call render """
+    last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response(render())
+    else:
+        response = make_response("", 304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+
+@app.before_request
+def start_timer():
+    """ remember when the request started for the route histograms """
+    if TIMINGS.enabled:
+        g.started = time.perf_counter()
+
+
+@app.after_request
+def stop_timer(response):
+    """ record the route latency """
+    started = g.pop("started", None)
+    if started is not None:
+        rule = request.url_rule.rule if request.url_rule else "404"
+        TIMINGS.record("route", rule, time.perf_counter() - started)
+    return response
+
+
+@app.after_request
+def count_status(response):
+    """ count the response status of requests passed to log_request """
+    if g.pop("logged", False):
+        REQS.count_status(response.status_code)
+    return response
+
+
+def log_request():
+    """ hand the current request to the request log """
+    g.logged = True
+    REQS.put_request(
+        request.remote_addr,
+        request.user_agent,
+        request.url,
+        route=request.url_rule.rule if request.url_rule else "404",
+    )
+
+
+def page_ids(rows):
+    """ first and last id of a page of rows for the cursor pagination links """
+    if rows and isinstance(rows[0][0], int):
+        return rows[0][0], rows[-1][0]
+    return 0, 0
+
+
+def request_table(key, bound, fetch, template):
+    """(rendered table, first id, last id) of a requests page, from PAGE_CACHE once final
+
+    bound is the newest RequestID read before fetch runs: a page whose
+    rows all lie below it can only change when retention deletes rows,
+    which moves the low-water mark the cache entries are checked against.
+    """
+    low_water = REQS.get_first_id() if PAGE_CACHE else None
+    if low_water is not None:
+        page = PAGE_CACHE.get(key, low_water)
+        if page is not None:
+            return page
+    req_tbl = fetch()
+    first_id, last_id = page_ids(req_tbl)
+    table = Markup(render_template(template, req_tbl=req_tbl))
+    page = (table, first_id, last_id)
+    if low_water is not None and req_tbl and last_id < bound:
+        PAGE_CACHE.put(key, low_water, page, len(table))
+    return page
 
 
 def is_database_connected():
@@ -50,6 +206,8 @@ def liveness_probe():
 def readiness_probe():
     """Readiness probe: Determines if the container can accept live network traffic."""
     # Check your critical background dependencies here
+    if not REQS.ready.is_set():
+        return jsonify({"status": "unready", "reason": "Starting"}), 503
     if not is_database_connected():
         return jsonify({"status": "unready", "reason": "Database disconnected"}), 503
     return jsonify({"status": "ready"}), 200
@@ -58,83 +216,263 @@ def readiness_probe():
 @app.route("/")
 def stats():
     """stats - node stats"""
-    REQS.put_request(request.remote_addr, request.user_agent, request.url)
+    log_request()
     fast = True if request.args.get("fast") == "true" else False
-    return render_template(
-        "stats.html",
-        stats=STATS.get_stats(fast, CFG.labels),
-        req_total=REQS.get_req_total(),
+    etag, last_modified, stats_snap = STATS.get_snapshot(fast, CFG.labels)
+    # the request total moves with every hit, this one included, so only the
+    # stats snapshot validates the page: a 304 keeps the client's total until they change
+    return conditional(
+        etag,
+        last_modified,
+        lambda: render_template(
+            "stats.html",
+            stats=stats_snap,
+            req_total=REQS.get_req_total(),
+            sampling=REQS.get_sampling(),
+        ),
     )
 
 
 @app.route("/servers")
 def servers():
-    REQS.put_request(request.remote_addr, request.user_agent, request.url)
+    log_request()
     """ servers - pystats servers """
     url_pn_start = request.args.get("pnstart", 1, int)
     url_pn_count = request.args.get("pncount", 10, int)
+    url_after_id = request.args.get("after_id", None, int)
+    url_before_id = request.args.get("before_id", None, int)
+    # ServerIDs are never deleted so the cursor maps straight onto pnstart
+    if url_after_id is not None:
+        url_pn_start = url_after_id + 1
+    elif url_before_id is not None:
+        url_pn_start = url_before_id - url_pn_count
+    # not in PAGE_CACHE: every row carries its server's request count, so
+    # no /servers page is final, and the page is one short indexed query
+    srv_tbl = REQS.get_srvs(url_pn_start, url_pn_count)
+    srv_total = REQS.get_srv_total()
+    first_id, last_id = page_ids(srv_tbl)
     return render_template(
         "servers.html",
-        srv_tbl=REQS.get_srvs(url_pn_start, url_pn_count),
-        pn_start=url_pn_start,
+        srv_tbl=srv_tbl,
         pn_count=url_pn_count,
-        req_total=REQS.get_srv_total(),
+        first_id=first_id,
+        last_id=last_id,
+        end_id=srv_total + 1,
+        req_total=srv_total,
     )
 
 
 @app.route("/requests")
 def requests():
-    REQS.put_request(request.remote_addr, request.user_agent, request.url)
+    log_request()
     """ requests - pystats requests """
-    url_pn_start = request.args.get("pnstart", 1, int)
     url_pn_count = request.args.get("pncount", 10, int)
+    url_after_id = request.args.get("after_id", None, int)
+    url_before_id = request.args.get("before_id", None, int)
+    if "pnstart" in request.args:
+        # keep old pnstart links working on top of the cursor api
+        url_after_id = request.args.get("pnstart", 1, int) - 1
+    # with sampling the total also counts requests that have no row
+    req_last_id = REQS.get_last_id()
+    req_total = REQS.get_req_total()
+    req_table, first_id, last_id = request_table(
+        ("requests", url_after_id, url_before_id, url_pn_count),
+        req_last_id,
+        partial(REQS.get_requests_page, url_after_id, url_before_id, url_pn_count),
+        "requests_table.html",
+    )
     return render_template(
         "requests.html",
-        req_tbl=REQS.get_requests(url_pn_start, url_pn_count),
-        pn_start=url_pn_start,
+        req_table=req_table,
         pn_count=url_pn_count,
-        req_total=REQS.get_req_total(),
+        first_id=first_id,
+        last_id=last_id,
+        end_id=req_last_id + 1,
+        req_total=req_total,
     )
 
 
 @app.route("/srv_requests")
 def srv_requests():
-    REQS.put_request(request.remote_addr, request.user_agent, request.url)
+    log_request()
     """ srv_requests - pystats requests """
     url_srv_id = request.args.get("srv_id", 1, int)
-    url_pn_page = request.args.get("pnpage", 1, int)
     url_pn_count = request.args.get("pncount", 10, int)
+    url_after_id = request.args.get("after_id", None, int)
+    url_before_id = request.args.get("before_id", None, int)
+    url_pn_page = None
+    if "pnpage" in request.args and url_after_id is None and url_before_id is None:
+        # old offset links
+        url_pn_page = request.args.get("pnpage", 1, int)
+        fetch = partial(REQS.get_srv_requests, url_srv_id, url_pn_page, url_pn_count)
+    else:
+        fetch = partial(
+            REQS.get_srv_requests_page, url_srv_id, url_after_id, url_before_id, url_pn_count
+        )
+    srv_last_rec = REQS.get_srv_last_rec(url_srv_id)
+    req_table, first_id, last_id = request_table(
+        ("srv_requests", url_srv_id, url_pn_page, url_after_id, url_before_id, url_pn_count),
+        srv_last_rec,
+        fetch,
+        "srv_requests_table.html",
+    )
     return render_template(
         "srv_requests.html",
-        req_tbl=REQS.get_srv_requests(url_srv_id, url_pn_page, url_pn_count),
+        req_table=req_table,
         srv_id=url_srv_id,
         srv_name=REQS.get_srv_socket(url_srv_id),
-        pn_page=url_pn_page,
         pn_count=url_pn_count,
+        first_id=first_id,
+        last_id=last_id,
+        end_id=srv_last_rec + 1,
         req_total=REQS.get_srv_req_tot(url_srv_id),
-        last_record=REQS.get_srv_last_rec(url_srv_id),
     )
 
+@app.route("/requests/export")
+def requests_export():
+    """ requests/export - stream the request log as jsonl or csv """
+    from src.export import EXPORT_FORMATS, export_requests  # pylint: disable=import-outside-toplevel
+    log_request()
+    url_format = request.args.get("format", "jsonl")
+    if url_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    url_gzip = request.args.get("gzip") == "true"
+    body = export_requests(
+        REQS,
+        url_format,
+        url_gzip,
+        srv_id=request.args.get("srv_id", None, int),
+        since=request.args.get("since", None, float),
+        until=request.args.get("until", None, float),
+        min_id=request.args.get("min_id", None, int),
+        max_id=request.args.get("max_id", None, int),
+    )
+    mimetype = "application/x-ndjson" if url_format == "jsonl" else "text/csv"
+    filename = f"requests.{url_format}"
+    if url_gzip:
+        mimetype = "application/gzip"
+        filename += ".gz"
+    response = Response(body, mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+
+@app.route("/analytics")
+def analytics_out():
+    """analytics - request counts per server, url, address, user agent or time bucket"""
+    log_request()
+    url_group_by = request.args.get("group_by", "server")
+    if url_group_by not in ANALYTICS_GROUPS:
+        return jsonify({"error": f"group_by must be one of {', '.join(ANALYTICS_GROUPS)}"}), 400
+    url_until = request.args.get("until", None, float)
+    url_since = request.args.get("since", None, float)
+    url_window = request.args.get("window", None, float)
+    if url_since is None and url_window is not None:
+        url_since = (url_until or time.time()) - url_window
+    result = REQS.get_analytics(
+        url_group_by,
+        since=url_since,
+        until=url_until,
+        srv_id=request.args.get("srv_id", None, int),
+        bucket=request.args.get("bucket", 60, int),
+        limit=request.args.get("limit", 100, int),
+    )
+    if result is None:
+        return jsonify({"error": "No DB Connection"}), 503
+    return jsonify(result)
+
+
+def serialized_out(fmt, mimetype):
+    """ cached /json or /yaml body, gzipped when the client accepts it """
+    use_gzip = request.accept_encodings.quality("gzip") > 0
+    etag, last_modified, body = SERIALIZED.get(fmt, use_gzip)
+    response = conditional(etag, last_modified, lambda: body)
+    response.mimetype = mimetype
+    response.vary.add("Accept-Encoding")
+    if use_gzip and response.status_code == 200:
+        response.content_encoding = "gzip"
+    return response
+
+
 @app.route("/json")
 def json_out():
     """json - output json"""
-    REQS.put_request(request.remote_addr, request.user_agent, request.url)
-    return jsonify(STATS.get_stats())
+    log_request()
+    return serialized_out("json", "application/json")
 
 
 @app.route("/yaml")
 def yaml_out():
     """yaml - output yaml"""
-    response = make_response(yaml.dump(STATS.get_stats(), indent=2), 200)
-    response.mimetype = "text/plain"
-    REQS.put_request(request.remote_addr, request.user_agent, request.url)
+    response = serialized_out("yaml", "text/plain")
+    log_request()
+    return response
+
+
+@app.route("/stream")
+def stream_out():
+    """stream - server-sent events: the stats snapshot, then merge patches of what changed"""
+    log_request()
+    subscriber = STREAM.subscribe() if STREAM else None
+    if subscriber is None:
+        response = jsonify({"error": "/stream is disabled or has no free client slot"})
+        response.status_code = 503
+        response.headers["Retry-After"] = "5"
+        return response
+    response = Response(STREAM.iter_events(subscriber), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # keep reverse proxies from buffering the events
+    response.headers["X-Accel-Buffering"] = "no"
     return response
 
 
+@app.route("/metrics")
+def metrics_out():
+    """metrics - prometheus text exposition, cached per cpu sample"""
+    response = make_response(METRICS.get_payload(), 200)
+    response.headers["Content-Type"] = METRICS_CONTENT_TYPE
+    return response
+
+
+@app.route("/history")
+def history_out():
+    """history - min/max/avg per bucket of the sampled stats over ?window= seconds"""
+    if not STATS.history:
+        return jsonify({"error": "history is disabled, see --history-tiers"}), 404
+    series = request.args.get("series")
+    return jsonify(
+        STATS.history.query(
+            series.split(",") if series else None,
+            window=request.args.get("window", 600, float),
+            until=request.args.get("until", None, float),
+            step=request.args.get("step", None, float),
+        )
+    )
+
+
+@app.route("/debug/timings")
+def timings_out():
+    """timings - latency histograms as json or ?format=prometheus"""
+    if request.args.get("format") == "prometheus":
+        response = make_response(TIMINGS.as_prometheus(), 200)
+        response.headers["Content-Type"] = METRICS_CONTENT_TYPE
+        return response
+    return jsonify(
+        {
+            "enabled": TIMINGS.enabled,
+            "timings": TIMINGS.as_dict(),
+            "startup": STARTUP.as_dict(),
+            "page_cache": PAGE_CACHE.as_dict() if PAGE_CACHE else None,
+            "stream": STREAM.as_dict() if STREAM else None,
+            "intern_cache": REQS.interner.as_dict() if REQS.interner else None,
+        }
+    )
+
+
 @app.errorhandler(404)
 def not_found(err):
     """404 page"""
-    REQS.put_request(request.remote_addr, request.user_agent, request.url)
+    log_request()
     return render_template("404.html", error=err)
 
 
@@ -160,10 +498,106 @@ def fav_image():
 
 def on_shutdown():
     """ exit message """
+    if STREAM:
+        STREAM.stop()
+    REQS.close()
+    STATS.close()
     LOG.debug("Exiting... Server_ID: %s", REQS.get_srv_id())
 
 
-if __name__ == "__main__":
-    LOG.debug("Starting... Server_ID: %s", REQS.get_srv_id())
+def export_cli():
+    """ export subcommand: stream the request log to a file or stdout """
+    from src.export import export_requests  # pylint: disable=import-outside-toplevel
+    body = export_requests(
+        REQS,
+        CFG.export_format,
+        CFG.export_gzip,
+        srv_id=CFG.export_srv_id,
+        since=CFG.export_since,
+        until=CFG.export_until,
+        min_id=CFG.export_min_id,
+        max_id=CFG.export_max_id,
+    )
+    out = sys.stdout.buffer if CFG.export_output == "-" else open(CFG.export_output, "wb")
+    try:
+        for part in body:
+            out.write(part)
+        out.flush()
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+        REQS.close()
+        STATS.close()
+
+
+def import_cli():
+    """ import subcommand: bulk load a requests JSONL export """
+    from src.importer import JsonlReader  # pylint: disable=import-outside-toplevel
+    reader = JsonlReader(CFG.import_input, CFG.import_chunk_size)
+    try:
+        REQS.import_requests(reader)
+    finally:
+        REQS.close()
+        STATS.close()
+    if reader.skipped:
+        LOG.warning("import: skipped %s malformed lines of %s", reader.skipped, reader.lines)
+
+
+def on_sigterm(signum, frame):
+    """ end the /stream responses, waitress would wait for them, then exit """
+    if STREAM:
+        STREAM.stop()
+    sys.exit(0)
+
+
+def startup_report():
+    """ log the startup phases once the DB is ready """
+    REQS.ready.wait()
+    STARTUP.ready()
+    LOG.debug("Starting... Server_ID: %s pid: %s", REQS.get_srv_id(), os.getpid())
+    LOG.info("%s", STARTUP.report())
+
+
+def serve_cli():
+    """ serve in this process or supervise --workers prefork workers """
+    from src.prefork import Supervisor, cpu_limit  # pylint: disable=import-outside-toplevel
+    workers = CFG.workers if CFG.workers > 0 else cpu_limit()
+    if CFG.worker_fd is None and workers > 1:
+        STATS.close()
+        supervisor = Supervisor(
+            [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:],
+            workers,
+            CFG.srv_socket_ip,
+            CFG.srv_socket_port,
+            backlog=CFG.backlog,
+            reuse_port=CFG.reuse_port,
+            shutdown_timeout=CFG.shutdown_timeout,
+        )
+        try:
+            supervisor.run()
+        finally:
+            REQS.close()
+        return
+    threading.Thread(target=startup_report, name="pystats-startup", daemon=True).start()
     atexit.register(on_shutdown)
-    serve(app, host=CFG.srv_socket_ip, port=CFG.srv_socket_port)
+    # waitress finishes in flight requests on SystemExit, atexit then flushes the writer
+    signal.signal(signal.SIGTERM, on_sigterm)
+    options = {
+        "threads": CFG.threads,
+        "connection_limit": CFG.connection_limit,
+        "backlog": CFG.backlog,
+    }
+    if CFG.worker_fd is not None:
+        serve(app, sockets=[socket.socket(fileno=CFG.worker_fd)], **options)
+    else:
+        serve(app, host=CFG.srv_socket_ip, port=CFG.srv_socket_port, **options)
+
+
+if __name__ == "__main__":
+    if CFG.command == "export":
+        export_cli()
+        sys.exit(0)
+    if CFG.command == "import":
+        import_cli()
+        sys.exit(0)
+    serve_cli()
@@ -0,0 +1,284 @@
+""" per minute and per hour request count rollups for load balancer distribution analysis """
+import math
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import closing
+from .interning import DICTIONARIES
+from .logger import get_logger
+
+
+ANALYTICS_GROUPS = ("server", "url", "address", "user_agent", "time")
+# group_by -> Dimension of analytics_rollup, server and time sum the url rows
+DIMENSIONS = {"url": 0, "address": 1, "user_agent": 2}
+# Dimension -> dictionary table (table, id column, value column) of its requests column
+DIMENSION_DICTIONARIES = (DICTIONARIES[2], DICTIONARIES[0], DICTIONARIES[1])
+# seconds per Period of each rollup tier, queries take whole hours from the coarse one
+STEPS = (60, 3600)
+ROLLUP_UPSERT_SQL = """INSERT INTO analytics_rollup (Step, Dimension, Period, ServerID, Value, RequestCount)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(Step, Dimension, Period, ServerID, Value) DO UPDATE SET
+    RequestCount = RequestCount + excluded.RequestCount"""
+
+
+def analytics_init(con):
+    """ create the rollup table and the fold watermark """
+    with con:
+        # without rowid the primary key is the table, so every query is an index range scan
+        con.execute(
+            """CREATE TABLE IF NOT EXISTS analytics_rollup(
+                Step INTEGER NOT NULL,
+                Dimension INTEGER NOT NULL,
+                Period INTEGER NOT NULL,
+                ServerID INTEGER NOT NULL,
+                Value TEXT NOT NULL,
+                RequestCount INTEGER NOT NULL,
+                PRIMARY KEY(Step, Dimension, Period, ServerID, Value)
+            ) WITHOUT ROWID"""
+        )
+        con.execute(
+            """CREATE TABLE IF NOT EXISTS analytics_state(
+                ID INTEGER PRIMARY KEY CHECK (ID = 0),
+                FoldedID INTEGER NOT NULL
+            )"""
+        )
+        con.execute("INSERT OR IGNORE INTO analytics_state (ID, FoldedID) VALUES (0, 0)")
+
+
+def rollup_rows(cur, rows):
+    """ add request rows (RequestID, Epoch, RemoteAddress, RemoteUserAgent, RequestURL, ServerID) """
+    counts = Counter()
+    for row in rows:
+        srv_id = row[5] or 0
+        for step in STEPS:
+            period = int(row[1] // step)
+            counts[(step, 0, period, srv_id, row[4] or "")] += 1
+            counts[(step, 1, period, srv_id, row[2] or "")] += 1
+            counts[(step, 2, period, srv_id, row[3] or "")] += 1
+    cur.executemany(ROLLUP_UPSERT_SQL, [key + (count,) for key, count in counts.items()])
+
+
+def _ranges(first, last, hours=True):
+    """ [(step, first period, last period)] covering minutes first..last, whole hours from the hour tier """
+    first_hour, end_hour = -(-first // 60), (last + 1) // 60
+    if not hours or first_hour >= end_hour:
+        return [(60, first, last)]
+    ranges = [(3600, first_hour, end_hour - 1)]
+    if first < first_hour * 60:
+        ranges.append((60, first, first_hour * 60 - 1))
+    if end_hour * 60 <= last:
+        ranges.append((60, end_hour * 60, last))
+    return ranges
+
+
+def skew(counts):
+    """ spread of the per server request counts """
+    if not counts:
+        return None
+    mean = sum(counts) / len(counts)
+    stddev = math.sqrt(sum((count - mean) ** 2 for count in counts) / len(counts))
+    return {
+        "servers": len(counts),
+        "min": min(counts),
+        "max": max(counts),
+        "mean": round(mean, 3),
+        "stddev": round(stddev, 3),
+        "cv": round(stddev / mean, 4) if mean else None,
+        "max_min_ratio": round(max(counts) / min(counts), 4) if min(counts) else None,
+    }
+
+
+class Analytics:
+    """Folds the requests table into analytics_rollup and answers grouped count queries
+
+    A background thread adds the rows above the FoldedID watermark in
+    batches, each in one transaction with the watermark update, so the
+    rollup is exact and several processes may fold safely. Partitioned
+    writes roll up their rows in the catalog transaction instead (see
+    rollup_rows), the thread then only folds the legacy requests table.
+    Rollups are kept per minute and per hour and outlive retention.
+    """
+
+    def __init__(self, db, interval=5.0, batch_size=50000, batch_pause=0.05):
+        """Initialize the rollup and start the fold thread unless interval is 0"""
+        self.log = get_logger()
+        self.db = db
+        self.interval = max(float(interval), 0)
+        self.batch_size = max(int(batch_size), 1)
+        self.batch_pause = max(float(batch_pause), 0)
+        self._stop = threading.Event()
+        analytics_init(self.db.connection())
+        self.thread = None
+        if self.interval:
+            self.thread = threading.Thread(
+                target=self._run, name="pystats-analytics", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        """stop the fold thread, waits for the current batch"""
+        self._stop.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        """fold thread main loop"""
+        while not self._stop.wait(self.interval):
+            try:
+                self.fold()
+            except sqlite3.Error as err:
+                self.log.warning("analytics: fold failed: %s", err)
+
+    def _fold_batch(self, cur):
+        """ fold the next batch of ids above the watermark in one transaction, returns ids folded """
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            folded = cur.execute("SELECT FoldedID FROM analytics_state WHERE ID = 0").fetchone()[0]
+            rec = cur.execute(
+                "SELECT RequestID FROM requests ORDER BY RequestID DESC LIMIT 1"
+            ).fetchone()
+            bound = min(rec[0], folded + self.batch_size) if rec else folded
+            if bound <= folded:
+                cur.execute("COMMIT")
+                return 0
+            for step in STEPS:
+                for dim, (table, id_col, value_col) in enumerate(DIMENSION_DICTIONARIES):
+                    cur.execute(
+                        f"""
+                        INSERT INTO analytics_rollup (
+                            Step, Dimension, Period, ServerID, Value, RequestCount
+                        )
+                        SELECT {step}, {dim}, CAST(r.Epoch / {step} AS INTEGER),
+                            COALESCE(r.ServerID, 0), COALESCE(d.{value_col}, ''), COUNT(*)
+                        FROM requests r
+                        LEFT JOIN {table} d ON d.{id_col} = r.{id_col}
+                        WHERE r.RequestID > ? AND r.RequestID <= ?
+                        GROUP BY 3, 4, r.{id_col}
+                        ON CONFLICT(Step, Dimension, Period, ServerID, Value) DO UPDATE SET
+                            RequestCount = RequestCount + excluded.RequestCount
+                        """,
+                        (folded, bound),
+                    )
+            cur.execute("UPDATE analytics_state SET FoldedID = ? WHERE ID = 0", (bound,))
+            cur.execute("COMMIT")
+        except sqlite3.Error:
+            cur.execute("ROLLBACK")
+            raise
+        return bound - folded
+
+    def fold(self):
+        """ fold every request above the watermark, returns ids folded """
+        started = time.monotonic()
+        folded = 0
+        with closing(self.db.connection().cursor()) as cur:
+            while not self._stop.is_set():
+                ids = self._fold_batch(cur)
+                if not ids:
+                    break
+                folded += ids
+                if ids < self.batch_size:
+                    break
+                # let queued writers in between batches
+                time.sleep(self.batch_pause)
+        if folded > self.batch_size:
+            self.log.info(
+                "analytics: folded %s request ids in %.3fs", folded, time.monotonic() - started
+            )
+        return folded
+
+    def folded_id(self):
+        """ highest RequestID of the requests table included in the rollup """
+        return self.db.connection().execute(
+            "SELECT FoldedID FROM analytics_state WHERE ID = 0"
+        ).fetchone()[0]
+
+    def _rows(self, dim, ranges, srv_id=None):
+        """ (sql, args) of the rollup rows of a dimension in ranges: (T epoch, ServerID, Value, RequestCount) """
+        srv_where = "AND ServerID = ?" if srv_id is not None else ""
+        srv_args = (int(srv_id),) if srv_id is not None else ()
+        parts = []
+        args = ()
+        for step, first, last in ranges:
+            parts.append(
+                f"""
+                SELECT Period * {step} AS T, ServerID, Value, RequestCount
+                FROM analytics_rollup
+                WHERE Step = {step} AND Dimension = ? AND Period BETWEEN ? AND ? {srv_where}
+                """
+            )
+            args += (dim, first, last) + srv_args
+        return " UNION ALL ".join(parts), args
+
+    def query(self, group_by="server", since=None, until=None, srv_id=None, bucket=60, limit=100):
+        """request counts grouped by server, url, address, user_agent or time bucket
+
+        The window is widened to whole minutes and bucket to whole minutes,
+        hours when it is 3600 or more. skew always compares the servers
+        that logged requests in the window, whatever group_by is.
+        """
+        until = time.time() if until is None else float(until)
+        since = until - 3600 if since is None else float(since)
+        first, last = int(since // 60), int(until // 60)
+        limit = min(max(int(limit), 1), 10000)
+        bucket = max(int(bucket) // 60, 1) * 60
+        if bucket >= 3600:
+            bucket -= bucket % 3600
+        con = self.db.connection()
+        sql, args = self._rows(0, _ranges(first, last))
+        per_server = con.execute(
+            f"""
+            SELECT r.ServerID, SUM(r.RequestCount), s.Hostname, s.IP
+            FROM ({sql}) r
+            LEFT JOIN servers s ON s.ServerID = r.ServerID
+            GROUP BY r.ServerID
+            ORDER BY r.ServerID ASC
+            """,
+            args,
+        ).fetchall()
+        if group_by == "server":
+            groups = [
+                {"server_id": row[0], "hostname": row[2], "ip": row[3], "count": row[1]}
+                for row in per_server
+                if srv_id is None or row[0] == int(srv_id)
+            ]
+        elif group_by == "time":
+            # hour rows only fit buckets of whole hours
+            sql, args = self._rows(0, _ranges(first, last, bucket % 3600 == 0), srv_id)
+            groups = [
+                {"t": row[0] * bucket, "count": row[1]}
+                for row in con.execute(
+                    f"""
+                    SELECT T / {bucket}, SUM(RequestCount)
+                    FROM ({sql})
+                    GROUP BY 1
+                    ORDER BY 1 ASC
+                    """,
+                    args,
+                )
+            ]
+        else:
+            sql, args = self._rows(DIMENSIONS[group_by], _ranges(first, last), srv_id)
+            groups = [
+                {group_by: row[0], "count": row[1]}
+                for row in con.execute(
+                    f"""
+                    SELECT Value, SUM(RequestCount) AS n
+                    FROM ({sql})
+                    GROUP BY Value
+                    ORDER BY n DESC
+                    LIMIT ?
+                    """,
+                    args + (limit,),
+                )
+            ]
+        total = sum(row[1] for row in per_server if srv_id is None or row[0] == int(srv_id))
+        return {
+            "group_by": group_by,
+            "since": first * 60,
+            "until": (last + 1) * 60,
+            "bucket": bucket if group_by == "time" else None,
+            "total": total,
+            "groups": groups,
+            "skew": skew([row[1] for row in per_server]),
+        }
@@ -0,0 +1,231 @@
+""" storage backends behind the Requests api """
+import time
+from abc import ABC, abstractmethod
+from urllib.parse import urlsplit
+
+
+REQUEST_BACKENDS = ("sqlite", "memory")
+NO_DATA_ROW = ("N0 Data", "N0 Data", "N0 Data", "N0 Data", "N0 Data", "N0 Data")
+
+
+def get_backend(kind, db_path, memory_rows=100000, sampler=None, **options):
+    """ the Requests backend of a kind, options go to the sqlite one """
+    # pylint: disable=import-outside-toplevel
+    # only the selected backend is imported
+    if kind == "memory":
+        from .memory import MemoryRequests
+        return MemoryRequests(rows=memory_rows, sampler=sampler)
+    from .requests import Requests
+    return Requests(db_path, sampler=sampler, **options)
+
+
+class RequestsBackend(ABC):
+    """What the routes, /metrics and the export / import commands use of a request log
+
+    Rows are (RequestID, Epoch, RemoteAddress, RemoteUserAgent,
+    RequestURL, ServerID) tuples with RequestIDs handed out in
+    increasing order. Subclasses set log, db_active, server_id, ready,
+    writer and sampler and implement the abstract methods, a backend
+    missing one fails when it is created. With a sampler only some requests get a row;
+    the totals add the requests it skipped so they stay exact.
+    """
+
+    log = None
+    db_active = False
+    server_id = 0
+    ready = None
+    # a RequestWriter when rows are queued for a background thread
+    writer = None
+    # a Sampler (src/sampling.py) when only some requests are stored
+    sampler = None
+    # an Interner (src/interning.py) when column values are stored as dictionary ids
+    interner = None
+
+    def put_request(self, remote_addr, remote_user_agent, request_url, route=None) -> bool:
+        """store the request data, queued when the backend has a writer
+
+        route names the request for the sampler's counters, the url path
+        when not given.
+        """
+        if not self.ready.is_set():
+            # deferred init still running, /ready keeps traffic away until it is done
+            self.log.debug("put request: DB init in progress, dropped %s", request_url)
+            return False
+        if not self.db_active:
+            self.log.warning(
+                "put request: No DB Connection: remote_addr %s, remote_user_agent %s, request_url %s",
+                remote_addr, remote_user_agent, request_url,
+            )
+            return False
+        if self.sampler:
+            if route is None:
+                route = urlsplit(str(request_url)).path
+            if not self.sampler.keep(str(remote_addr), route):
+                return True
+        req_data = {
+            "epoch": float(round(time.time(), 4)),
+            "remote_address": str(remote_addr),
+            "remote_user_agent": str(remote_user_agent),
+            "request_url": str(request_url),
+            "server_id": int(self.server_id),
+        }
+        if self.writer:
+            if self.writer.put(req_data):
+                return True
+            self.log.warning("put request: write queue full, writing synchronously")
+        self._insert_rows([req_data])
+        return True
+
+    def count_status(self, status):
+        """ count the response status of a request passed to put_request """
+        if self.sampler:
+            self.sampler.count_status(status)
+
+    @abstractmethod
+    def _insert_rows(self, batch):
+        """ store a batch of request dicts """
+
+    @abstractmethod
+    def import_requests(self, chunks, progress_interval=5.0):
+        """ bulk load chunks of request dicts (see src/importer.py), returns rows imported """
+
+    @abstractmethod
+    def close(self):
+        """flush any queued requests and stop the background tasks"""
+
+    def get_srv_id(self):
+        """get the server id for this instance of pystats"""
+        return self.server_id
+
+    def get_req_total(self):
+        """get the total number of requests, stored or skipped by sampling"""
+        return self.get_last_id() + self._skipped_total()
+
+    @abstractmethod
+    def get_last_id(self):
+        """get the highest RequestID handed out"""
+
+    @abstractmethod
+    def _skipped_total(self, srv_id=None):
+        """ requests the sampler of every (or one) server did not store """
+
+    @abstractmethod
+    def get_counters(self):
+        """ exact request counts of this server: {"route": {route: n}, "status": {code: n}} """
+
+    def get_sampling(self):
+        """ the sampling mode with the stored and total request counts, None without sampling """
+        if not self.sampler:
+            return None
+        total = self.get_req_total()
+        return {
+            "mode": self.sampler.describe(),
+            "total": total,
+            "stored": total - self._skipped_total(),
+        }
+
+    @abstractmethod
+    def get_first_id(self):
+        """get the lowest RequestID still stored, None when rows below the newest id may still arrive"""
+
+    @abstractmethod
+    def get_srv_total(self):
+        """get total number of servers"""
+
+    def _parse_min_max(self, pn_start, pn_count, req_total):
+        """ get the min and max ids for pagination and sanitize for integers """
+        try:
+            min = int(pn_start)
+            min = min if min > 0 else 1
+            pn_count = int(pn_count) if pn_count < 100 else 100
+            max_min = int(req_total) - int(pn_count -1 )
+            min = min if min <= max_min else max_min
+            max = min + int(pn_count - 1)
+            return (min, max)
+        except TypeError:
+            return(1, 10)
+
+    @abstractmethod
+    def get_srvs(self, pn_start=1, pn_count=10):
+        """ get all the servers: list of (ServerID,srv_req_tot,Hostname,IP,Platform) """
+
+    @abstractmethod
+    def get_requests(self, pn_start=1, pn_count=10):
+        """ get all the requests: list of tuple """
+
+    @abstractmethod
+    def get_srv_req_tot(self, srv_id):
+        """ get number of requests for server """
+
+    @abstractmethod
+    def get_srv_req_totals(self):
+        """ get the request total of every server: list of (ServerID,Hostname,IP,total) """
+
+    @abstractmethod
+    def get_srv_socket(self, srv_id):
+        """ get the hostname and ip of a server """
+
+    @abstractmethod
+    def get_srv_requests(self, srv_id, pn_page=1, pn_count=10):
+        """ get a page of a server's requests by page number: list of tuple """
+
+    @abstractmethod
+    def get_srv_last_rec(self, srv_id):
+        """ get the last RequestID of a server """
+
+    @abstractmethod
+    def _fetch(self, srv_id, desc, cursor_id, limit):
+        """ up to limit rows after (or before when desc) a RequestID, optionally for one server """
+
+    @staticmethod
+    def _page_count(pn_count):
+        """ rows per page clamped to 1..100, 10 when not a number """
+        try:
+            return min(max(int(pn_count), 1), 100)
+        except (TypeError, ValueError):
+            return 10
+
+    def _keyset_page(self, srv_id, after_id, before_id, pn_count):
+        """ one page of requests by RequestID cursor, optionally for one server """
+        pn_count = self._page_count(pn_count)
+        rows = None
+        if before_id is not None:
+            rows = self._fetch(srv_id, True, before_id, pn_count)
+            rows.reverse()
+            # stepped back past the first record: show the first page
+            if len(rows) < pn_count:
+                after_id, rows = 0, None
+        if rows is None:
+            after_id = int(after_id) if after_id is not None else 0
+            rows = self._fetch(srv_id, False, after_id, pn_count)
+            # stepped past the last record: show the last page
+            if not rows and after_id > 0:
+                rows = self._fetch(srv_id, True, after_id + 1, pn_count)
+                rows.reverse()
+        return rows
+
+    def get_requests_page(self, after_id=None, before_id=None, pn_count=10):
+        """ get a page of requests after or before a RequestID: list of tuple """
+        if not self.db_active:
+            self.log.warning("get_requests_page: No DB Connection")
+            return [NO_DATA_ROW]
+        return self._keyset_page(None, after_id, before_id, pn_count)
+
+    def get_srv_requests_page(self, srv_id, after_id=None, before_id=None, pn_count=10):
+        """ get a page of a server's requests after or before a RequestID: list of tuple """
+        if not self.db_active:
+            self.log.warning("get_srv_requests_page: No DB Connection")
+            return [NO_DATA_ROW]
+        return self._keyset_page(srv_id, after_id, before_id, pn_count)
+
+    @abstractmethod
+    def iter_requests(
+        self, srv_id=None, since=None, until=None, min_id=None, max_id=None, chunk=1000
+    ):
+        """ yield lists of up to chunk request rows plus Hostname and IP, in RequestID order """
+
+    @abstractmethod
+    def get_analytics(
+        self, group_by="server", since=None, until=None, srv_id=None, bucket=60, limit=100
+    ):
+        """ request counts over a time window grouped by server, url, address, user_agent or time """
@@ -40,6 +40,374 @@ e.g. -l 'cluster=my-cluster' -l 'service=my-svc'
 DEFAULT: None
 
 
+"""
+WRITE_BEHIND = """
+Queue requests in memory and write them to the DB from a single
+background thread in batches instead of on the request thread.
+DEFAULT: False
+
+
+"""
+BATCH_SIZE = """
+Max number of requests committed in one write-behind transaction.
+DEFAULT: 100
+
+
+"""
+FLUSH_INTERVAL = """
+Max seconds a queued request waits before its batch is committed.
+DEFAULT: 1.0
+
+
+"""
+QUEUE_SIZE = """
+Max number of requests held in the write-behind queue. When full,
+requests are written synchronously on the request thread.
+DEFAULT: 10000
+
+
+"""
+DB_SYNCHRONOUS = """
+SQLite synchronous pragma for the WAL journal: OFF, NORMAL, FULL or EXTRA.
+DEFAULT: NORMAL
+
+
+"""
+DB_CACHE_SIZE = """
+SQLite cache_size pragma per connection. Negative values are KiB,
+positive values are pages.
+DEFAULT: -8000
+
+
+"""
+DB_MMAP_SIZE = """
+SQLite mmap_size pragma per connection in bytes. 0 disables mmap.
+DEFAULT: 0
+
+
+"""
+DB_BUSY_TIMEOUT = """
+Milliseconds a connection waits on a locked DB before failing.
+DEFAULT: 5000
+
+
+"""
+CPU_INTERVAL = """
+Seconds between background cpu usage samples. cpu_percent values
+are averaged over this interval.
+DEFAULT: 1.0
+
+
+"""
+UPTIME_TTL = """
+Seconds the cached uptime stats are reused before being refreshed.
+DEFAULT: 1.0
+
+
+"""
+MEM_TTL = """
+Seconds the cached memory stats are reused before being refreshed.
+DEFAULT: 1.0
+
+
+"""
+CPU_TTL = """
+Seconds the cached cpu stats are reused before being refreshed.
+DEFAULT: 1.0
+
+
+"""
+RETENTION_MAX_AGE = """
+Seconds a request row is kept before it is deleted, its count stays
+in the analytics_rollup table behind /analytics and server_totals.
+0 disables age based retention.
+DEFAULT: 0
+
+
+"""
+RETENTION_MAX_ROWS = """
+Max number of raw request rows kept, older rows are deleted once
+analytics_rollup counts them. 0 disables row count based retention.
+DEFAULT: 0
+
+
+"""
+RETENTION_INTERVAL = """
+Seconds between retention maintenance runs.
+DEFAULT: 300
+
+
+"""
+RETENTION_BATCH_SIZE = """
+Rows rolled up and deleted per transaction so writers are never
+stalled for long.
+DEFAULT: 1000
+
+
+"""
+PARTITION_BY = """
+Store request rows in partition files next to --db-file, one per
+day (requests.d20261018.db) or per --partition-rows rows
+(requests.r00000012.db). The --db-file keeps the servers table and
+the partition catalog. Retention drops whole partitions.
+DEFAULT: none
+
+
+"""
+PARTITION_ROWS = """
+Rows per partition file with --partition-by rows.
+DEFAULT: 1000000
+
+
+"""
+TIMINGS = """
+Record latency histograms per route, per Requests sql call and per
+Stats collector group, served at /debug/timings (JSON) and
+/debug/timings?format=prometheus.
+DEFAULT: False
+
+
+"""
+EXPORT = """
+Stream the requests table joined with servers as JSONL or CSV
+instead of starting the web server.
+e.g. pystat.py -f requests.db export --format csv --gzip -o requests.csv.gz
+"""
+EXPORT_FORMAT = """
+Export format.
+DEFAULT: jsonl
+
+
+"""
+EXPORT_GZIP = """
+gzip the export.
+DEFAULT: False
+
+
+"""
+EXPORT_SRV_ID = """
+Only requests of this ServerID.
+DEFAULT: all servers
+
+
+"""
+EXPORT_SINCE = """
+Only requests with Epoch >= since.
+DEFAULT: no lower bound
+
+
+"""
+EXPORT_UNTIL = """
+Only requests with Epoch < until.
+DEFAULT: no upper bound
+
+
+"""
+EXPORT_MIN_ID = """
+Only requests with RequestID >= min-id.
+DEFAULT: no lower bound
+
+
+"""
+EXPORT_MAX_ID = """
+Only requests with RequestID <= max-id.
+DEFAULT: no upper bound
+
+
+"""
+EXPORT_OUTPUT = """
+File to write the export to, - for stdout.
+DEFAULT: -
+
+
+"""
+IMPORT = """
+Bulk load a requests JSONL export (see export) into the DB instead of
+starting the web server. Servers are matched by Hostname and IP, rows
+get new RequestIDs. Meant to run while no pystats instance writes to
+the DB: the requests index and the server_totals trigger are dropped
+during the load and rebuilt at the end.
+e.g. pystat.py -f requests.db import -i requests.jsonl.gz
+"""
+IMPORT_INPUT = """
+JSONL file to import, - for stdin, *.gz is decompressed.
+DEFAULT: -
+
+
+"""
+IMPORT_CHUNK_SIZE = """
+Rows parsed and inserted per transaction.
+DEFAULT: 50000
+
+
+"""
+WORKERS = """
+Number of server processes. Above 1 a supervisor pre-forks that many
+workers sharing the listening port and respawns dead ones; each worker
+has its own DB connections. 0 picks the pod's CPU limit (cgroup
+cpu.max or the CPU affinity mask).
+DEFAULT: 1
+
+
+"""
+THREADS = """
+waitress worker threads per process.
+DEFAULT: 4
+
+
+"""
+CONNECTION_LIMIT = """
+Max open client connections per process before waitress stops accepting.
+DEFAULT: 100
+
+
+"""
+BACKLOG = """
+Listen backlog of the server socket.
+DEFAULT: 1024
+
+
+"""
+REUSE_PORT = """
+With --workers above 1 give every worker its own SO_REUSEPORT socket so
+the kernel spreads connections across them instead of one shared socket.
+DEFAULT: False
+
+
+"""
+SHUTDOWN_TIMEOUT = """
+Seconds workers get to finish in flight requests on SIGTERM before
+the supervisor kills them.
+DEFAULT: 10.0
+
+
+"""
+FAST_START = """
+Run schema setup and server registration (a DNS lookup) in the
+background so the web server starts listening right away; /ready
+answers 503 until they are done.
+DEFAULT: False
+
+
+"""
+HISTORY_TIERS = """
+Downsampling tiers of the in-memory stats history served on /history
+as step_seconds:slots, comma separated; none disables the history.
+The default keeps 1s for 10 minutes, 10s for 6 hours and 1m for 7 days.
+DEFAULT: 1:600,10:2160,60:10080
+
+
+"""
+COLLECTOR = """
+Where system stats come from: proc reads /proc and the cgroup v2
+files over kept open descriptors (linux only, adds the pod's cgroup
+limits, throttling and memory pressure), psutil is portable, auto
+picks proc when available.
+DEFAULT: auto
+
+
+"""
+PAGE_CACHE_SIZE = """
+Bytes of rendered /requests and /srv_requests tables kept in an LRU
+once their page can no longer change (every row below the newest id).
+The tail page and the totals are always read live. 0 disables it.
+DEFAULT: 8388608
+
+
+"""
+ANALYTICS_INTERVAL = """
+Seconds between folds of new requests into the per minute and per hour
+rollups /analytics reads from. 0 stops folding (partitioned DBs roll up
+on insert and only need it for rows of the legacy requests table).
+DEFAULT: 5.0
+
+
+"""
+BACKEND = """
+Where the request log is kept: sqlite in --db-file, or memory in a
+bounded in-process ring of --memory-rows rows for ephemeral tests. The
+memory log is lost on exit and not shared between prefork workers.
+DEFAULT: sqlite
+
+
+"""
+MEMORY_ROWS = """
+Rows the memory backend keeps, the oldest are dropped first. Server
+totals still count every request.
+DEFAULT: 100000
+
+
+"""
+SAMPLE_EVERY = """
+Store only every Nth request in the request log. Totals per server,
+route and response status stay exact: skipped requests are counted and
+checkpointed to the DB. Prefork workers sample independently.
+DEFAULT: 1
+
+
+"""
+SAMPLE_PER_SECOND = """
+Store at most this many requests per second for each --sample-key,
+after --sample-every. 0 disables the rate limit.
+DEFAULT: 0
+
+
+"""
+SAMPLE_KEY = """
+What --sample-per-second limits: each route or each client address.
+DEFAULT: route
+
+
+"""
+INTERN_CACHE_SIZE = """
+Remote addresses, user agents and urls are stored once in dictionary
+tables and referenced by id. This many of the most recently used values
+of each are kept in memory so inserts rarely need a lookup query.
+DEFAULT: 10000
+
+
+"""
+LOG_LEVEL = """
+Lowest level of the log lines written to stderr.
+DEFAULT: DEBUG
+
+
+"""
+LOG_FORMAT = """
+Log line format: text as created;level;message or json with one
+compact object per line.
+DEFAULT: text
+
+
+"""
+LOG_DEDUP_INTERVAL = """
+Seconds a warning or error is rate limited for: repeats of the same
+message, whatever its arguments, are counted instead of written and the
+next line shows how many were suppressed. 0 writes every one.
+DEFAULT: 10.0
+
+
+"""
+STREAM_INTERVAL = """
+Seconds between the stats updates /stream sends. One sampler serves
+every subscriber. 0 disables /stream.
+DEFAULT: 1.0
+
+
+"""
+STREAM_CLIENTS = """
+Subscribers /stream accepts at once, more get a 503. Each one holds a
+waitress thread while connected, keep it below --threads.
+DEFAULT: 2
+
+
+"""
+CHECKPOINT_INTERVAL = """
+Seconds between writes of the sampling counters to the DB, they are
+also written on shutdown.
+DEFAULT: 5.0
+
+
 """
 
 def parse_cfg():
@@ -87,6 +455,395 @@ def parse_cfg():
         default=[],
         action="append",
     )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        help=BACKEND,
+        choices=["sqlite", "memory"],
+        default="sqlite",
+    )
+    parser.add_argument(
+        "--memory-rows",
+        dest="memory_rows",
+        help=MEMORY_ROWS,
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        "--log-level",
+        dest="log_level",
+        help=LOG_LEVEL,
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="DEBUG",
+    )
+    parser.add_argument(
+        "--log-format",
+        dest="log_format",
+        help=LOG_FORMAT,
+        choices=["text", "json"],
+        default="text",
+    )
+    parser.add_argument(
+        "--log-dedup-interval",
+        dest="log_dedup_interval",
+        help=LOG_DEDUP_INTERVAL,
+        type=float,
+        default=10.0,
+    )
+    parser.add_argument(
+        "--stream-interval",
+        dest="stream_interval",
+        help=STREAM_INTERVAL,
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--stream-clients",
+        dest="stream_clients",
+        help=STREAM_CLIENTS,
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--intern-cache-size",
+        dest="intern_cache_size",
+        help=INTERN_CACHE_SIZE,
+        type=int,
+        default=10000,
+    )
+    parser.add_argument(
+        "--sample-every",
+        dest="sample_every",
+        help=SAMPLE_EVERY,
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--sample-per-second",
+        dest="sample_per_second",
+        help=SAMPLE_PER_SECOND,
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "--sample-key",
+        dest="sample_key",
+        help=SAMPLE_KEY,
+        choices=["route", "client"],
+        default="route",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        dest="checkpoint_interval",
+        help=CHECKPOINT_INTERVAL,
+        type=float,
+        default=5.0,
+    )
+    parser.add_argument(
+        "--write-behind",
+        dest="write_behind",
+        help=WRITE_BEHIND,
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        help=BATCH_SIZE,
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--flush-interval",
+        dest="flush_interval",
+        help=FLUSH_INTERVAL,
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--queue-size",
+        dest="queue_size",
+        help=QUEUE_SIZE,
+        type=int,
+        default=10000,
+    )
+    parser.add_argument(
+        "--db-synchronous",
+        dest="db_synchronous",
+        help=DB_SYNCHRONOUS,
+        type=str.upper,
+        choices=["OFF", "NORMAL", "FULL", "EXTRA"],
+        default="NORMAL",
+    )
+    parser.add_argument(
+        "--db-cache-size",
+        dest="db_cache_size",
+        help=DB_CACHE_SIZE,
+        type=int,
+        default=-8000,
+    )
+    parser.add_argument(
+        "--db-mmap-size",
+        dest="db_mmap_size",
+        help=DB_MMAP_SIZE,
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--db-busy-timeout",
+        dest="db_busy_timeout",
+        help=DB_BUSY_TIMEOUT,
+        type=int,
+        default=5000,
+    )
+    parser.add_argument(
+        "--cpu-interval",
+        dest="cpu_interval",
+        help=CPU_INTERVAL,
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--uptime-ttl",
+        dest="uptime_ttl",
+        help=UPTIME_TTL,
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--mem-ttl",
+        dest="mem_ttl",
+        help=MEM_TTL,
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--cpu-ttl",
+        dest="cpu_ttl",
+        help=CPU_TTL,
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--retention-max-age",
+        dest="retention_max_age",
+        help=RETENTION_MAX_AGE,
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--retention-max-rows",
+        dest="retention_max_rows",
+        help=RETENTION_MAX_ROWS,
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--retention-interval",
+        dest="retention_interval",
+        help=RETENTION_INTERVAL,
+        type=float,
+        default=300,
+    )
+    parser.add_argument(
+        "--retention-batch-size",
+        dest="retention_batch_size",
+        help=RETENTION_BATCH_SIZE,
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--partition-by",
+        dest="partition_by",
+        help=PARTITION_BY,
+        type=str,
+        choices=["none", "day", "rows"],
+        default="none",
+    )
+    parser.add_argument(
+        "--partition-rows",
+        dest="partition_rows",
+        help=PARTITION_ROWS,
+        type=int,
+        default=1000000,
+    )
+    parser.add_argument(
+        "--timings",
+        dest="timings",
+        help=TIMINGS,
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        help=WORKERS,
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        help=THREADS,
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--connection-limit",
+        dest="connection_limit",
+        help=CONNECTION_LIMIT,
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--backlog",
+        dest="backlog",
+        help=BACKLOG,
+        type=int,
+        default=1024,
+    )
+    parser.add_argument(
+        "--reuse-port",
+        dest="reuse_port",
+        help=REUSE_PORT,
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--shutdown-timeout",
+        dest="shutdown_timeout",
+        help=SHUTDOWN_TIMEOUT,
+        type=float,
+        default=10.0,
+    )
+    parser.add_argument(
+        "--collector",
+        dest="collector",
+        help=COLLECTOR,
+        choices=["auto", "proc", "psutil"],
+        default="auto",
+    )
+    parser.add_argument(
+        "--history-tiers",
+        dest="history_tiers",
+        help=HISTORY_TIERS,
+        type=str,
+        default="1:600,10:2160,60:10080",
+    )
+    parser.add_argument(
+        "--analytics-interval",
+        dest="analytics_interval",
+        help=ANALYTICS_INTERVAL,
+        type=float,
+        default=5.0,
+    )
+    parser.add_argument(
+        "--page-cache-size",
+        dest="page_cache_size",
+        help=PAGE_CACHE_SIZE,
+        type=int,
+        default=8388608,
+    )
+    parser.add_argument(
+        "--fast-start",
+        dest="fast_start",
+        help=FAST_START,
+        action="store_true",
+        default=False,
+    )
+    # set by the prefork supervisor on the workers it starts
+    parser.add_argument(
+        "--worker-fd",
+        dest="worker_fd",
+        help=argparse.SUPPRESS,
+        type=int,
+        default=None,
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    export = subparsers.add_parser(
+        "export",
+        help=EXPORT,
+        description=EXPORT,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    export.add_argument(
+        "--format",
+        dest="export_format",
+        help=EXPORT_FORMAT,
+        choices=["jsonl", "csv"],
+        default="jsonl",
+    )
+    export.add_argument(
+        "--gzip",
+        dest="export_gzip",
+        help=EXPORT_GZIP,
+        action="store_true",
+        default=False,
+    )
+    export.add_argument(
+        "--srv-id",
+        dest="export_srv_id",
+        help=EXPORT_SRV_ID,
+        type=int,
+        default=None,
+    )
+    export.add_argument(
+        "--since",
+        dest="export_since",
+        help=EXPORT_SINCE,
+        type=float,
+        default=None,
+    )
+    export.add_argument(
+        "--until",
+        dest="export_until",
+        help=EXPORT_UNTIL,
+        type=float,
+        default=None,
+    )
+    export.add_argument(
+        "--min-id",
+        dest="export_min_id",
+        help=EXPORT_MIN_ID,
+        type=int,
+        default=None,
+    )
+    export.add_argument(
+        "--max-id",
+        dest="export_max_id",
+        help=EXPORT_MAX_ID,
+        type=int,
+        default=None,
+    )
+    export.add_argument(
+        "--output",
+        "-o",
+        dest="export_output",
+        help=EXPORT_OUTPUT,
+        type=str,
+        default="-",
+    )
+    importer = subparsers.add_parser(
+        "import",
+        help=IMPORT,
+        description=IMPORT,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    importer.add_argument(
+        "--input",
+        "-i",
+        dest="import_input",
+        help=IMPORT_INPUT,
+        type=str,
+        default="-",
+    )
+    importer.add_argument(
+        "--chunk-size",
+        dest="import_chunk_size",
+        help=IMPORT_CHUNK_SIZE,
+        type=int,
+        default=50000,
+    )
     cfg = parser.parse_args()
     if cfg.crate_path:
         db_dir = os.path.dirname(cfg.db_path)
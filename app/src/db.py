@@ -0,0 +1,84 @@
+""" per-thread sqlite connection manager """
+import sqlite3
+import threading
+from .logger import get_logger
+
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+
+class ConnectionManager:
+    """Keeps one long lived sqlite connection per thread with WAL and tuned pragmas"""
+
+    def __init__(
+        self,
+        db_path,
+        synchronous="NORMAL",
+        cache_size=-8000,
+        mmap_size=0,
+        busy_timeout=5000,
+        cached_statements=128,
+    ):
+        """Initialize the connection manager, connections are opened lazily"""
+        self.log = get_logger()
+        self.db_path = db_path
+        self.synchronous = str(synchronous).upper()
+        if self.synchronous not in SYNCHRONOUS_MODES:
+            self.synchronous = "NORMAL"
+        self.cache_size = int(cache_size)
+        self.mmap_size = int(mmap_size)
+        self.busy_timeout = int(busy_timeout)
+        self.cached_statements = int(cached_statements)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def connection(self):
+        """return this thread's connection, opening it on first use"""
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._connect()
+            self._local.con = con
+            with self._lock:
+                self._connections.append(con)
+        return con
+
+    def _connect(self):
+        """open a connection and apply the pragmas"""
+        # statements are parameterized so the per-connection statement
+        # cache reuses the prepared statements between calls
+        con = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout / 1000,
+            cached_statements=self.cached_statements,
+            check_same_thread=False,
+        )
+        try:
+            # only takes effect on a new DB and must come before the WAL switch,
+            # lets retention give deleted pages back with incremental_vacuum
+            con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            con.execute("PRAGMA journal_mode = WAL")
+            con.execute(f"PRAGMA synchronous = {self.synchronous}")
+            con.execute(f"PRAGMA cache_size = {self.cache_size}")
+            con.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+            con.execute(f"PRAGMA busy_timeout = {self.busy_timeout}")
+            con.execute("PRAGMA foreign_keys = 1")
+        except sqlite3.Error:
+            con.close()
+            raise
+        return con
+
+    def open_reader(self):
+        """open a separate connection for long reads such as exports, the caller closes it"""
+        return self._connect()
+
+    def close(self):
+        """close every connection handed out by this manager"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for con in connections:
+            try:
+                con.close()
+            except sqlite3.Error as err:
+                self.log.warning("ConnectionManager: close failed: %s", err)
+        self._local = threading.local()
@@ -0,0 +1,58 @@
+""" streaming JSONL / CSV export of the request log """
+import csv
+import io
+import json
+import zlib
+
+
+EXPORT_FORMATS = ("jsonl", "csv")
+EXPORT_COLUMNS = (
+    "RequestID",
+    "Epoch",
+    "RemoteAddress",
+    "RemoteUserAgent",
+    "RequestURL",
+    "ServerID",
+    "Hostname",
+    "IP",
+)
+
+
+def _jsonl(chunks):
+    """ one json object per row """
+    for rows in chunks:
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, row)), separators=(",", ":")) + "\n"
+            for row in rows
+        )
+
+
+def _csv(chunks):
+    """ csv with a header row """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def export_requests(reqs, fmt="jsonl", gzip=False, **filters):
+    """ generator of encoded export bytes, filters are passed to Requests.iter_requests """
+    chunks = reqs.iter_requests(**filters)
+    text = _csv(chunks) if fmt == "csv" else _jsonl(chunks)
+    if not gzip:
+        for part in text:
+            yield part.encode("utf-8")
+        return
+    # wbits 31 writes a gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for part in text:
+        data = compressor.compress(part.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,127 @@
+""" bounded in-memory history of numeric stats in array backed ring buffers """
+import threading
+import time
+from array import array
+
+
+DEFAULT_TIERS = "1:600,10:2160,60:10080"
+
+
+def parse_tiers(spec):
+    """ 'step:slots,...' into [(step seconds, slots)] finest first, [] for none """
+    if not spec or spec == "none":
+        return []
+    tiers = []
+    for part in spec.split(","):
+        step, slots = part.split(":")
+        tiers.append((max(int(step), 1), max(int(slots), 1)))
+    return sorted(tiers)
+
+
+class Tier:
+    """One downsampling level: a ring of slots buckets of step seconds with min/max/sum per series
+
+    Values live in flat preallocated float32 arrays, slot major, so a
+    sample is a handful of in place writes and a window query only
+    touches the slots it returns.
+    """
+
+    def __init__(self, step, slots, width):
+        self.step = step
+        self.slots = slots
+        self.width = width
+        self.buckets = array("q", [-1]) * slots
+        self.counts = array("I", [0]) * slots
+        self.mins = array("f", [0.0]) * (slots * width)
+        self.maxs = array("f", [0.0]) * (slots * width)
+        self.sums = array("f", [0.0]) * (slots * width)
+
+    def add(self, epoch, values):
+        """ fold one sample into its bucket, recycling the slot of an expired bucket """
+        bucket = int(epoch // self.step)
+        slot = bucket % self.slots
+        base = slot * self.width
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.counts[slot] = 1
+            row = array("f", values)
+            self.mins[base:base + self.width] = row
+            self.maxs[base:base + self.width] = row
+            self.sums[base:base + self.width] = row
+            return
+        self.counts[slot] += 1
+        mins, maxs, sums = self.mins, self.maxs, self.sums
+        for pos, val in enumerate(values, base):
+            if val < mins[pos]:
+                mins[pos] = val
+            if val > maxs[pos]:
+                maxs[pos] = val
+            sums[pos] += val
+
+    def query(self, first, last, cols):
+        """ (bucket start times, {col: (mins, maxs, avgs)}) of the buckets first..last still held """
+        first = max(first, last - self.slots + 1)
+        times = []
+        out = {col: ([], [], []) for col in cols}
+        for bucket in range(first, last + 1):
+            slot = bucket % self.slots
+            if self.buckets[slot] != bucket:
+                continue
+            times.append(bucket * self.step)
+            count = self.counts[slot]
+            base = slot * self.width
+            for col in cols:
+                pos = base + col
+                mins, maxs, avgs = out[col]
+                mins.append(round(self.mins[pos], 3))
+                maxs.append(round(self.maxs[pos], 3))
+                avgs.append(round(self.sums[pos] / count, 3))
+        return times, out
+
+
+class History:
+    """Fixed set of numeric series sampled into every downsampling tier at once"""
+
+    def __init__(self, names, tiers):
+        self.names = list(names)
+        self.index = {name: idx for idx, name in enumerate(self.names)}
+        self.tiers = [Tier(step, slots, len(self.names)) for step, slots in tiers]
+        self._lock = threading.Lock()
+
+    def add(self, epoch, values):
+        """ record one sample, values in the order of names """
+        with self._lock:
+            for tier in self.tiers:
+                tier.add(epoch, values)
+
+    def _tier(self, window, step):
+        """ the requested step's tier, else the finest tier that holds the whole window """
+        for tier in self.tiers:
+            if step is not None:
+                if tier.step >= step:
+                    return tier
+            elif tier.step * tier.slots >= window:
+                return tier
+        return self.tiers[-1]
+
+    def query(self, series=None, window=600, until=None, step=None):
+        """ min/max/avg per bucket of the named series (all when None) over the window """
+        until = time.time() if until is None else float(until)
+        window = max(float(window), 1)
+        tier = self._tier(window, step)
+        names = [name for name in series if name in self.index] if series else self.names
+        with self._lock:
+            times, cols = tier.query(
+                int((until - window) // tier.step),
+                int(until // tier.step),
+                [self.index[name] for name in names],
+            )
+        return {
+            "step": tier.step,
+            "since": until - window,
+            "until": until,
+            "t": times,
+            "series": {
+                name: dict(zip(("min", "max", "avg"), cols[self.index[name]])) for name in names
+            },
+        }
@@ -0,0 +1,74 @@
+""" streaming JSONL reader for bulk imports of exported request logs """
+import gzip
+import io
+import json
+import sys
+from .logger import get_logger
+
+
+class JsonlReader:
+    """Reads a requests JSONL export (see src/export.py) in chunks of request dicts
+
+    Every line is one object with at least Epoch. RemoteAddress,
+    RemoteUserAgent and RequestURL may be missing; Hostname and IP pick
+    the server, ServerID is only used when they are absent. RequestID is
+    ignored, imported rows get new ids so logs can be merged.
+    """
+
+    def __init__(self, path, chunk_size=50000):
+        """Initialize the reader, - reads stdin, *.gz is decompressed"""
+        self.log = get_logger()
+        self.path = path
+        self.chunk_size = max(int(chunk_size), 1)
+        self.lines = 0
+        self.skipped = 0
+
+    def _open(self):
+        """ text stream of the input """
+        if self.path == "-":
+            return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, "rt", encoding="utf-8")
+        return open(self.path, "r", encoding="utf-8")
+
+    def _parse(self, line):
+        """ one request dict or None for a malformed line """
+        try:
+            rec = json.loads(line)
+            srv_id = rec.get("ServerID")
+            return {
+                "epoch": float(rec["Epoch"]),
+                "remote_address": rec.get("RemoteAddress"),
+                "remote_user_agent": rec.get("RemoteUserAgent"),
+                "request_url": rec.get("RequestURL"),
+                "hostname": rec.get("Hostname"),
+                "ip": rec.get("IP"),
+                "server_id": int(srv_id) if srv_id is not None else None,
+            }
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return None
+
+    def __iter__(self):
+        """ yield lists of up to chunk_size request dicts """
+        fh = self._open()
+        try:
+            batch = []
+            for line in fh:
+                self.lines += 1
+                if not line.strip():
+                    continue
+                req_data = self._parse(line)
+                if req_data is None:
+                    if not self.skipped:
+                        self.log.warning("import: skipping malformed line %s", self.lines)
+                    self.skipped += 1
+                    continue
+                batch.append(req_data)
+                if len(batch) >= self.chunk_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            if self.path != "-":
+                fh.close()
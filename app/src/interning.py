@@ -0,0 +1,245 @@
+""" dictionary tables for the repeating request columns and the insert side intern cache """
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from .logger import get_logger
+
+
+# (table, id column, value column) in the order of the request row columns
+DICTIONARIES = (
+    ("remote_addresses", "AddressID", "RemoteAddress"),
+    ("user_agents", "UserAgentID", "RemoteUserAgent"),
+    ("request_urls", "URLID", "RequestURL"),
+)
+# request dict key of each dictionary, in DICTIONARIES order
+DICTIONARY_KEYS = ("remote_address", "remote_user_agent", "request_url")
+# values per IN (...) lookup, well below SQLITE_MAX_VARIABLE_NUMBER
+LOOKUP_CHUNK = 500
+
+
+def dictionaries_init(cur):
+    """ create the dictionary tables, always in the catalog (main) DB """
+    for table, id_col, value_col in DICTIONARIES:
+        cur.execute(
+            f"""CREATE TABLE IF NOT EXISTS main.{table}(
+                {id_col} INTEGER PRIMARY KEY,
+                {value_col} TEXT NOT NULL UNIQUE
+            )"""
+        )
+
+
+def requests_table_sql(schema="main", name="requests"):
+    """ CREATE TABLE of a requests table, partitions reserve ids in the catalog instead of AUTOINCREMENT """
+    if schema == "main":
+        return f"""CREATE TABLE IF NOT EXISTS main.{name}(
+            RequestID INTEGER PRIMARY KEY AUTOINCREMENT,
+            Epoch REAL NOT NULL,
+            AddressID INTEGER REFERENCES remote_addresses(AddressID),
+            UserAgentID INTEGER REFERENCES user_agents(UserAgentID),
+            URLID INTEGER REFERENCES request_urls(URLID),
+            ServerID INTEGER,
+            FOREIGN KEY(ServerID) REFERENCES servers(ServerID)
+        )"""
+    # foreign keys can not point into another DB file
+    return f"""CREATE TABLE IF NOT EXISTS {schema}.{name}(
+        RequestID INTEGER PRIMARY KEY,
+        Epoch REAL NOT NULL,
+        AddressID INTEGER,
+        UserAgentID INTEGER,
+        URLID INTEGER,
+        ServerID INTEGER
+    )"""
+
+
+def request_rows_sql(table, columns=""):
+    """ SELECT list and FROM of request rows with the dictionary values joined back, alias r """
+    return f"""r.RequestID,r.Epoch,a.RemoteAddress,u.RemoteUserAgent,l.RequestURL,r.ServerID{columns}
+        FROM {table} r
+        LEFT JOIN main.remote_addresses a ON a.AddressID = r.AddressID
+        LEFT JOIN main.user_agents u ON u.UserAgentID = r.UserAgentID
+        LEFT JOIN main.request_urls l ON l.URLID = r.URLID"""
+
+
+def normalize_requests(con, schema="main"):
+    """move a requests table with text columns over to dictionary ids, returns rows moved
+
+    Rows keep their RequestIDs, the main table also its sqlite_sequence
+    value and triggers. None when the table is already normalized.
+    Runs in one immediate transaction, other processes wait for it.
+    """
+    info_sql = f"PRAGMA {schema}.table_info(requests)"
+    if "RemoteAddress" not in {row[1] for row in con.execute(info_sql)}:
+        return None
+    log = get_logger()
+    started = time.monotonic()
+    # old rows may predate the servers they name, the copy keeps them as they are
+    con.execute("PRAGMA foreign_keys = 0")
+    try:
+        with closing(con.cursor()) as cur:
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                # another process may have been first
+                if "RemoteAddress" not in {row[1] for row in cur.execute(info_sql)}:
+                    cur.execute("COMMIT")
+                    return None
+                for table, _, value_col in DICTIONARIES:
+                    cur.execute(
+                        f"""
+                        INSERT OR IGNORE INTO main.{table} ({value_col})
+                        SELECT DISTINCT {value_col} FROM {schema}.requests
+                        WHERE {value_col} IS NOT NULL
+                        """
+                    )
+                triggers = []
+                seq = None
+                if schema == "main":
+                    triggers = [
+                        row[0]
+                        for row in cur.execute(
+                            "SELECT sql FROM main.sqlite_master WHERE type = 'trigger' AND tbl_name = 'requests'"
+                        )
+                    ]
+                    rec = cur.execute(
+                        "SELECT seq FROM main.sqlite_sequence WHERE name = 'requests'"
+                    ).fetchone()
+                    # partitioned DBs reserve ids past the rows of this table
+                    seq = rec[0] if rec else 0
+                cur.execute(requests_table_sql(schema, "requests_normalized"))
+                cur.execute(
+                    f"""
+                    INSERT INTO {schema}.requests_normalized (
+                        RequestID, Epoch, AddressID, UserAgentID, URLID, ServerID
+                    )
+                    SELECT r.RequestID, r.Epoch, a.AddressID, u.UserAgentID, l.URLID, r.ServerID
+                    FROM {schema}.requests r
+                    LEFT JOIN main.remote_addresses a ON a.RemoteAddress = r.RemoteAddress
+                    LEFT JOIN main.user_agents u ON u.RemoteUserAgent = r.RemoteUserAgent
+                    LEFT JOIN main.request_urls l ON l.RequestURL = r.RequestURL
+                    ORDER BY r.RequestID ASC
+                    """
+                )
+                moved = cur.rowcount
+                cur.execute(f"DROP TABLE {schema}.requests")
+                cur.execute(f"ALTER TABLE {schema}.requests_normalized RENAME TO requests")
+                cur.execute(
+                    f"""CREATE INDEX IF NOT EXISTS {schema}.requests_server_request
+                    ON requests(ServerID, RequestID)"""
+                )
+                if schema == "main":
+                    for sql in triggers:
+                        cur.execute(sql)
+                    # sqlite_sequence has no key, the renamed table may have brought a row
+                    last = cur.execute("SELECT MAX(RequestID) FROM requests").fetchone()[0]
+                    cur.execute("DELETE FROM sqlite_sequence WHERE name = 'requests'")
+                    cur.execute(
+                        "INSERT INTO sqlite_sequence (name, seq) VALUES ('requests', ?)",
+                        (max(seq, last or 0),),
+                    )
+                cur.execute("COMMIT")
+            except sqlite3.Error:
+                cur.execute("ROLLBACK")
+                raise
+    finally:
+        con.execute("PRAGMA foreign_keys = 1")
+    log.info(
+        "interning: moved %s rows of %s.requests to dictionary ids in %.3fs, "
+        "VACUUM gives the freed pages back to the filesystem",
+        moved, schema, time.monotonic() - started,
+    )
+    return moved
+
+
+class Interner:
+    """Maps request column values to their dictionary ids with a per column LRU
+
+    Values missing from the LRU are added with INSERT OR IGNORE and read
+    back in their own short transaction before the rows that use them,
+    so the ids are committed before they are cached and several
+    processes can intern the same value. Dictionary rows are never
+    deleted, which keeps cached ids valid for the life of the process.
+    """
+
+    def __init__(self, db, max_entries=10000):
+        """Initialize the caches, one per dictionary"""
+        self.db = db
+        self.max_entries = max(int(max_entries), 1)
+        self._lock = threading.Lock()
+        self._caches = tuple(OrderedDict() for _ in DICTIONARIES)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ids(self, batch):
+        """ [AddressID, UserAgentID, URLID] of every request dict of batch, None for missing values """
+        values = [
+            [None if req_data[key] is None else str(req_data[key]) for key in DICTIONARY_KEYS]
+            for req_data in batch
+        ]
+        result = [[None] * len(DICTIONARIES) for _ in batch]
+        missing = tuple(set() for _ in DICTIONARIES)
+        with self._lock:
+            for row, row_values in zip(result, values):
+                for dim, value in enumerate(row_values):
+                    if value is None:
+                        continue
+                    cache = self._caches[dim]
+                    value_id = cache.get(value)
+                    if value_id is None:
+                        missing[dim].add(value)
+                        self.misses += 1
+                    else:
+                        cache.move_to_end(value)
+                        row[dim] = value_id
+                        self.hits += 1
+        if not any(missing):
+            return result
+        found = self._lookup(missing)
+        with self._lock:
+            for dim, value_ids in enumerate(found):
+                cache = self._caches[dim]
+                cache.update(value_ids)
+                while len(cache) > self.max_entries:
+                    cache.popitem(last=False)
+                    self.evictions += 1
+        for row, row_values in zip(result, values):
+            for dim, value in enumerate(row_values):
+                if row[dim] is None and value is not None:
+                    row[dim] = found[dim][value]
+        return result
+
+    def _lookup(self, missing):
+        """ add the missing values of every dictionary, returns a value -> id dict per dictionary """
+        con = self.db.connection()
+        found = tuple({} for _ in DICTIONARIES)
+        with con:
+            for dim, (table, id_col, value_col) in enumerate(DICTIONARIES):
+                values = sorted(missing[dim])
+                con.executemany(
+                    f"INSERT OR IGNORE INTO {table} ({value_col}) VALUES (?)",
+                    [(value,) for value in values],
+                )
+                for start in range(0, len(values), LOOKUP_CHUNK):
+                    chunk = values[start:start + LOOKUP_CHUNK]
+                    marks = ",".join("?" * len(chunk))
+                    found[dim].update(
+                        (value, value_id)
+                        for value_id, value in con.execute(
+                            f"SELECT {id_col}, {value_col} FROM {table} WHERE {value_col} IN ({marks})",
+                            chunk,
+                        )
+                    )
+        return found
+
+    def as_dict(self):
+        """ intern cache counters for /debug/timings and /metrics """
+        with self._lock:
+            entries = sum(len(cache) for cache in self._caches)
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries * len(self._caches),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -1,6 +1,139 @@
-""" custom logger for stream handler and formating """
+""" custom logger: records are queued on the calling thread and written by a listener thread """
 
+import atexit
+import json
 import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+LOG_FORMATS = ("text", "json")
+TEXT_FORMAT = "%(created)17s;%(levelname)8s;%(message)s"
+# records waiting for the listener, more are counted and dropped
+QUEUE_RECORDS = 10000
+# rate limit keys (call site, template, error) remembered at once
+RATE_LIMIT_KEYS = 1000
+
+
+class TextFormatter(logging.Formatter):
+    """The created;level;message lines, with the count of suppressed repeats"""
+
+    def format(self, record):
+        line = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            line += f" (suppressed {suppressed} similar)"
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One compact json object per line"""
+
+    def format(self, record):
+        out = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+        }
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            out["suppressed"] = suppressed
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, separators=(",", ":"), default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets one record per call site, message template, error and interval through, counting the rest
+
+    Keyed on the unformatted message so a warning repeated with different
+    arguments, e.g. put_request's during a DB outage, is rate limited as
+    one. An exception among the arguments, or the one being logged, is
+    part of the key so different failures are each reported. The next
+    record let through carries the suppressed count.
+    """
+
+    def __init__(self, interval=10.0, level=logging.WARNING):
+        super().__init__()
+        self.interval = max(float(interval), 0)
+        self.level = level
+        self._lock = threading.Lock()
+        # key -> [monotonic the window ends, records suppressed in it, last one suppressed]
+        self._windows = {}
+
+    @staticmethod
+    def _key(record):
+        """ (level, call site, template, error) a record is rate limited on """
+        error = None
+        if record.exc_info and record.exc_info[1] is not None:
+            error = record.exc_info[1]
+        elif isinstance(record.args, tuple) and record.args and isinstance(record.args[-1], BaseException):
+            error = record.args[-1]
+        if error is not None:
+            error = f"{type(error).__name__}: {error}"
+        return (record.levelno, record.pathname, record.lineno, str(record.msg), error)
+
+    def filter(self, record):
+        if record.levelno < self.level or not self.interval:
+            return True
+        key = self._key(record)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window and now < window[0]:
+                window[1] += 1
+                window[2] = record
+                return False
+            if len(self._windows) >= RATE_LIMIT_KEYS:
+                # forget the quiet keys
+                self._windows = {
+                    seen: counts for seen, counts in self._windows.items() if counts[1]
+                }
+            self._windows[key] = [now + self.interval, 0, None]
+        if window and window[1]:
+            record.suppressed = window[1]
+        return True
+
+    def take_suppressed(self):
+        """ [(levelno, last message, count)] of the records suppressed since each key was last let through """
+        with self._lock:
+            suppressed = [
+                (key[0], window[2], window[1]) for key, window in self._windows.items() if window[1]
+            ]
+            for window in self._windows.values():
+                window[1], window[2] = 0, None
+        return [(levelno, record.getMessage(), count) for levelno, record, count in suppressed]
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queues records as they are, formatting is left to the listener thread"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the queue never leaves the process, so the record needs no
+        # merged message or pickling and the caller skips the formatting
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_STREAM = logging.StreamHandler()
+_STREAM.setFormatter(TextFormatter(TEXT_FORMAT))
+_RATE_LIMIT = RateLimitFilter()
+_QUEUE = DroppingQueueHandler(queue.Queue(QUEUE_RECORDS))
+_LISTENER = QueueListener(_QUEUE.queue, _STREAM)
+_RUNNING = threading.Event()
 
 
 def get_logger():
@@ -8,11 +141,38 @@ def get_logger():
     log = logging.getLogger("pystats_logger")
     if not log.handlers:
         log.setLevel(logging.DEBUG)
-        lsh = logging.StreamHandler()
-        log_formater = logging.Formatter(
-            "%(created)17s;%(levelname)8s;%(message)s",
-        )
-        lsh.setFormatter(log_formater)
-        log.addHandler(lsh)
+        log.addFilter(_RATE_LIMIT)
+        log.addHandler(_QUEUE)
         log.propagate = False
+        _LISTENER.start()
+        _RUNNING.set()
+        # registered before anything that logs at exit, so it runs after them
+        atexit.register(stop_logging)
     return log
+
+
+def configure_logging(level="DEBUG", fmt="text", dedup_interval=10.0):
+    """ apply the --log-level, --log-format and --log-dedup-interval options """
+    get_logger().setLevel(level)
+    _STREAM.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter(TEXT_FORMAT))
+    _RATE_LIMIT.interval = max(float(dedup_interval), 0)
+
+
+def stop_logging():
+    """ report the suppressed repeats, then write every queued record and stop the listener """
+    if not _RUNNING.is_set():
+        return
+    log = get_logger()
+    # the summaries share one template, let all of them through
+    _RATE_LIMIT.interval = 0
+    for levelno, msg, count in _RATE_LIMIT.take_suppressed():
+        log.log(levelno, "suppressed %s more like: %s", count, msg)
+    _LISTENER.stop()
+    _RUNNING.clear()
+    if _QUEUE.dropped:
+        _STREAM.handle(
+            log.makeRecord(
+                log.name, logging.ERROR, __file__, 0,
+                "log: dropped %s records while the queue was full", (_QUEUE.dropped,), None,
+            )
+        )
@@ -0,0 +1,411 @@
+""" in-memory request log: a bounded columnar ring with running per server totals """
+import os
+import platform
+import socket
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from .analytics import DIMENSIONS, skew
+from .backend import RequestsBackend
+from .logger import get_logger
+from .sampling import SKIPPED
+
+
+class MemoryRequests(RequestsBackend):
+    """Keeps the newest rows requests in preallocated arrays, nothing touches the disk
+
+    RequestID n lives in slot (n - 1) % rows of one array per column;
+    address, user agent and url are stored as codes into a shared string
+    table. Per server totals count every request ever stored, like the
+    server_totals table, while pages only see the rows still in the ring.
+    max_epochs holds the running max Epoch by RequestID, so time windows
+    are found by bisection even when imported rows come out of order.
+    Each process has its own log, prefork workers do not share it.
+    """
+
+    def __init__(self, rows=100000, sampler=None):
+        """Initialize the ring and register this server"""
+        self.log = get_logger()
+        self.rows = max(int(rows), 1)
+        self.sampler = sampler
+        self.epochs = array("d", [0.0]) * self.rows
+        self.max_epochs = array("d", [0.0]) * self.rows
+        self.srv_ids = array("I", [0]) * self.rows
+        self.addrs = array("I", [0]) * self.rows
+        self.agents = array("I", [0]) * self.rows
+        self.urls = array("I", [0]) * self.rows
+        # code 0 is None
+        self.strings = [None]
+        self.codes = {}
+        self.last_id = 0
+        self.max_epoch = 0.0
+        # most an Epoch ever went back behind the running max
+        self.epoch_slack = 0.0
+        # ServerID -> (Hostname, IP, Platform)
+        self.servers = {}
+        # (Hostname, IP) -> ServerID
+        self.server_ids = {}
+        # ServerID -> [RequestCount, LastRequestID, LastEpoch]
+        self.totals = {}
+        # ServerID -> RequestIDs of the server, the ones below the ring are trimmed on wrap
+        self.srv_rows = {}
+        self._lock = threading.Lock()
+        self.db_active = True
+        self.server_id = self._add_server(
+            str(os.uname()[1]),
+            str(socket.gethostbyname(socket.gethostname())),
+            str(platform.platform()),
+        )
+        self.ready = threading.Event()
+        self.ready.set()
+
+    def _add_server(self, host, ip, arc=None):
+        """ ServerID of a hostname / ip pair, registering it when new """
+        srv_id = self.server_ids.get((host, ip))
+        if srv_id is None:
+            srv_id = self.server_ids[(host, ip)] = len(self.servers) + 1
+            self.servers[srv_id] = (host, ip, arc)
+        return srv_id
+
+    def close(self):
+        """nothing to flush, the rows go away with the process"""
+
+    def _intern(self, value):
+        """ code of a string in the string table """
+        if value is None:
+            return 0
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.strings)
+            self.strings.append(value)
+        return code
+
+    def _compact(self):
+        """ drop the strings no row in the ring uses any more """
+        first = self._first_id()
+        slots = [(rid - 1) % self.rows for rid in range(first, self.last_id + 1)] if first else []
+        strings = [None]
+        codes = {}
+        remap = {0: 0}
+        for column in (self.addrs, self.agents, self.urls):
+            for slot in slots:
+                old = column[slot]
+                new = remap.get(old)
+                if new is None:
+                    new = remap[old] = codes[self.strings[old]] = len(strings)
+                    strings.append(self.strings[old])
+                column[slot] = new
+        self.strings = strings
+        self.codes = codes
+
+    def _first_id(self):
+        """ lowest RequestID still in the ring, 0 when empty """
+        if not self.last_id:
+            return 0
+        return max(self.last_id - self.rows + 1, 1)
+
+    def _trim(self):
+        """ forget the per server ids that left the ring """
+        first = self._first_id()
+        for ids in self.srv_rows.values():
+            stale = bisect_left(ids, first)
+            if stale:
+                del ids[:stale]
+
+    def _insert_rows(self, batch):
+        """ append a batch of request dicts to the ring """
+        with self._lock:
+            for req_data in batch:
+                self.last_id += 1
+                rid = self.last_id
+                slot = (rid - 1) % self.rows
+                epoch = req_data["epoch"]
+                srv_id = req_data["server_id"] or 0
+                self.epochs[slot] = epoch
+                if epoch < self.max_epoch:
+                    self.epoch_slack = max(self.epoch_slack, self.max_epoch - epoch)
+                else:
+                    self.max_epoch = epoch
+                self.max_epochs[slot] = self.max_epoch
+                self.srv_ids[slot] = srv_id
+                self.addrs[slot] = self._intern(req_data["remote_address"])
+                self.agents[slot] = self._intern(req_data["remote_user_agent"])
+                self.urls[slot] = self._intern(req_data["request_url"])
+                total = self.totals.get(srv_id)
+                if total is None:
+                    total = self.totals[srv_id] = [0, 0, 0.0]
+                    self.srv_rows[srv_id] = array("q")
+                total[0] += 1
+                total[1] = rid
+                total[2] = max(total[2], epoch)
+                self.srv_rows[srv_id].append(rid)
+                if slot == self.rows - 1:
+                    # the ring wrapped
+                    self._trim()
+                    # every row holds at most 3 strings
+                    if len(self.strings) > 3 * self.rows + 1024:
+                        self._compact()
+
+    def _row(self, rid):
+        """ (RequestID, Epoch, RemoteAddress, RemoteUserAgent, RequestURL, ServerID) of a live id """
+        slot = (rid - 1) % self.rows
+        strings = self.strings
+        return (
+            rid,
+            self.epochs[slot],
+            strings[self.addrs[slot]],
+            strings[self.agents[slot]],
+            strings[self.urls[slot]],
+            self.srv_ids[slot],
+        )
+
+    def import_requests(self, chunks, progress_interval=5.0):
+        """ bulk load chunks of request dicts (see src/importer.py), returns rows imported """
+        started = time.monotonic()
+        imported = 0
+        for batch in chunks:
+            with self._lock:
+                for req_data in batch:
+                    if req_data["hostname"] is not None:
+                        req_data["server_id"] = self._add_server(
+                            req_data["hostname"], req_data["ip"] or ""
+                        )
+                    elif req_data["server_id"] not in self.servers:
+                        req_data["server_id"] = self.server_id
+            self._insert_rows(batch)
+            imported += len(batch)
+        self.log.info("import: %s rows in %.1fs", imported, time.monotonic() - started)
+        return imported
+
+    def get_last_id(self):
+        """get the highest RequestID handed out"""
+        return self.last_id
+
+    def _skipped_total(self, srv_id=None):
+        """ requests the sampler did not store, only this server samples here """
+        if not self.sampler or (srv_id is not None and int(srv_id) != self.server_id):
+            return 0
+        return self.sampler.counts[(SKIPPED, "")]
+
+    def get_counters(self):
+        """ exact request counts of this server: {"route": {route: n}, "status": {code: n}} """
+        counters = {}
+        if self.sampler:
+            for (kind, name), count in self.sampler.snapshot().items():
+                if kind != SKIPPED:
+                    counters.setdefault(kind, {})[name] = count
+        return counters
+
+    def get_first_id(self):
+        """get the lowest RequestID still in the ring"""
+        return self._first_id()
+
+    def get_srv_total(self):
+        """get total number of servers"""
+        return len(self.servers)
+
+    def get_srvs(self, pn_start=1, pn_count=10):
+        """ get all the servers: list of tuple """
+        low, high = self._parse_min_max(pn_start, pn_count, self.get_srv_total())
+        return [
+            (srv_id, self.get_srv_req_tot(srv_id)) + tuple(str(val) for val in self.servers[srv_id])
+            for srv_id in range(low, high + 1)
+            if srv_id in self.servers
+        ]
+
+    def get_requests(self, pn_start=1, pn_count=10):
+        """ get all the requests: list of tuple """
+        low, high = self._parse_min_max(pn_start, pn_count, self.get_last_id())
+        with self._lock:
+            first = self._first_id()
+            if not first:
+                return []
+            return [self._row(rid) for rid in range(max(low, first), high + 1)]
+
+    def get_srv_req_tot(self, srv_id):
+        """ get number of requests for server """
+        total = self.totals.get(int(srv_id))
+        return (total[0] if total else 0) + self._skipped_total(srv_id)
+
+    def get_srv_req_totals(self):
+        """ get the request total of every server: list of (ServerID,Hostname,IP,total) """
+        return [
+            (srv_id, host, ip, self.get_srv_req_tot(srv_id))
+            for srv_id, (host, ip, _) in sorted(self.servers.items())
+        ]
+
+    def get_srv_socket(self, srv_id):
+        """ get the hostname and ip of a server """
+        server = self.servers.get(int(srv_id))
+        return (server[0], server[1]) if server else ("N/A", "N/A")
+
+    def _srv_ids(self, srv_id):
+        """ (RequestIDs of a server, position of the first one still in the ring) """
+        ids = self.srv_rows.get(int(srv_id))
+        if not ids:
+            return array("q"), 0
+        return ids, bisect_left(ids, self._first_id())
+
+    def get_srv_requests(self, srv_id, pn_page=1, pn_count=10):
+        """ get all the requests: list of tuple """
+        pn_count = self._page_count(pn_count)
+        with self._lock:
+            ids, start = self._srv_ids(srv_id)
+            start += (max(int(pn_page), 1) - 1) * pn_count
+            return [self._row(rid) for rid in ids[start:start + pn_count]]
+
+    def get_srv_last_rec(self, srv_id):
+        """ get the last page of records """
+        total = self.totals.get(int(srv_id))
+        return total[1] if total else 0
+
+    def _fetch(self, srv_id, desc, cursor_id, limit):
+        """ up to limit rows after (or before when desc) a RequestID, optionally for one server """
+        cursor_id = int(cursor_id)
+        with self._lock:
+            first = self._first_id()
+            if not first:
+                return []
+            if srv_id is None:
+                if desc:
+                    high = min(cursor_id - 1, self.last_id)
+                    ids = range(high, max(high - limit, first - 1), -1)
+                else:
+                    low = max(cursor_id + 1, first)
+                    ids = range(low, min(low + limit - 1, self.last_id) + 1)
+            else:
+                srv_ids, start = self._srv_ids(srv_id)
+                if desc:
+                    end = max(bisect_left(srv_ids, cursor_id), start)
+                    ids = reversed(srv_ids[max(end - limit, start):end])
+                else:
+                    pos = max(bisect_right(srv_ids, cursor_id), start)
+                    ids = srv_ids[pos:pos + limit]
+            return [self._row(rid) for rid in ids]
+
+    def iter_requests(
+        self, srv_id=None, since=None, until=None, min_id=None, max_id=None, chunk=1000
+    ):
+        """ yield lists of up to chunk request rows joined with their server, in RequestID order
+
+        The lock is only held for one chunk at a time, rows that leave
+        the ring while the export runs are skipped.
+        """
+        chunk = max(int(chunk), 1)
+        last_id = int(min_id) - 1 if min_id is not None else 0
+        while True:
+            rows = []
+            with self._lock:
+                high = self.last_id if max_id is None else min(int(max_id), self.last_id)
+                rid = max(last_id + 1, self._first_id() or 1)
+                while rid <= high and len(rows) < chunk:
+                    row = self._row(rid)
+                    rid += 1
+                    if (
+                        (srv_id is None or row[5] == int(srv_id))
+                        and (since is None or row[1] >= float(since))
+                        and (until is None or row[1] < float(until))
+                    ):
+                        server = self.servers.get(row[5], (None, None, None))
+                        rows.append(row + (server[0], server[1]))
+                last_id = rid - 1
+            if rows:
+                yield rows
+            if rid > high:
+                return
+
+    def _window(self, low, high):
+        """ (first, last) RequestIDs that can hold an Epoch in [low, high), caller holds the lock """
+        first = self._first_id()
+        if not first:
+            return 1, 0
+        ids = range(first, self.last_id + 1)
+
+        def running_max(rid):
+            return self.max_epochs[(rid - 1) % self.rows]
+
+        # a row's Epoch is at most the running max and at least the running max - slack
+        start = bisect_left(ids, low, key=running_max)
+        end = bisect_left(ids, high + self.epoch_slack, key=running_max)
+        return first + start, first + end - 1
+
+    def _copy(self, column, first, last):
+        """ copy of a column for RequestIDs first..last, caller holds the lock """
+        if last < first:
+            return column[:0]
+        start, end = (first - 1) % self.rows, (last - 1) % self.rows
+        if start <= end:
+            return column[start:end + 1]
+        # the window wraps around the end of the ring
+        return column[start:] + column[:end + 1]
+
+    def get_analytics(
+        self, group_by="server", since=None, until=None, srv_id=None, bucket=60, limit=100
+    ):
+        """request counts over a time window grouped by server, url, address, user_agent or time
+
+        Same result as the sqlite rollups but counted from the rows still
+        in the ring. Only the columns of the window are copied under the
+        lock, the counting runs outside it so put_request is not held up.
+        """
+        until = time.time() if until is None else float(until)
+        since = until - 3600 if since is None else float(since)
+        first, last = int(since // 60), int(until // 60)
+        low, high = first * 60, (last + 1) * 60
+        limit = min(max(int(limit), 1), 10000)
+        bucket = max(int(bucket) // 60, 1) * 60
+        if bucket >= 3600:
+            bucket -= bucket % 3600
+        column = {0: self.urls, 1: self.addrs, 2: self.agents}.get(DIMENSIONS.get(group_by))
+        with self._lock:
+            first_id, last_id = self._window(low, high)
+            epochs = self._copy(self.epochs, first_id, last_id)
+            srv_ids = self._copy(self.srv_ids, first_id, last_id)
+            values = self._copy(column, first_id, last_id) if column is not None else None
+            # compaction swaps in a new list, this one stays valid for the copied codes
+            strings = self.strings
+        per_server = Counter()
+        groups = Counter()
+        for pos, epoch in enumerate(epochs):
+            if not low <= epoch < high:
+                continue
+            row_srv = srv_ids[pos]
+            per_server[row_srv] += 1
+            if srv_id is not None and row_srv != int(srv_id):
+                continue
+            if group_by == "time":
+                groups[int(epoch // bucket)] += 1
+            elif values is not None:
+                groups[values[pos]] += 1
+        if group_by == "server":
+            result = [
+                {
+                    "server_id": row_srv,
+                    "hostname": self.servers.get(row_srv, (None,))[0],
+                    "ip": self.servers.get(row_srv, (None, None))[1],
+                    "count": count,
+                }
+                for row_srv, count in sorted(per_server.items())
+                if srv_id is None or row_srv == int(srv_id)
+            ]
+        elif group_by == "time":
+            result = [{"t": key * bucket, "count": count} for key, count in sorted(groups.items())]
+        else:
+            result = [
+                {group_by: strings[code] or "", "count": count}
+                for code, count in groups.most_common(limit)
+            ]
+        return {
+            "group_by": group_by,
+            "since": low,
+            "until": high,
+            "bucket": bucket if group_by == "time" else None,
+            "total": sum(
+                count for row_srv, count in per_server.items()
+                if srv_id is None or row_srv == int(srv_id)
+            ),
+            "groups": result,
+            "skew": skew(list(per_server.values())),
+        }
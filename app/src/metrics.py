@@ -0,0 +1,269 @@
+""" prometheus text exposition for the /metrics endpoint """
+import threading
+from .logger import get_logger
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    """escape a label value for the text exposition format"""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_name(name):
+    """sanitize a label name to [a-zA-Z_][a-zA-Z0-9_]*"""
+    name = "".join(c if c.isalnum() or c == "_" else "_" for c in str(name))
+    if not name or name[0].isdigit():
+        name = "_" + name
+    return name
+
+
+def parse_labels(labels):
+    """turn the --labels key=value list into a dict of constant labels"""
+    const = {}
+    for label in labels:
+        if len(label.split("=")) == 2:
+            key, val = label.split("=")
+            const[_label_name(key)] = val
+    return const
+
+
+class Metrics:
+    """Renders Stats and Requests data as prometheus metrics, once per cpu sample"""
+
+    def __init__(self, stats, reqs, labels=[], page_cache=None, stream=None):
+        self.log = get_logger()
+        self.stats = stats
+        self.reqs = reqs
+        self.page_cache = page_cache
+        self.stream = stream
+        self.const_labels = parse_labels(labels)
+        self._lock = threading.Lock()
+        self._generation = None
+        self._payload = b""
+
+    def get_payload(self) -> bytes:
+        """return the cached exposition payload, rendering it on a new sample generation"""
+        generation = self.stats.get_generation()
+        if generation == self._generation:
+            return self._payload
+        with self._lock:
+            # another thread may have rendered this generation while we waited
+            if generation != self._generation:
+                self._payload = self._render().encode("utf-8")
+                self._generation = generation
+        return self._payload
+
+    def _labels(self, extra=None):
+        """format the constant labels plus any per series labels"""
+        labels = dict(self.const_labels)
+        if extra:
+            labels.update(extra)
+        if not labels:
+            return ""
+        pairs = ",".join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+        return "{" + pairs + "}"
+
+    def _metric(self, lines, name, mtype, help_txt, samples):
+        """append one metric family, samples is a list of (labels, value)"""
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            # e.g. the cgroup families outside a cgroup v2
+            return
+        lines.append(f"# HELP {name} {help_txt}")
+        lines.append(f"# TYPE {name} {mtype}")
+        for labels, value in samples:
+            lines.append(f"{name}{self._labels(labels)} {value}")
+
+    def _render(self) -> str:
+        """build the text exposition payload"""
+        stats = self.stats.get_stats()
+        cpu = stats["cpu"]
+        uptime = stats["uptime"]
+        mem, swap = self.stats.get_memory()
+        lines = []
+        self._metric(lines, "pystats_info", "gauge", "pystats host information.", [(
+            {
+                "hostname": stats["info"]["hostname"],
+                "platform": stats["info"]["platform"],
+                "python_version": stats["info"]["python_version"],
+            },
+            1,
+        )])
+        self._metric(
+            lines, "pystats_process_uptime_seconds", "gauge",
+            "Seconds since the pystats process started.",
+            [(None, uptime["process_seconds"])],
+        )
+        self._metric(
+            lines, "pystats_system_uptime_seconds", "gauge",
+            "Seconds since the system booted.",
+            [(None, uptime["system_seconds"])],
+        )
+        self._metric(
+            lines, "pystats_load_average", "gauge",
+            "System load average.",
+            [
+                ({"period": "1m"}, cpu["load_1m"]),
+                ({"period": "5m"}, cpu["load_5m"]),
+                ({"period": "15m"}, cpu["load_15m"]),
+            ],
+        )
+        self._metric(
+            lines, "pystats_cpu_count", "gauge",
+            "Number of cpus.",
+            [
+                ({"type": "logical"}, cpu["cpu_count_logical"]),
+                ({"type": "physical"}, cpu["cpu_count"]),
+            ],
+        )
+        self._metric(
+            lines, "pystats_cpu_percent", "gauge",
+            "System wide cpu utilization percent over the last sample interval.",
+            [(None, cpu["cpu_percent"])],
+        )
+        self._metric(
+            lines, "pystats_cpu_percent_percpu", "gauge",
+            "Per cpu utilization percent over the last sample interval.",
+            [
+                ({"cpu": str(idx)}, val)
+                for idx, val in enumerate(cpu["cpu_percent_percpu"] or [])
+            ],
+        )
+        self._metric(
+            lines, "pystats_cpu_sample_age_seconds", "gauge",
+            "Age of the cpu sample used for this payload.",
+            [(None, cpu["cpu_sample_age_seconds"])],
+        )
+        self._metric(
+            lines, "pystats_memory_bytes", "gauge",
+            "Virtual memory in bytes.",
+            [
+                ({"type": "total"}, mem.total),
+                ({"type": "available"}, mem.available),
+                ({"type": "used"}, mem.used),
+                ({"type": "free"}, mem.free),
+            ],
+        )
+        self._metric(
+            lines, "pystats_swap_bytes", "gauge",
+            "Swap memory in bytes.",
+            [
+                ({"type": "total"}, swap.total),
+                ({"type": "used"}, swap.used),
+                ({"type": "free"}, swap.free),
+            ],
+        )
+        cgroup = self.stats.get_cgroup()
+        self._metric(
+            lines, "pystats_cgroup_cpu_limit", "gauge",
+            "cgroup v2 cpu.max quota in cpus.",
+            [(None, cgroup.get("cpu_limit"))],
+        )
+        self._metric(
+            lines, "pystats_cgroup_cpu_throttled_periods_total", "counter",
+            "cgroup v2 enforcement periods in which the cgroup was throttled.",
+            [(None, cgroup.get("cpu_nr_throttled"))],
+        )
+        self._metric(
+            lines, "pystats_cgroup_cpu_throttled_seconds_total", "counter",
+            "cgroup v2 time the cgroup spent throttled.",
+            [(None, cgroup.get("cpu_throttled_seconds"))],
+        )
+        self._metric(
+            lines, "pystats_cgroup_memory_bytes", "gauge",
+            "cgroup v2 memory usage and limit in bytes.",
+            [
+                ({"type": "current"}, cgroup.get("memory_current")),
+                ({"type": "max"}, cgroup.get("memory_max")),
+            ],
+        )
+        self._metric(
+            lines, "pystats_cgroup_memory_pressure", "gauge",
+            "cgroup v2 memory pressure stall percent.",
+            [
+                ({"kind": kind, "window": window}, cgroup.get(f"memory_pressure_{kind}_{window}"))
+                for kind in ("some", "full")
+                for window in ("avg10", "avg60", "avg300")
+            ],
+        )
+        self._metric(
+            lines, "pystats_requests_total", "counter",
+            "Requests logged by all pystats servers.",
+            [(None, self.reqs.get_req_total())],
+        )
+        self._metric(
+            lines, "pystats_servers", "gauge",
+            "Number of registered pystats servers.",
+            [(None, self.reqs.get_srv_total())],
+        )
+        self._metric(
+            lines, "pystats_server_requests_total", "counter",
+            "Requests logged per pystats server.",
+            [
+                ({"server_id": str(srv_id), "hostname": host, "ip": ip}, total)
+                for srv_id, host, ip, total in self.reqs.get_srv_req_totals()
+            ],
+        )
+        sampling = self.reqs.get_sampling()
+        if sampling:
+            self._metric(
+                lines, "pystats_requests_stored_total", "counter",
+                "Requests with a row in the request log, the rest were skipped by sampling.",
+                [(None, sampling["stored"])],
+            )
+        counters = self.reqs.get_counters() if sampling else {}
+        self._metric(
+            lines, "pystats_route_requests_total", "counter",
+            "Requests handled by this pystats server per route, counted before sampling.",
+            [({"route": route}, count) for route, count in sorted(counters.get("route", {}).items())],
+        )
+        self._metric(
+            lines, "pystats_responses_total", "counter",
+            "Responses sent by this pystats server per status code, counted before sampling.",
+            [({"status": status}, count) for status, count in sorted(counters.get("status", {}).items())],
+        )
+        if self.page_cache:
+            cache = self.page_cache.as_dict()
+            self._metric(
+                lines, "pystats_page_cache_lookups_total", "counter",
+                "Page cache lookups of rendered request tables by result.",
+                [({"result": "hit"}, cache["hits"]), ({"result": "miss"}, cache["misses"])],
+            )
+            self._metric(
+                lines, "pystats_page_cache_evictions_total", "counter",
+                "Rendered request tables evicted from the page cache.",
+                [(None, cache["evictions"])],
+            )
+            self._metric(
+                lines, "pystats_page_cache_bytes", "gauge",
+                "Size of the rendered request tables held in the page cache.",
+                [(None, cache["bytes"])],
+            )
+        if self.stream:
+            stream = self.stream.as_dict()
+            self._metric(
+                lines, "pystats_stream_clients", "gauge",
+                "Subscribers connected to /stream.",
+                [(None, stream["clients"])],
+            )
+            self._metric(
+                lines, "pystats_stream_disconnects_total", "counter",
+                "/stream subscribers turned away when full or dropped for falling behind.",
+                [({"reason": "rejected"}, stream["rejected"]), ({"reason": "dropped"}, stream["dropped"])],
+            )
+        if self.reqs.interner:
+            intern = self.reqs.interner.as_dict()
+            self._metric(
+                lines, "pystats_intern_cache_lookups_total", "counter",
+                "Intern cache lookups of request column values by result.",
+                [({"result": "hit"}, intern["hits"]), ({"result": "miss"}, intern["misses"])],
+            )
+            self._metric(
+                lines, "pystats_intern_cache_entries", "gauge",
+                "Dictionary ids held in the intern cache.",
+                [(None, intern["entries"])],
+            )
+        lines.append("")
+        return "\n".join(lines)
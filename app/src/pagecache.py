@@ -0,0 +1,65 @@
+""" size bounded LRU of rendered pages that can no longer change """
+import threading
+from collections import OrderedDict
+
+
+class PageCache:
+    """LRU of rendered request tables keyed by route and query arguments
+
+    RequestIDs are handed out in commit order and never reused, so a
+    full page whose rows all lie below the newest id keeps the same rows
+    until retention deletes from the front of the table. Every entry
+    remembers the lowest RequestID present when it was rendered and is
+    dropped on lookup once that low-water mark has moved.
+    """
+
+    def __init__(self, max_bytes=8388608):
+        self.max_bytes = max(int(max_bytes), 0)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # key -> (low water, page, size)
+        self._pages = OrderedDict()
+
+    def get(self, key, low_water):
+        """ the cached page of key or None, dropping it when rows were deleted since """
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is not None:
+                if entry[0] == low_water:
+                    self._pages.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._pages[key]
+                self.size -= entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, key, low_water, page, size):
+        """ store a rendered page of size bytes, evicting the least recently used over max_bytes """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self._pages[key] = (low_water, page, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self._pages.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def as_dict(self):
+        """ counters for /debug/timings and /metrics """
+        with self._lock:
+            return {
+                "entries": len(self._pages),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,379 @@
+""" time or row count partitioned request log with ATTACH based reads """
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from .analytics import rollup_rows
+from .interning import normalize_requests, request_rows_sql, requests_table_sql
+from .logger import get_logger
+
+
+PARTITION_MODES = ("none", "day", "rows")
+MAIN_PARTITION = "main"
+REQ_COLUMNS = "RequestID,Epoch,AddressID,UserAgentID,URLID,ServerID"
+
+
+class Partitions:
+    """Routes request rows to partition files next to the catalog DB and reads them back via ATTACH
+
+    The catalog (--db-file) keeps servers, server_totals and a partitions
+    table with the id and epoch range of every partition. RequestIDs stay
+    global: they are reserved from the catalog's sqlite_sequence so the
+    legacy requests table in the catalog is just the first partition.
+    Partition rows hold ids of the catalog's dictionary tables (see
+    src/interning.py), reads join them from main. Dropping a partition
+    bumps the catalog generation, every connection detaches dropped
+    partitions the next time it looks at the catalog.
+    """
+
+    def __init__(self, db, db_path, mode="day", rows=1000000, max_attached=8):
+        """Initialize the partition router"""
+        self.log = get_logger()
+        self.db = db
+        self.db_path = db_path
+        self.mode = mode
+        self.rows = max(int(rows), 1)
+        # sqlite allows 10 attached DBs by default
+        self.max_attached = min(max(int(max_attached), 1), 9)
+        self._local = threading.local()
+        self._catalog_init()
+        self._normalize()
+
+    def _catalog_init(self):
+        """ create the partitions catalog and register the legacy requests table """
+        con = self.db.connection()
+        with closing(con.cursor()) as cur:
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute(
+                    """CREATE TABLE IF NOT EXISTS partitions(
+                        Name TEXT PRIMARY KEY,
+                        MinID INTEGER NOT NULL,
+                        MaxID INTEGER NOT NULL,
+                        MinEpoch REAL NOT NULL,
+                        MaxEpoch REAL NOT NULL,
+                        RowCount INTEGER NOT NULL
+                    )"""
+                )
+                cur.execute(
+                    """
+                    INSERT INTO partitions (Name, MinID, MaxID, MinEpoch, MaxEpoch, RowCount)
+                    SELECT * FROM (
+                        SELECT ?, MIN(RequestID), MAX(RequestID), MIN(Epoch), MAX(Epoch), COUNT(*) AS n
+                        FROM requests
+                    )
+                    WHERE n > 0
+                    ON CONFLICT(Name) DO UPDATE SET
+                        MinID = excluded.MinID,
+                        MaxID = excluded.MaxID,
+                        MinEpoch = excluded.MinEpoch,
+                        MaxEpoch = excluded.MaxEpoch,
+                        RowCount = excluded.RowCount
+                    """,
+                    (MAIN_PARTITION,),
+                )
+                cur.execute(
+                    """CREATE TABLE IF NOT EXISTS partitions_state(
+                        ID INTEGER PRIMARY KEY CHECK (ID = 0),
+                        Generation INTEGER NOT NULL
+                    )"""
+                )
+                cur.execute("INSERT OR IGNORE INTO partitions_state (ID, Generation) VALUES (0, 0)")
+                cur.execute(
+                    """
+                    INSERT INTO sqlite_sequence (name, seq)
+                    SELECT 'requests', COALESCE((SELECT MAX(RequestID) FROM requests), 0)
+                    WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'requests')
+                    """
+                )
+                cur.execute("COMMIT")
+            except sqlite3.Error:
+                cur.execute("ROLLBACK")
+                raise
+
+    def _normalize(self):
+        """ move partition files written before the dictionary tables over to ids, once """
+        con = self.db.connection()
+        for part in self.get_partitions(con):
+            if part[0] != MAIN_PARTITION and os.path.exists(self.partition_path(part[0])):
+                # attaching normalizes
+                self.table(con, part[0])
+
+    def partition_path(self, name):
+        """ file path of a partition, e.g. requests.d20261018.db """
+        stem, ext = os.path.splitext(self.db_path)
+        return f"{stem}.{name}{ext or '.db'}"
+
+    def _partition_name(self, request_id, epoch):
+        """ partition a row belongs to """
+        if self.mode == "rows":
+            return f"r{(request_id - 1) // self.rows:08d}"
+        return "d" + time.strftime("%Y%m%d", time.gmtime(epoch))
+
+    def _entry(self, con):
+        """ (connection, LRU of attached partition names, [catalog generation seen]) """
+        cons = getattr(self._local, "cons", None)
+        if cons is None:
+            cons = self._local.cons = {}
+        entry = cons.get(id(con))
+        if entry is None or entry[0] is not con:
+            entry = cons[id(con)] = (con, OrderedDict(), [None])
+        return entry
+
+    def _attached(self, con):
+        """ per connection LRU of attached partition names """
+        return self._entry(con)[1]
+
+    def _generation(self, con):
+        """ catalog generation, bumped by every partition drop """
+        return con.execute("SELECT Generation FROM partitions_state WHERE ID = 0").fetchone()[0]
+
+    def _sync(self, con):
+        """ detach the partitions dropped since this connection last looked, outside a transaction """
+        generation = self._generation(con)
+        _, attached, seen = self._entry(con)
+        if seen[0] == generation:
+            return
+        if attached:
+            names = {row[0] for row in con.execute("SELECT Name FROM partitions")}
+            for name in [name for name in attached if name not in names]:
+                del attached[name]
+                con.execute(f"DETACH DATABASE p_{name}")
+        seen[0] = generation
+
+    def release(self, con):
+        """ forget the attachments of a short lived connection before it is closed """
+        getattr(self._local, "cons", {}).pop(id(con), None)
+
+    def table(self, con, name):
+        """ schema qualified requests table of a partition, attaching it when needed """
+        if name == MAIN_PARTITION:
+            return "main.requests"
+        schema = f"p_{name}"
+        attached = self._attached(con)
+        if name in attached:
+            attached.move_to_end(name)
+            return f"{schema}.requests"
+        while len(attached) >= self.max_attached:
+            old, _ = attached.popitem(last=False)
+            con.execute(f"DETACH DATABASE p_{old}")
+        con.execute(f"ATTACH DATABASE ? AS {schema}", (self.partition_path(name),))
+        attached[name] = True
+        con.execute(f"PRAGMA {schema}.journal_mode = WAL")
+        with con:
+            con.execute(requests_table_sql(schema))
+            con.execute(
+                f"""CREATE INDEX IF NOT EXISTS {schema}.requests_server_request
+                ON requests(ServerID, RequestID)"""
+            )
+        normalize_requests(con, schema)
+        return f"{schema}.requests"
+
+    def detach(self, con, name):
+        """ detach a partition from this thread's connection if attached """
+        attached = self._attached(con)
+        if attached.pop(name, None):
+            con.execute(f"DETACH DATABASE p_{name}")
+
+    def forget(self, con, name):
+        """ remove a partition from the catalog, the other connections detach it on next use """
+        with con:
+            con.execute("DELETE FROM partitions WHERE Name = ?", (name,))
+            con.execute("UPDATE partitions_state SET Generation = Generation + 1 WHERE ID = 0")
+        self.detach(con, name)
+
+    def get_partitions(self, con):
+        """ all partitions: list of (Name, MinID, MaxID, MinEpoch, MaxEpoch, RowCount) """
+        self._sync(con)
+        return con.execute(
+            """
+            SELECT Name, MinID, MaxID, MinEpoch, MaxEpoch, RowCount
+            FROM partitions
+            ORDER BY MinID ASC
+            """
+        ).fetchall()
+
+    def last_id(self):
+        """ highest RequestID handed out """
+        rec = self.db.connection().execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'requests'"
+        ).fetchone()
+        return int(rec[0]) if rec else 0
+
+    def insert(self, batch, ids):
+        """write a batch of request dicts, the catalog and the partition rows in one transaction
+
+        ids are the dictionary ids of every request dict, see Interner.ids.
+        Partitions can only be attached outside a transaction, so the batch
+        is written in slices touching at most max_attached partitions,
+        each attached up front for the ids the slice is expected to get.
+        """
+        con = self.db.connection()
+        pending = list(zip(batch, ids))
+        while pending:
+            self._sync(con)
+            count, names = self._slice(pending, self.last_id())
+            for name in names:
+                self.table(con, name)
+            # another process took the ids expected or dropped a partition: sync and attach again
+            if self._insert_slice(con, pending[:count]):
+                del pending[:count]
+
+    def _slice(self, pending, last):
+        """ (rows, partition names) of the leading pending rows within max_attached partitions """
+        names = []
+        for offset, (req_data, _) in enumerate(pending):
+            name = self._partition_name(last + 1 + offset, req_data["epoch"])
+            if name not in names:
+                if len(names) >= self.max_attached:
+                    return offset, names
+                names.append(name)
+        return len(pending), names
+
+    def _insert_slice(self, con, pending):
+        """reserve ids, update the catalog and write the rows, False when a partition is not attached
+
+        A failure anywhere rolls back the catalog with the rows. Attached
+        WAL files commit one after the other, so only a crash in between
+        can leave them apart.
+        """
+        groups = OrderedDict()
+        text_rows = []
+        with closing(con.cursor()) as cur:
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute(
+                    "UPDATE sqlite_sequence SET seq = seq + ? WHERE name = 'requests'",
+                    (len(pending),),
+                )
+                last = cur.execute(
+                    "SELECT seq FROM sqlite_sequence WHERE name = 'requests'"
+                ).fetchone()[0]
+                for offset, (req_data, row_ids) in enumerate(pending):
+                    row = (
+                        last - len(pending) + 1 + offset,
+                        req_data["epoch"],
+                        *row_ids,
+                        req_data["server_id"],
+                    )
+                    groups.setdefault(self._partition_name(row[0], row[1]), []).append(row)
+                    text_rows.append(
+                        row[:2]
+                        + (
+                            req_data["remote_address"],
+                            req_data["remote_user_agent"],
+                            req_data["request_url"],
+                        )
+                        + row[5:]
+                    )
+                _, attached, seen = self._entry(con)
+                # a drop since the sync may have deleted the file behind an attached name
+                if seen[0] != self._generation(con) or any(name not in attached for name in groups):
+                    cur.execute("ROLLBACK")
+                    return False
+                for name, rows in groups.items():
+                    cur.execute(
+                        """
+                        INSERT INTO partitions (Name, MinID, MaxID, MinEpoch, MaxEpoch, RowCount)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(Name) DO UPDATE SET
+                            MinID = MIN(MinID, excluded.MinID),
+                            MaxID = MAX(MaxID, excluded.MaxID),
+                            MinEpoch = MIN(MinEpoch, excluded.MinEpoch),
+                            MaxEpoch = MAX(MaxEpoch, excluded.MaxEpoch),
+                            RowCount = RowCount + excluded.RowCount
+                        """,
+                        (
+                            name,
+                            rows[0][0],
+                            rows[-1][0],
+                            min(row[1] for row in rows),
+                            max(row[1] for row in rows),
+                            len(rows),
+                        ),
+                    )
+                totals = {}
+                for rows in groups.values():
+                    for row in rows:
+                        count, last_id, last_epoch = totals.get(row[5], (0, 0, 0))
+                        totals[row[5]] = (count + 1, max(last_id, row[0]), max(last_epoch, row[1]))
+                cur.executemany(
+                    """
+                    INSERT INTO server_totals (ServerID, RequestCount, LastRequestID, LastEpoch)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(ServerID) DO UPDATE SET
+                        RequestCount = RequestCount + excluded.RequestCount,
+                        LastRequestID = MAX(LastRequestID, excluded.LastRequestID),
+                        LastEpoch = MAX(LastEpoch, excluded.LastEpoch)
+                    """,
+                    [(srv_id,) + vals for srv_id, vals in totals.items()],
+                )
+                rollup_rows(cur, text_rows)
+                for name, rows in groups.items():
+                    cur.executemany(
+                        f"INSERT INTO p_{name}.requests ({REQ_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                        rows,
+                    )
+                cur.execute("COMMIT")
+            except Exception:
+                # not only sqlite errors, a bad request dict must not leave the transaction open
+                cur.execute("ROLLBACK")
+                raise
+        return True
+
+    def _query(self, con, table, srv_id, desc, cursor_id, limit, offset=0):
+        """ rows of one partition table after or before a cursor """
+        srv_where = "ServerID = ? AND" if srv_id is not None else ""
+        srv_args = (int(srv_id),) if srv_id is not None else ()
+        op, order = ("<", "DESC") if desc else (">", "ASC")
+        return con.execute(
+            f"""
+            SELECT {request_rows_sql(table)}
+            WHERE {srv_where} RequestID {op} ?
+            ORDER BY RequestID {order}
+            LIMIT ?,?
+            """,
+            srv_args + (int(cursor_id), int(offset), int(limit)),
+        ).fetchall()
+
+    def fetch(self, srv_id, desc, cursor_id, limit):
+        """ up to limit rows after (or before when desc) cursor_id, merged across partitions """
+        con = self.db.connection()
+        parts = self.get_partitions(con)
+        if desc:
+            parts = [part for part in reversed(parts) if part[1] < cursor_id]
+        else:
+            parts = [part for part in parts if part[2] > cursor_id]
+        merged = []
+        for part in parts:
+            if len(merged) >= limit:
+                # partitions may overlap a little, stop once none can beat the page
+                kth = merged[limit - 1][0]
+                if (desc and part[2] < kth) or (not desc and part[1] > kth):
+                    break
+            merged.extend(
+                self._query(con, self.table(con, part[0]), srv_id, desc, cursor_id, limit)
+            )
+            merged.sort(key=lambda row: row[0], reverse=desc)
+            del merged[limit:]
+        return merged
+
+    def fetch_offset(self, srv_id, offset, limit):
+        """ up to limit rows of a server skipping offset rows, for the old pnpage links """
+        con = self.db.connection()
+        rows = []
+        for part in self.get_partitions(con):
+            table = self.table(con, part[0])
+            count = con.execute(
+                f"SELECT COUNT(*) FROM {table} WHERE ServerID = ?", (int(srv_id),)
+            ).fetchone()[0]
+            if offset >= count:
+                offset -= count
+                continue
+            rows.extend(self._query(con, table, srv_id, False, 0, limit - len(rows), offset))
+            offset = 0
+            if len(rows) >= limit:
+                break
+        return rows
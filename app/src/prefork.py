@@ -0,0 +1,158 @@
+""" pre-forking supervisor sharing the listening port between worker processes """
+import math
+import os
+import signal
+import socket
+import subprocess
+import time
+from .logger import get_logger
+
+
+def cpu_limit():
+    """ cpus this process may use: the cgroup v2 cpu.max quota or the affinity mask """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max", encoding="utf-8") as fh:
+            quota, period = fh.read().split()
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(cpus, 1)
+
+
+def listen_socket(host, port, backlog, reuse_port=False):
+    """ bound and listening tcp socket """
+    family, sock_type, proto, _, addr = socket.getaddrinfo(
+        host, int(port), socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE
+    )[0]
+    sock = socket.socket(family, sock_type, proto)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(addr)
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class Supervisor:
+    """Runs N copies of the server as child processes and keeps them alive
+
+    Every worker is a fresh interpreter started with argv plus
+    --worker-fd, so it opens its own DB connections and samplers after
+    the split instead of inheriting threads through fork. Workers either
+    share one inherited listening socket or, with reuse_port, each get
+    their own SO_REUSEPORT socket so the kernel balances accepts.
+    """
+
+    def __init__(
+        self,
+        argv,
+        workers,
+        host,
+        port,
+        backlog=1024,
+        reuse_port=False,
+        shutdown_timeout=10.0,
+    ):
+        """Initialize the supervisor and bind the shared socket"""
+        self.log = get_logger()
+        self.argv = list(argv)
+        self.workers = max(int(workers), 1)
+        self.host = host
+        self.port = int(port)
+        self.backlog = int(backlog)
+        self.reuse_port = reuse_port
+        self.shutdown_timeout = max(float(shutdown_timeout), 0)
+        self.sock = None
+        if not reuse_port:
+            self.sock = listen_socket(host, port, backlog)
+        # slot -> (Popen, started monotonic)
+        self.procs = {}
+        # slot -> respawn at monotonic
+        self.pending = {}
+        # slot -> seconds waited before the last respawn
+        self.backoff = {}
+        self._stopping = False
+
+    def _spawn(self, slot):
+        """ start the worker of a slot """
+        sock = self.sock
+        if self.reuse_port:
+            sock = listen_socket(self.host, self.port, self.backlog, reuse_port=True)
+        fd = sock.fileno()
+        try:
+            proc = subprocess.Popen(self.argv + ["--worker-fd", str(fd)], pass_fds=(fd,))
+        finally:
+            if self.reuse_port:
+                # the worker holds its own copy
+                sock.close()
+        self.procs[slot] = (proc, time.monotonic())
+        self.log.info("prefork: worker %s started with pid %s", slot, proc.pid)
+
+    def _on_signal(self, signum, frame):
+        """ SIGTERM / SIGINT: stop the workers """
+        self._stopping = True
+
+    def _reap(self):
+        """ respawn workers that exited, backing off while a slot crash loops """
+        now = time.monotonic()
+        for slot, (proc, started) in list(self.procs.items()):
+            if proc.poll() is None:
+                continue
+            del self.procs[slot]
+            backoff = 0
+            if now - started < 5:
+                backoff = min(self.backoff.get(slot, 0) * 2 or 0.5, 30)
+            self.backoff[slot] = backoff
+            self.pending[slot] = now + backoff
+            self.log.warning(
+                "prefork: worker %s pid %s exited with %s, respawning in %.1fs",
+                slot, proc.pid, proc.returncode, backoff,
+            )
+        for slot, respawn_at in list(self.pending.items()):
+            if now >= respawn_at:
+                del self.pending[slot]
+                self._spawn(slot)
+
+    def run(self):
+        """ start the workers and supervise them until SIGTERM or SIGINT """
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        self.log.info(
+            "prefork: %s workers on %s:%s%s",
+            self.workers, self.host, self.port, " with SO_REUSEPORT" if self.reuse_port else "",
+        )
+        for slot in range(self.workers):
+            self._spawn(slot)
+        while not self._stopping:
+            time.sleep(0.5)
+            if not self._stopping:
+                self._reap()
+        self.shutdown()
+
+    def shutdown(self):
+        """ SIGTERM every worker, SIGKILL the ones still running after shutdown_timeout """
+        for proc, _ in self.procs.values():
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout
+        for slot, (proc, _) in self.procs.items():
+            try:
+                proc.wait(timeout=max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                self.log.warning("prefork: worker %s pid %s did not stop, killing it", slot, proc.pid)
+                proc.kill()
+                proc.wait()
+        self.procs = {}
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        self.log.info("prefork: all workers stopped")
@@ -3,27 +3,227 @@ import sqlite3
 import os
 import socket
 import platform
+import threading
 import time
 from contextlib import closing
+from .analytics import Analytics
+from .backend import RequestsBackend
+from .db import ConnectionManager
+from .interning import (
+    Interner,
+    dictionaries_init,
+    normalize_requests,
+    request_rows_sql,
+    requests_table_sql,
+)
 from .logger import get_logger
+from .partitions import Partitions
+from .retention import Retention
+from .sampling import SKIPPED
+from .timings import get_startup, get_timings
+from .writer import RequestWriter
 
 
-class Requests:
-    """Class to maintain the server and requests tables"""
+TIMINGS = get_timings()
+STARTUP = get_startup()
+INSERT_REQUEST_SQL = """INSERT INTO requests (
+    Epoch, AddressID, UserAgentID, URLID, ServerID
+) VALUES (?, ?, ?, ?, ?)"""
+SERVER_REQUEST_INDEX_SQL = """CREATE INDEX IF NOT EXISTS requests_server_request
+ON requests(ServerID, RequestID)"""
+SRV_TOTALS_TRIGGER_SQL = """CREATE TRIGGER IF NOT EXISTS requests_server_totals
+AFTER INSERT ON requests
+BEGIN
+    INSERT INTO server_totals (ServerID, RequestCount, LastRequestID, LastEpoch)
+    VALUES (NEW.ServerID, 1, NEW.RequestID, NEW.Epoch)
+    ON CONFLICT(ServerID) DO UPDATE SET
+        RequestCount = RequestCount + 1,
+        LastRequestID = MAX(LastRequestID, NEW.RequestID),
+        LastEpoch = MAX(LastEpoch, NEW.Epoch);
+END"""
+# page cache used while bulk importing, in KiB like PRAGMA cache_size
+IMPORT_CACHE_SIZE = -262144
+COUNTERS_UPSERT_SQL = """INSERT INTO request_counters (Kind, ServerID, Name, Count)
+VALUES (?, ?, ?, ?)
+ON CONFLICT(Kind, ServerID, Name) DO UPDATE SET
+    Count = Count + excluded.Count"""
 
-    def __init__(self, db_path):
-        """Initialize db class"""
+
+class Requests(RequestsBackend):
+    """SQLite backend: maintains the server and requests tables of --db-file"""
+
+    def __init__(
+        self,
+        db_path,
+        write_behind=False,
+        batch_size=100,
+        flush_interval=1.0,
+        queue_size=10000,
+        db_synchronous="NORMAL",
+        db_cache_size=-8000,
+        db_mmap_size=0,
+        db_busy_timeout=5000,
+        retention_max_age=0,
+        retention_max_rows=0,
+        retention_interval=300,
+        retention_batch_size=1000,
+        partition_by="none",
+        partition_rows=1000000,
+        analytics_interval=5.0,
+        sampler=None,
+        checkpoint_interval=5.0,
+        intern_cache_size=10000,
+        defer_init=False,
+    ):
+        """Initialize db class
+
+        With defer_init the schema setup and server registration (which
+        does a DNS lookup) run on a background thread; the instance reports
+        no DB connection and drops put_request calls until ready is set.
+
+        With a sampler its counters are added to request_counters every
+        checkpoint_interval seconds and on close.
+
+        Addresses, user agents and urls are stored as dictionary ids, the
+        intern_cache_size most recently used of each are cached.
+        """
         self.log = get_logger()
         self.db_path = db_path
-        self.db_active = self._db_init()
-        self.server_id = self._add_server()
+        self.db = ConnectionManager(
+            db_path,
+            synchronous=db_synchronous,
+            cache_size=db_cache_size,
+            mmap_size=db_mmap_size,
+            busy_timeout=db_busy_timeout,
+        )
+        self.db_active = False
+        self.server_id = 0
+        self.partitions = None
+        self.writer = None
+        self.retention = None
+        self.analytics = None
+        self.interner = Interner(self.db, intern_cache_size)
+        self.sampler = sampler
+        self.checkpoint_interval = max(float(checkpoint_interval), 0.1)
+        self.checkpoint_thread = None
+        self._checkpoint_stop = threading.Event()
+        self.ready = threading.Event()
+        self.init_thread = None
+        init_args = (
+            write_behind,
+            batch_size,
+            flush_interval,
+            queue_size,
+            retention_max_age,
+            retention_max_rows,
+            retention_interval,
+            retention_batch_size,
+            partition_by,
+            partition_rows,
+            analytics_interval,
+        )
+        if defer_init:
+            self.init_thread = threading.Thread(
+                target=self._init, args=init_args, name="pystats-db-init", daemon=True
+            )
+            self.init_thread.start()
+        else:
+            self._init(*init_args)
+
+    def _init(
+        self,
+        write_behind,
+        batch_size,
+        flush_interval,
+        queue_size,
+        retention_max_age,
+        retention_max_rows,
+        retention_interval,
+        retention_batch_size,
+        partition_by,
+        partition_rows,
+        analytics_interval,
+    ):
+        """create the schema, register this server and start the background tasks"""
+        try:
+            with STARTUP.phase("db_init"):
+                self.db_active = self._db_init()
+            with STARTUP.phase("server_registration"):
+                self.server_id = self._add_server()
+            if self.db_active:
+                # before the partitions, their inserts write the rollup too
+                self.analytics = Analytics(self.db, interval=analytics_interval)
+            if partition_by != "none" and self.db_active:
+                self.partitions = Partitions(self.db, self.db_path, partition_by, partition_rows)
+            if write_behind and self.db_active:
+                self.writer = RequestWriter(self._insert_rows, batch_size, flush_interval, queue_size)
+            if (retention_max_age or retention_max_rows) and self.db_active:
+                self.retention = Retention(
+                    self.db,
+                    partitions=self.partitions,
+                    analytics=self.analytics,
+                    max_age=retention_max_age,
+                    max_rows=retention_max_rows,
+                    interval=retention_interval,
+                    batch_size=retention_batch_size,
+                )
+            if self.sampler and self.db_active:
+                self.checkpoint_thread = threading.Thread(
+                    target=self._checkpoint_run, name="pystats-checkpoint", daemon=True
+                )
+                self.checkpoint_thread.start()
+        finally:
+            self.ready.set()
+
+    def close(self):
+        """flush any queued requests, stop the background tasks and close connections"""
+        if self.init_thread:
+            self.init_thread.join()
+        if self.retention:
+            self.retention.stop()
+            self.retention = None
+        if self.analytics:
+            self.analytics.stop()
+            self.analytics = None
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        if self.checkpoint_thread:
+            self._checkpoint_stop.set()
+            self.checkpoint_thread.join()
+            self.checkpoint_thread = None
+            self.checkpoint()
+        self.db.close()
+
+    def _checkpoint_run(self):
+        """checkpoint thread main loop"""
+        while not self._checkpoint_stop.wait(self.checkpoint_interval):
+            self.checkpoint()
+
+    def checkpoint(self):
+        """ add the sampler's counters since the last checkpoint to request_counters """
+        pending = self.sampler.take_pending()
+        if not pending:
+            return
+        try:
+            con = self.db.connection()
+            with con:
+                con.executemany(
+                    COUNTERS_UPSERT_SQL,
+                    [
+                        (kind, int(self.server_id), name, count)
+                        for (kind, name), count in pending.items()
+                    ],
+                )
+        except sqlite3.Error as err:
+            self.sampler.restore_pending(pending)
+            self.log.warning("checkpoint: could not save request counters: %s", err)
 
     def _db_init(self) -> bool:
         """ initialize the database"""
         try:
-            with closing(sqlite3.connect(self.db_path)) as con:
-                con.execute("PRAGMA foreign_keys = 1")
-                con.commit()
+            con = self.db.connection()
+            with con:
                 with closing(con.cursor()) as cur:
                     cur.execute(
                         """CREATE TABLE IF NOT EXISTS servers(
@@ -33,122 +233,386 @@ class Requests:
                             Platform TEXT
                         )"""
                     )
+                    # addresses, user agents and urls repeat, rows only hold their ids
+                    dictionaries_init(cur)
+                    cur.execute(requests_table_sql())
+                    cur.execute(SERVER_REQUEST_INDEX_SQL)
+                    # exact counts of sampled servers, see src/sampling.py
                     cur.execute(
-                        """CREATE TABLE IF NOT EXISTS requests(
-                            RequestID INTEGER PRIMARY KEY AUTOINCREMENT,
-                            Epoch REAL NOT NULL,
-                            RemoteAddress TEXT,
-                            RemoteUserAgent TEXT,
-                            RequestURL TEXT,
-                            ServerID INTEGER,
-                            FOREIGN KEY(ServerID) REFERENCES servers(ServerID)
-                        )"""
+                        """CREATE TABLE IF NOT EXISTS request_counters(
+                            Kind TEXT NOT NULL,
+                            ServerID INTEGER NOT NULL,
+                            Name TEXT NOT NULL,
+                            Count INTEGER NOT NULL,
+                            PRIMARY KEY(Kind, ServerID, Name)
+                        ) WITHOUT ROWID"""
                     )
-                    return True
+            # DBs from before the dictionary tables, once
+            normalize_requests(con)
+            self._srv_totals_init(con)
+            return True
         except (TypeError, sqlite3.OperationalError):
             self.log.warning("Could not connect to DB: %s", self.db_path)
         return False
 
+    def _srv_totals_init(self, con):
+        """ create the per server summary table and its insert trigger, backfill it once """
+        with closing(con.cursor()) as cur:
+            # immediate so no other pod inserts between the backfill and the trigger
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                exists = cur.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type='table' AND name='server_totals'"
+                ).fetchone()
+                if not exists:
+                    cur.execute(
+                        """CREATE TABLE server_totals(
+                            ServerID INTEGER PRIMARY KEY,
+                            RequestCount INTEGER NOT NULL DEFAULT 0,
+                            LastRequestID INTEGER NOT NULL DEFAULT 0,
+                            LastEpoch REAL NOT NULL DEFAULT 0,
+                            FOREIGN KEY(ServerID) REFERENCES servers(ServerID)
+                        )"""
+                    )
+                    cur.execute(SRV_TOTALS_TRIGGER_SQL)
+                    self._srv_totals_backfill(cur)
+                cur.execute("COMMIT")
+            except sqlite3.Error:
+                cur.execute("ROLLBACK")
+                raise
+
+    def _srv_totals_backfill(self, cur):
+        """ rebuild server_totals from the requests table """
+        started = time.monotonic()
+        cur.execute("DELETE FROM server_totals")
+        cur.execute(
+            """
+            INSERT INTO server_totals (ServerID, RequestCount, LastRequestID, LastEpoch)
+            SELECT ServerID, COUNT(*), MAX(RequestID), MAX(Epoch)
+            FROM requests
+            WHERE ServerID IS NOT NULL
+            GROUP BY ServerID
+            """
+        )
+        self.log.info(
+            "server_totals backfilled in %.3fs", time.monotonic() - started
+        )
+
+    def rebuild_srv_totals(self):
+        """recount server_totals from analytics_rollup plus the rows it has not folded yet
+
+        The rollup outlives retention, so the lifetime totals survive the
+        recount. Refuses (False) while the old requests_rollup table holds
+        rows, those requests may have been deleted before the fold saw them.
+        """
+        if not self.db_active:
+            self.log.warning("rebuild_srv_totals: No DB Connection")
+            return False
+        con = self.db.connection()
+        with closing(con.cursor()) as cur:
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                legacy = cur.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type='table' AND name='requests_rollup'"
+                ).fetchone()
+                if legacy and cur.execute("SELECT 1 FROM requests_rollup LIMIT 1").fetchone():
+                    cur.execute("ROLLBACK")
+                    self.log.warning(
+                        "rebuild_srv_totals: requests_rollup holds pruned rows, server_totals left as is"
+                    )
+                    return False
+                started = time.monotonic()
+                cur.execute(
+                    """
+                    WITH counts(ServerID, RequestCount, LastRequestID, LastEpoch) AS (
+                        SELECT ServerID, SUM(RequestCount), 0, 0
+                        FROM analytics_rollup
+                        WHERE Step = 3600 AND Dimension = 0 AND ServerID != 0
+                        GROUP BY ServerID
+                        UNION ALL
+                        SELECT ServerID,
+                            SUM(RequestID > (SELECT FoldedID FROM analytics_state WHERE ID = 0)),
+                            MAX(RequestID), MAX(Epoch)
+                        FROM requests
+                        WHERE ServerID IS NOT NULL
+                        GROUP BY ServerID
+                        UNION ALL
+                        SELECT ServerID, 0, LastRequestID, LastEpoch FROM server_totals
+                    )
+                    INSERT INTO server_totals (ServerID, RequestCount, LastRequestID, LastEpoch)
+                    SELECT ServerID, SUM(RequestCount), MAX(LastRequestID), MAX(LastEpoch)
+                    FROM counts
+                    GROUP BY ServerID
+                    ON CONFLICT(ServerID) DO UPDATE SET
+                        RequestCount = excluded.RequestCount,
+                        LastRequestID = excluded.LastRequestID,
+                        LastEpoch = excluded.LastEpoch
+                    """
+                )
+                cur.execute("COMMIT")
+            except sqlite3.Error:
+                cur.execute("ROLLBACK")
+                raise
+        self.log.info("server_totals rebuilt in %.3fs", time.monotonic() - started)
+        return True
+
     def _add_server(self):
         """add a entry to the servers table for this instance of pystats"""
         if not self.db_active:
             self.log.warning("AddServer: No DB Connection")
             return 0
-        with closing(sqlite3.connect(self.db_path)) as con:
-            with closing(con.cursor()) as cur:
-                host_data = {
-                    "host": str(os.uname()[1]),
-                    "ip": str(socket.gethostbyname(socket.gethostname())),
-                    "arc": str(platform.platform()),
-                }
+        con = self.db.connection()
+        with closing(con.cursor()) as cur:
+            host_data = {
+                "host": str(os.uname()[1]),
+                "ip": str(socket.gethostbyname(socket.gethostname())),
+                "arc": str(platform.platform()),
+            }
+            cur.execute(
+                "SELECT ServerID from servers WHERE Hostname=:host AND IP=:ip",
+                host_data,
+            )
+            our_id = cur.fetchone()
+            if not our_id:
+                cur.execute(
+                    "INSERT INTO servers (Hostname, IP, Platform) VALUES (:host, :ip, :arc)",
+                    host_data,
+                )
+                con.commit()
                 cur.execute(
                     "SELECT ServerID from servers WHERE Hostname=:host AND IP=:ip",
                     host_data,
                 )
                 our_id = cur.fetchone()
-                if not our_id:
-                    cur.execute(
-                        "INSERT INTO servers (Hostname, IP, Platform) VALUES (:host, :ip, :arc)",
-                        host_data,
+        return int(our_id[0])
+
+    @TIMINGS.timed("sql")
+    def _insert_rows(self, batch):
+        """ write a batch of request dicts in one transaction """
+        ids = self.interner.ids(batch)
+        if self.partitions:
+            self.partitions.insert(batch, ids)
+            return
+        con = self.db.connection()
+        with con:
+            con.executemany(
+                INSERT_REQUEST_SQL,
+                [
+                    (req_data["epoch"], *row_ids, req_data["server_id"])
+                    for req_data, row_ids in zip(batch, ids)
+                ],
+            )
+
+    def _import_servers(self, con, servers, batch):
+        """ set server_id on every row, adding unknown hostname/ip pairs to servers """
+        # servers.IP is NOT NULL, a record without one is stored and looked up as ""
+        missing = {
+            (req_data["hostname"], req_data["ip"] or "")
+            for req_data in batch
+            if req_data["hostname"] is not None
+            and (req_data["hostname"], req_data["ip"] or "") not in servers
+        }
+        if missing:
+            with con:
+                for host, ip in sorted(missing, key=str):
+                    cur = con.execute(
+                        "INSERT INTO servers (Hostname, IP) VALUES (?, ?)", (host, ip)
                     )
-                    con.commit()
-                    cur.execute(
-                        "SELECT ServerID from servers WHERE Hostname=:host AND IP=:ip",
-                        host_data,
+                    servers[(host, ip)] = cur.lastrowid
+        known = set(servers.values())
+        for req_data in batch:
+            if req_data["hostname"] is not None:
+                req_data["server_id"] = servers[(req_data["hostname"], req_data["ip"] or "")]
+            elif req_data["server_id"] not in known:
+                # no server info or a ServerID this DB never had: count it as ours
+                req_data["server_id"] = int(self.server_id)
+
+    def _import_begin(self, con):
+        """fast pragmas, drop the index and summary trigger until the import is done
+
+        Returns the highest RequestID the trigger counted, None when
+        partition inserts keep server_totals themselves.
+        """
+        con.execute("PRAGMA synchronous = OFF")
+        con.execute(f"PRAGMA cache_size = {IMPORT_CACHE_SIZE}")
+        con.execute("PRAGMA temp_store = MEMORY")
+        if self.partitions:
+            return None
+        with con:
+            con.execute("DROP TRIGGER IF EXISTS requests_server_totals")
+            con.execute("DROP INDEX IF EXISTS requests_server_request")
+            # read in the same transaction, so every later row goes uncounted
+            return con.execute(
+                "SELECT COALESCE(MAX(RequestID), 0) FROM requests"
+            ).fetchone()[0]
+
+    def _srv_totals_add(self, cur, after_id):
+        """ add the rows above after_id to server_totals, keeping the counts of pruned rows """
+        cur.execute(
+            """
+            INSERT INTO server_totals (ServerID, RequestCount, LastRequestID, LastEpoch)
+            SELECT ServerID, COUNT(*), MAX(RequestID), MAX(Epoch)
+            FROM requests
+            WHERE RequestID > ? AND ServerID IS NOT NULL
+            GROUP BY ServerID
+            ON CONFLICT(ServerID) DO UPDATE SET
+                RequestCount = RequestCount + excluded.RequestCount,
+                LastRequestID = MAX(LastRequestID, excluded.LastRequestID),
+                LastEpoch = MAX(LastEpoch, excluded.LastEpoch)
+            """,
+            (int(after_id),),
+        )
+
+    def _import_end(self, con, counted_id):
+        """ rebuild the index, add the imported rows to server_totals, restore the pragmas """
+        started = time.monotonic()
+        try:
+            if counted_id is not None:
+                with con:
+                    con.execute(SERVER_REQUEST_INDEX_SQL)
+                with closing(con.cursor()) as cur:
+                    cur.execute("BEGIN IMMEDIATE")
+                    try:
+                        cur.execute(SRV_TOTALS_TRIGGER_SQL)
+                        self._srv_totals_add(cur, counted_id)
+                        cur.execute("COMMIT")
+                    except sqlite3.Error:
+                        cur.execute("ROLLBACK")
+                        raise
+        finally:
+            con.execute(f"PRAGMA synchronous = {self.db.synchronous}")
+            con.execute(f"PRAGMA cache_size = {self.db.cache_size}")
+            con.execute("PRAGMA temp_store = DEFAULT")
+        return time.monotonic() - started
+
+    def import_requests(self, chunks, progress_interval=5.0):
+        """ bulk load chunks of request dicts (see src/importer.py), returns rows imported
+
+        Meant for offline loads: while it runs the requests index and the
+        server_totals trigger are dropped, at the end the index is rebuilt
+        and the rows added since are counted on top of server_totals.
+        """
+        if not self.db_active:
+            self.log.warning("import_requests: No DB Connection")
+            return 0
+        con = self.db.connection()
+        servers = {
+            (host, ip): srv_id
+            for srv_id, host, ip in con.execute("SELECT ServerID, Hostname, IP FROM servers")
+        }
+        started = time.monotonic()
+        reported = started
+        imported = 0
+        counted_id = self._import_begin(con)
+        try:
+            for batch in chunks:
+                self._import_servers(con, servers, batch)
+                # one transaction per chunk
+                self._insert_rows(batch)
+                imported += len(batch)
+                now = time.monotonic()
+                if now - reported >= progress_interval:
+                    reported = now
+                    self.log.info(
+                        "import: %s rows in %.1fs, %.0f rows/s",
+                        imported, now - started, imported / (now - started),
                     )
-                    our_id = cur.fetchone()
-        return int(our_id[0])
+        finally:
+            rebuild_secs = self._import_end(con, counted_id)
+        elapsed = time.monotonic() - started
+        self.log.info(
+            "import: %s rows in %.1fs, %.0f rows/s, index and server_totals rebuilt in %.3fs",
+            imported, elapsed, imported / elapsed if elapsed else 0, rebuild_secs,
+        )
+        return imported
 
-    def put_request(self, remote_addr, remote_user_agent, request_url) -> bool:
-        """write request data to the sqlite date base"""
+    @TIMINGS.timed("sql")
+    def get_last_id(self):
+        """get the highest RequestID handed out"""
         if not self.db_active:
-            msg = "put request: No DB Connection:"
-            msg += f" remote_addr {remote_addr},"
-            msg += f" remote_user_agent {remote_user_agent},"
-            msg += f" request_url {request_url}"
-            self.log.warning(msg)
-            return False
-        with closing(sqlite3.connect(self.db_path)) as con:
-            with closing(con.cursor()) as cur:
-                req_data = {
-                    "epoch": float(round(time.time(), 4)),
-                    "remote_address": str(remote_addr),
-                    "remote_user_agent": str(remote_user_agent),
-                    "request_url": str(request_url),
-                    "server_id": int(self.server_id),
-                }
-                cur.execute(
-                    """INSERT INTO requests (
-                        Epoch, RemoteAddress, RemoteUserAgent, RequestURL, ServerID
-                    ) VALUES (
-                        :epoch, :remote_address, :remote_user_agent, :request_url, :server_id
-                    )""",
-                    req_data,
-                )
-                con.commit()
-        return True
+            self.log.warning("get_last_id: No DB Connection")
+            return 0
+        if self.partitions:
+            return self.partitions.last_id()
+        with closing(self.db.connection().cursor()) as cur:
+            cur.execute(
+                "SELECT RequestID FROM requests ORDER BY RequestID DESC LIMIT 1"
+            )
+            # with write-behind the table can still be empty
+            rec = cur.fetchone()
+            return int(rec[0]) if rec else 0
 
-    def get_srv_id(self):
-        """get the server id for this instance of pystats"""
-        return self.server_id
+    def _pending_skipped(self, srv_id=None):
+        """ requests this server skipped since the last checkpoint """
+        if not self.sampler or (srv_id is not None and int(srv_id) != self.server_id):
+            return 0
+        return self.sampler.pending_count(SKIPPED)
 
-    def get_req_total(self):
-        """get the total number of requests"""
+    @TIMINGS.timed("sql")
+    def _skipped_total(self, srv_id=None):
+        """ requests the sampler of every (or one) server did not store """
         if not self.db_active:
-            self.log.warning("get_req_total: No DB Connection")
             return 0
-        with closing(sqlite3.connect(self.db_path)) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute(
-                    "SELECT RequestID FROM requests ORDER BY RequestID DESC LIMIT 1"
-                )
-                return int(cur.fetchone()[0])
+        srv_where = "AND ServerID = ?" if srv_id is not None else ""
+        srv_args = (int(srv_id),) if srv_id is not None else ()
+        with closing(self.db.connection().cursor()) as cur:
+            rec = cur.execute(
+                f"""
+                SELECT SUM(Count)
+                FROM request_counters
+                WHERE Kind = ? {srv_where}
+                """,
+                (SKIPPED,) + srv_args,
+            ).fetchone()
+        return (rec[0] or 0) + self._pending_skipped(srv_id)
+
+    @TIMINGS.timed("sql")
+    def get_counters(self):
+        """ exact request counts of this server: {"route": {route: n}, "status": {code: n}} """
+        counters = {}
+        if self.db_active:
+            with closing(self.db.connection().cursor()) as cur:
+                for kind, name, count in cur.execute(
+                    "SELECT Kind, Name, Count FROM request_counters WHERE ServerID = ?",
+                    (int(self.server_id),),
+                ):
+                    counters.setdefault(kind, {})[name] = count
+        if self.sampler:
+            for (kind, name), count in self.sampler.snapshot(pending=True).items():
+                kind_counts = counters.setdefault(kind, {})
+                kind_counts[name] = kind_counts.get(name, 0) + count
+        counters.pop(SKIPPED, None)
+        return counters
+
+    @TIMINGS.timed("sql")
+    def get_first_id(self):
+        """get the lowest RequestID still stored, None when rows below the newest id may still arrive
 
+        Partitioned writes reserve ids before the rows land in their
+        partition files, so there a lower id can show up after a higher one.
+        """
+        if not self.db_active or self.partitions:
+            return None
+        with closing(self.db.connection().cursor()) as cur:
+            cur.execute(
+                "SELECT RequestID FROM requests ORDER BY RequestID ASC LIMIT 1"
+            )
+            rec = cur.fetchone()
+            return int(rec[0]) if rec else 0
+
+    @TIMINGS.timed("sql")
     def get_srv_total(self):
         """get total number of servers"""
         if not self.db_active:
             self.log.warning("get_srv_total: No DB Connection")
             return 0
-        with closing(sqlite3.connect(self.db_path)) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute(
-                    "SELECT ServerID FROM servers ORDER BY ServerID DESC LIMIT 1"
-                )
-                return int(cur.fetchone()[0])
-
-    def _parse_min_max(self, pn_start, pn_count, req_total):
-        """ get the min and max ids for pagination and sanitize for integers """
-        try:
-            min = int(pn_start)
-            min = min if min > 0 else 1
-            pn_count = int(pn_count) if pn_count < 100 else 100
-            max_min = int(req_total) - int(pn_count -1 )
-            min = min if min <= max_min else max_min
-            max = min + int(pn_count - 1)
-            return (min, max)
-        except TypeError:
-            return(1, 10)
+        with closing(self.db.connection().cursor()) as cur:
+            cur.execute(
+                "SELECT ServerID FROM servers ORDER BY ServerID DESC LIMIT 1"
+            )
+            return int(cur.fetchone()[0])
 
+    @TIMINGS.timed("sql")
     def get_srvs(self, pn_start=1, pn_count=10):
         """ get all the servers: list of tuple """
         srvs_tbl = []
@@ -156,100 +620,240 @@ class Requests:
         if not self.db_active:
             self.log.warning("get_srvs: No DB Connection")
             return [("N0 Data", "N0 Data", "N0 Data", "N0 Data", "N0 Data")]
-        with closing(sqlite3.connect(self.db_path)) as con:
-            with closing(con.cursor()) as cur:
-                sql = f"""
-                    SELECT ServerID,Hostname,IP,Platform
-                    FROM servers
-                    WHERE ServerID BETWEEN {min} AND {max}
-                    ORDER BY ServerID ASC
+        with closing(self.db.connection().cursor()) as cur:
+            data = cur.execute(
                 """
-                data = cur.execute(sql).fetchall()
+                SELECT s.ServerID,COALESCE(t.RequestCount, 0) + COALESCE(c.Count, 0),
+                    s.Hostname,s.IP,s.Platform
+                FROM servers s
+                LEFT JOIN server_totals t ON t.ServerID = s.ServerID
+                LEFT JOIN request_counters c
+                    ON c.Kind = ? AND c.ServerID = s.ServerID AND c.Name = ''
+                WHERE s.ServerID BETWEEN ? AND ?
+                ORDER BY s.ServerID ASC
+                """,
+                (SKIPPED, min, max),
+            ).fetchall()
         for row in data:
             # ServerID,srv_req_tot,Hostname,IP,Platform
-            rec = (row[0],self.get_srv_req_tot(row[0]),str(row[1]),str(row[2]),str(row[3]))
+            srv_req_tot = row[1] + self._pending_skipped(row[0])
+            rec = (row[0],srv_req_tot,str(row[2]),str(row[3]),str(row[4]))
             srvs_tbl.append(rec)
         return srvs_tbl
 
 
+    @TIMINGS.timed("sql")
     def get_requests(self, pn_start=1, pn_count=10):
         """ get all the requests: list of tuple """
         if not self.db_active:
             self.log.warning("get_requests: No DB Connection")
             return [("N0 Data", "N0 Data", "N0 Data", "N0 Data", "N0 Data", "N0 Data")]
-        min, max = self._parse_min_max(pn_start, pn_count, self.get_req_total())
-        with closing(sqlite3.connect(self.db_path)) as con:
-            with closing(con.cursor()) as cur:
-                sql = f"""
-                    SELECT RequestID,Epoch,RemoteAddress,RemoteUserAgent,RequestURL,ServerID
-                    FROM requests
-                    WHERE RequestID BETWEEN {min} AND {max}
-                    ORDER BY RequestID ASC
-                """
-                return cur.execute(sql).fetchall()
+        min, max = self._parse_min_max(pn_start, pn_count, self.get_last_id())
+        if self.partitions:
+            rows = self.partitions.fetch(None, False, min - 1, max - min + 1)
+            return [row for row in rows if row[0] <= max]
+        with closing(self.db.connection().cursor()) as cur:
+            return cur.execute(
+                f"""
+                SELECT {request_rows_sql("requests")}
+                WHERE RequestID BETWEEN ? AND ?
+                ORDER BY RequestID ASC
+                """,
+                (min, max),
+            ).fetchall()
 
 
+    @TIMINGS.timed("sql")
     def get_srv_req_tot(self, srv_id):
         """ get number of requests for server """
         if not self.db_active:
             self.log.warning("get_srv_req_tot: No DB Connection")
             return 0
-        with closing(sqlite3.connect(self.db_path)) as con:
-            with closing(con.cursor()) as cur:
-                sql = f"""
-                    SELECT COUNT(ServerID)
-                    FROM requests
-                    WHERE ServerID = {int(srv_id)}
+        with closing(self.db.connection().cursor()) as cur:
+            rec = cur.execute(
                 """
-                return cur.execute(sql).fetchone()[0]
+                SELECT RequestCount
+                FROM server_totals
+                WHERE ServerID = ?
+                """,
+                (int(srv_id),),
+            ).fetchone()
+        return (rec[0] if rec else 0) + self._skipped_total(srv_id)
 
+    @TIMINGS.timed("sql")
+    def get_srv_req_totals(self):
+        """ get the request total of every server: list of (ServerID,Hostname,IP,total) """
+        if not self.db_active:
+            self.log.warning("get_srv_req_totals: No DB Connection")
+            return []
+        with closing(self.db.connection().cursor()) as cur:
+            rows = cur.execute(
+                """
+                SELECT s.ServerID,s.Hostname,s.IP,
+                    COALESCE(t.RequestCount, 0) + COALESCE(c.Count, 0)
+                FROM servers s
+                LEFT JOIN server_totals t ON t.ServerID = s.ServerID
+                LEFT JOIN request_counters c
+                    ON c.Kind = ? AND c.ServerID = s.ServerID AND c.Name = ''
+                ORDER BY s.ServerID ASC
+                """,
+                (SKIPPED,),
+            ).fetchall()
+        return [row[:3] + (row[3] + self._pending_skipped(row[0]),) for row in rows]
+
+    @TIMINGS.timed("sql")
     def get_srv_socket(self, srv_id):
         """ get the hostname and ip of a server """
         if not self.db_active:
-            self.log.get_srv_socket("get_requests: No DB Connection")
+            self.log.warning("get_srv_socket: No DB Connection")
             return ("N/A","N/A")
-        with closing(sqlite3.connect(self.db_path)) as con:
-            with closing(con.cursor()) as cur:
-                sql = f"""
-                    SELECT Hostname,IP
-                    FROM servers
-                    WHERE ServerID = {int(srv_id)}
+        with closing(self.db.connection().cursor()) as cur:
+            data = cur.execute(
                 """
-                data = cur.execute(sql).fetchone()
-                return (data[0], data[1])
+                SELECT Hostname,IP
+                FROM servers
+                WHERE ServerID = ?
+                """,
+                (int(srv_id),),
+            ).fetchone()
+            return (data[0], data[1])
 
+    @TIMINGS.timed("sql")
     def get_srv_requests(self, srv_id, pn_page=1, pn_count=10):
         """ get all the requests: list of tuple """
         if not self.db_active:
             self.log.warning("get_requests: No DB Connection")
             return [("N0 Data", "N0 Data", "N0 Data", "N0 Data", "N0 Data", "N0 Data")]
-        pn_start = ( int(pn_page) - 1 ) * pn_count
-        with closing(sqlite3.connect(self.db_path)) as con:
-            with closing(con.cursor()) as cur:
+        pn_count = self._page_count(pn_count)
+        pn_start = (max(int(pn_page), 1) - 1) * pn_count
+        if self.partitions:
+            return self.partitions.fetch_offset(srv_id, pn_start, pn_count)
+        with closing(self.db.connection().cursor()) as cur:
+            return cur.execute(
+                f"""
+                SELECT {request_rows_sql("requests")}
+                WHERE ServerID = ?
+                ORDER BY RequestID ASC
+                Limit ?,?
+                """,
+                (int(srv_id), int(pn_start), int(pn_count)),
+            ).fetchall()
+
+    @TIMINGS.timed("sql")
+    def _fetch(self, srv_id, desc, cursor_id, limit):
+        """ up to limit rows after (or before when desc) a RequestID, optionally for one server """
+        if self.partitions:
+            return self.partitions.fetch(srv_id, desc, cursor_id, limit)
+        srv_where = "ServerID = ? AND" if srv_id is not None else ""
+        srv_args = (int(srv_id),) if srv_id is not None else ()
+        op, order = ("<", "DESC") if desc else (">", "ASC")
+        with closing(self.db.connection().cursor()) as cur:
+            return cur.execute(
+                f"""
+                SELECT {request_rows_sql("requests")}
+                WHERE {srv_where} RequestID {op} ?
+                ORDER BY RequestID {order}
+                LIMIT ?
+                """,
+                srv_args + (int(cursor_id), int(limit)),
+            ).fetchall()
+
+    def iter_requests(
+        self, srv_id=None, since=None, until=None, min_id=None, max_id=None, chunk=1000
+    ):
+        """ yield lists of up to chunk request rows joined with their server, in RequestID order
+
+        Rows are read on a separate connection in keyset windows of
+        50 chunks, each consumed with fetchmany, so no read transaction
+        is held open for the whole export and WAL checkpoints keep up.
+        """
+        if not self.db_active:
+            self.log.warning("iter_requests: No DB Connection")
+            return
+        chunk = max(int(chunk), 1)
+        window = chunk * 50
+        where = ["r.RequestID > ?"]
+        args = []
+        if srv_id is not None:
+            where.append("r.ServerID = ?")
+            args.append(int(srv_id))
+        if since is not None:
+            where.append("r.Epoch >= ?")
+            args.append(float(since))
+        if until is not None:
+            where.append("r.Epoch < ?")
+            args.append(float(until))
+        if max_id is not None:
+            where.append("r.RequestID <= ?")
+            args.append(int(max_id))
+        where_sql = " AND ".join(where)
+        con = self.db.open_reader()
+        try:
+            if self.partitions:
+                parts = self.partitions.get_partitions(con)
+                parts = [
+                    part for part in parts
+                    if (max_id is None or part[1] <= int(max_id))
+                    and (min_id is None or part[2] >= int(min_id))
+                    and (since is None or part[4] >= float(since))
+                    and (until is None or part[3] < float(until))
+                ]
+                names = [part[0] for part in parts]
+            else:
+                names = [None]
+            for name in names:
+                table = self.partitions.table(con, name) if name else "main.requests"
                 sql = f"""
-                    SELECT RequestID,Epoch,RemoteAddress,RemoteUserAgent,RequestURL,ServerID
-                    FROM requests
-                    WHERE ServerID = {int(srv_id)}
-                    ORDER BY RequestID ASC
-                    Limit {int(pn_start)},{int(pn_count)}
+                    SELECT {request_rows_sql(table, ",s.Hostname,s.IP")}
+                    LEFT JOIN main.servers s ON s.ServerID = r.ServerID
+                    WHERE {where_sql}
+                    ORDER BY r.RequestID ASC
+                    LIMIT ?
                 """
-                return cur.execute(sql).fetchall()
+                last_id = int(min_id) - 1 if min_id is not None else 0
+                while True:
+                    with closing(con.cursor()) as cur:
+                        cur.execute(sql, [last_id] + args + [window])
+                        seen = 0
+                        while True:
+                            rows = cur.fetchmany(chunk)
+                            if not rows:
+                                break
+                            seen += len(rows)
+                            last_id = rows[-1][0]
+                            yield rows
+                    if seen < window:
+                        break
+        finally:
+            if self.partitions:
+                self.partitions.release(con)
+            con.close()
+
+    @TIMINGS.timed("sql")
+    def get_analytics(
+        self, group_by="server", since=None, until=None, srv_id=None, bucket=60, limit=100
+    ):
+        """ request counts over a time window grouped by server, url, address, user_agent or time """
+        if not self.db_active or not self.analytics:
+            self.log.warning("get_analytics: No DB Connection")
+            return None
+        return self.analytics.query(group_by, since, until, srv_id, bucket, limit)
 
+    @TIMINGS.timed("sql")
     def get_srv_last_rec(self, srv_id):
         """ get the last page of records """
         if not self.db_active:
             self.log.warning("get_srv_end_start: No DB Connection")
             return 0
-        with closing(sqlite3.connect(self.db_path)) as con:
-            with closing(con.cursor()) as cur:
-                sql = f"""
-                    SELECT RequestID
-                    FROM requests
-                    WHERE ServerID = {srv_id}
-                    ORDER BY RequestID DESC
-                    LIMIT 1
+        with closing(self.db.connection().cursor()) as cur:
+            rec = cur.execute(
                 """
-                rec = cur.execute(sql).fetchone()[0]
-                if rec:
-                    return rec
-                return 0
+                SELECT LastRequestID
+                FROM server_totals
+                WHERE ServerID = ?
+                """,
+                (int(srv_id),),
+            ).fetchone()
+            if rec:
+                return rec[0]
+            return 0
@@ -0,0 +1,230 @@
+""" retention and compaction of the requests table """
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from .logger import get_logger
+from .partitions import MAIN_PARTITION
+
+
+class Retention:
+    """Background task that deletes expired requests, their counts live on in analytics_rollup"""
+
+    def __init__(
+        self,
+        db,
+        partitions=None,
+        analytics=None,
+        max_age=0,
+        max_rows=0,
+        interval=300,
+        batch_size=1000,
+        batch_pause=0.05,
+        vacuum_pages=1000,
+    ):
+        """Initialize the retention task and start the maintenance thread
+
+        With analytics, rows are only deleted once they are folded into
+        analytics_rollup, each pass folds everything first.
+        """
+        self.log = get_logger()
+        self.db = db
+        self.partitions = partitions
+        self.analytics = analytics
+        self.max_age = max(float(max_age), 0)
+        self.max_rows = max(int(max_rows), 0)
+        self.interval = max(float(interval), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.batch_pause = max(float(batch_pause), 0)
+        self.vacuum_pages = max(int(vacuum_pages), 0)
+        self._main_bound = None
+        self._stop = threading.Event()
+        self._vacuum_init()
+        self.thread = threading.Thread(
+            target=self._run, name="pystats-retention", daemon=True
+        )
+        self.thread.start()
+
+    def _vacuum_init(self):
+        """ check the DB can give deleted pages back a batch at a time """
+        con = self.db.connection()
+        self.incremental_vacuum = con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        if not self.incremental_vacuum:
+            self.log.warning(
+                "retention: auto_vacuum is not INCREMENTAL on this DB, "
+                "run VACUUM once to give deleted space back to the filesystem"
+            )
+
+    def stop(self):
+        """stop the maintenance thread, waits for the current batch"""
+        self._stop.set()
+        self.thread.join()
+
+    def _run(self):
+        """maintenance thread main loop"""
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except sqlite3.Error as err:
+                self.log.warning("retention: maintenance failed: %s", err)
+
+    def _expired_bound(self, cur):
+        """ highest RequestID of the next batch to expire, 0 when nothing is due """
+        bound = self._due_bound(cur)
+        if bound and self.analytics:
+            # rows the fold has not reached yet would be lost to the rollups
+            folded = cur.execute("SELECT FoldedID FROM analytics_state WHERE ID = 0").fetchone()[0]
+            bound = min(bound, folded)
+        return bound
+
+    def _due_bound(self, cur):
+        """ highest RequestID of the next batch past max_age or max_rows, 0 when nothing is due """
+        if self._main_bound is not None:
+            # dropping the legacy table of a partitioned DB: everything goes
+            rec = cur.execute(
+                "SELECT RequestID FROM requests ORDER BY RequestID ASC LIMIT 1 OFFSET ?",
+                (self.batch_size - 1,),
+            ).fetchone()
+            return min(rec[0], self._main_bound) if rec else self._main_bound
+        bound = 0
+        min_id, max_id = cur.execute(
+            "SELECT MIN(RequestID), MAX(RequestID) FROM requests"
+        ).fetchone()
+        if min_id is None:
+            return 0
+        if self.max_rows:
+            # rows are only ever deleted from the front so the id range is the row count
+            excess = max_id - min_id + 1 - self.max_rows
+            if excess > 0:
+                bound = min_id + min(excess, self.batch_size) - 1
+        if self.max_age:
+            rec = cur.execute(
+                """
+                SELECT MAX(RequestID)
+                FROM (
+                    SELECT RequestID, Epoch
+                    FROM requests
+                    WHERE RequestID >= ?
+                    ORDER BY RequestID ASC
+                    LIMIT ?
+                )
+                WHERE Epoch < ?
+                """,
+                (min_id, self.batch_size, time.time() - self.max_age),
+            ).fetchone()
+            if rec[0]:
+                bound = max(bound, rec[0])
+        return bound
+
+    def _expire_batch(self, cur):
+        """ delete one batch in its own transaction, returns rows deleted """
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            bound = self._expired_bound(cur)
+            if not bound:
+                cur.execute("COMMIT")
+                return 0
+            cur.execute("DELETE FROM requests WHERE RequestID <= ?", (bound,))
+            deleted = cur.rowcount
+            cur.execute("COMMIT")
+        except sqlite3.Error:
+            cur.execute("ROLLBACK")
+            raise
+        return deleted
+
+    def _expired_partitions(self, con):
+        """ oldest partitions past max_age or beyond max_rows, never the newest one """
+        parts = self.partitions.get_partitions(con)
+        cutoff = time.time() - self.max_age
+        total = sum(part[5] for part in parts)
+        expired = []
+        for part in parts[:-1]:
+            by_age = self.max_age and part[4] < cutoff
+            by_rows = self.max_rows and total - part[5] >= self.max_rows
+            if not (by_age or by_rows):
+                break
+            expired.append(part)
+            total -= part[5]
+        return expired
+
+    def _drop_partition(self, con, part):
+        """ forget a whole partition and delete its file, its rows were rolled up on insert """
+        name = part[0]
+        if name == MAIN_PARTITION:
+            # the legacy table lives in the catalog file, delete it in batches
+            self._main_bound = part[2]
+            try:
+                deleted = self._expire_rows()
+            finally:
+                self._main_bound = None
+            # stopped half way: the next run picks up the rest
+            if con.execute("SELECT 1 FROM requests LIMIT 1").fetchone():
+                return deleted
+            self.partitions.forget(con, name)
+            return deleted
+        self.partitions.forget(con, name)
+        path = self.partitions.partition_path(name)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        return part[5]
+
+    def _drop_partitions(self):
+        """ drop every expired partition, returns rows dropped """
+        con = self.db.connection()
+        dropped = 0
+        for part in self._expired_partitions(con):
+            if self._stop.is_set():
+                break
+            started = time.monotonic()
+            rows = self._drop_partition(con, part)
+            dropped += rows
+            self.log.info(
+                "retention: dropped partition %s with %s rows in %.3fs",
+                part[0], rows, time.monotonic() - started,
+            )
+        return dropped
+
+    def run_once(self):
+        """ run one full maintenance pass """
+        if not (self.max_age or self.max_rows):
+            return 0
+        if self.partitions:
+            return self._drop_partitions()
+        return self._expire_rows()
+
+    def _expire_rows(self):
+        """ fold, then delete expired rows of the requests table in batches """
+        if self.analytics:
+            self.analytics.fold()
+        started = time.monotonic()
+        deleted = 0
+        batches = 0
+        con = self.db.connection()
+        with closing(con.cursor()) as cur:
+            while not self._stop.is_set():
+                rows = self._expire_batch(cur)
+                if not rows:
+                    break
+                deleted += rows
+                batches += 1
+                # let queued writers in between batches
+                time.sleep(self.batch_pause)
+            expire_secs = time.monotonic() - started
+            vacuum_secs = 0
+            freed = 0
+            if deleted and self.incremental_vacuum and self.vacuum_pages:
+                vacuum_started = time.monotonic()
+                free_before = cur.execute("PRAGMA freelist_count").fetchone()[0]
+                # executescript steps the pragma to completion, execute frees a single page
+                cur.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages});")
+                freed = free_before - cur.execute("PRAGMA freelist_count").fetchone()[0]
+                vacuum_secs = time.monotonic() - vacuum_started
+        if not deleted:
+            return 0
+        self.log.info(
+            "retention: deleted %s rows in %s batches in %.3fs, vacuumed %s pages in %.3fs",
+            deleted, batches, expire_secs, freed, vacuum_secs,
+        )
+        return deleted
@@ -0,0 +1,106 @@
+""" request sampling with exact per route and per status counters """
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+SAMPLE_KEYS = ("route", "client")
+# request_counters kinds: requests not stored, requests per route, responses per status
+SKIPPED = "skipped"
+ROUTE = "route"
+STATUS = "status"
+
+
+class Sampler:
+    """Picks the requests that get a row and counts every request exactly
+
+    A request is stored when it is the every-th one and, with
+    per_second set, its route or client still has a token in its
+    bucket. Counters accumulate in pending until the backend takes them
+    for a checkpoint; counts keeps everything since start for backends
+    without a DB.
+    """
+
+    def __init__(self, every=1, per_second=0.0, key="route", max_keys=10000):
+        self.every = max(int(every), 1)
+        self.per_second = max(float(per_second), 0)
+        self.key = key
+        self.max_keys = max(int(max_keys), 1)
+        self._lock = threading.Lock()
+        self._seen = 0
+        # route or client -> [tokens, monotonic of the last refill], least recently used first
+        self._buckets = OrderedDict()
+        # (kind, name) -> count not checkpointed yet
+        self.pending = Counter()
+        # (kind, name) -> count since start
+        self.counts = Counter()
+
+    def describe(self):
+        """ the sampling mode for humans, e.g. 1 in 100, 10/s per route """
+        parts = []
+        if self.every > 1:
+            parts.append(f"1 in {self.every}")
+        if self.per_second:
+            parts.append(f"{self.per_second:g}/s per {self.key}")
+        return ", ".join(parts) or "all"
+
+    def _bucket_take(self, key):
+        """ take a token from the bucket of key, False when it is empty """
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            # a new key starts with a full bucket of one second's worth
+            bucket = self._buckets[key] = [max(self.per_second, 1.0), now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(bucket[0] + (now - bucket[1]) * self.per_second, max(self.per_second, 1.0))
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def keep(self, remote_addr, route):
+        """ count a request, True when it should be stored """
+        with self._lock:
+            self._seen += 1
+            keep = self._seen % self.every == 0
+            if keep and self.per_second:
+                keep = self._bucket_take(route if self.key == "route" else remote_addr)
+            self._add(ROUTE, route)
+            if not keep:
+                self._add(SKIPPED, "")
+        return keep
+
+    def count_status(self, status):
+        """ count the response status of a counted request """
+        with self._lock:
+            self._add(STATUS, str(status))
+
+    def _add(self, kind, name, count=1):
+        """ bump a counter, caller holds the lock """
+        self.pending[(kind, name)] += count
+        self.counts[(kind, name)] += count
+
+    def take_pending(self):
+        """ the counters since the last checkpoint, resetting them """
+        with self._lock:
+            pending, self.pending = self.pending, Counter()
+        return pending
+
+    def restore_pending(self, pending):
+        """ put back counters of a failed checkpoint """
+        with self._lock:
+            self.pending.update(pending)
+
+    def snapshot(self, pending=False):
+        """ copy of counts, or of pending """
+        with self._lock:
+            return Counter(self.pending if pending else self.counts)
+
+    def pending_count(self, kind):
+        """ sum of the not yet checkpointed counters of a kind """
+        with self._lock:
+            return sum(count for (ckind, _), count in self.pending.items() if ckind == kind)
@@ -0,0 +1,57 @@
+""" pre-serialized /json and /yaml bodies, rendered once per stats snapshot version """
+import gzip
+import json
+import threading
+from .logger import get_logger
+
+
+SERIALIZED_FORMATS = ("json", "yaml")
+
+
+def _json(stats):
+    """ same bytes flask's jsonify sends outside debug mode """
+    return (json.dumps(stats, separators=(",", ":"), sort_keys=True) + "\n").encode("utf-8")
+
+
+def _yaml(stats):
+    """ yaml.dump output, through libyaml when available """
+    # pylint: disable=import-outside-toplevel
+    # yaml is imported on the first /yaml request to keep it off the startup path
+    import yaml
+    try:
+        from yaml import CDumper as YamlDumper
+    except ImportError:
+        # PyYAML built without libyaml
+        from yaml import Dumper as YamlDumper
+    return yaml.dump(stats, Dumper=YamlDumper, indent=2).encode("utf-8")
+
+
+class SerializedStats:
+    """Caches the encoded and gzipped bodies of the latest Stats snapshot per format"""
+
+    def __init__(self, stats, gzip_level=6):
+        self.log = get_logger()
+        self.stats = stats
+        self.gzip_level = int(gzip_level)
+        self.renderers = {"json": _json, "yaml": _yaml}
+        self._lock = threading.Lock()
+        # fmt -> [etag, body, gzipped body or None]
+        self._bodies = {}
+
+    def get(self, fmt, gzipped=False):
+        """return (etag, last_modified epoch, body bytes) of the current snapshot"""
+        etag, last_modified, stats = self.stats.get_snapshot()
+        entry = self._bodies.get(fmt)
+        if entry is None or entry[0] != etag:
+            with self._lock:
+                # another thread may have rendered this version while we waited
+                entry = self._bodies.get(fmt)
+                if entry is None or entry[0] != etag:
+                    entry = [etag, self.renderers[fmt](stats), None]
+                    self._bodies[fmt] = entry
+        if not gzipped:
+            return etag, last_modified, entry[1]
+        if entry[2] is None:
+            # mtime 0 keeps the bytes identical for the same body
+            entry[2] = gzip.compress(entry[1], self.gzip_level, mtime=0)
+        return f"{etag}-gz", last_modified, entry[2]
@@ -1,111 +1,605 @@
 """ manages a dictionary of system stats """
 import os
+import sys
 import time
 import platform
+import threading
+from collections import namedtuple
 import psutil
-from dateutil.relativedelta import relativedelta
+from .history import DEFAULT_TIERS, History, parse_tiers
 from .logger import get_logger
+from .timings import get_timings
+
+
+TIMINGS = get_timings()
+COLLECTORS = ("auto", "proc", "psutil")
+MiB = 1024 * 1024
+# named like psutil's linux tuples so str() of them reads the same as before
+# pylint: disable=invalid-name
+scputimes = namedtuple(
+    "scputimes", "user nice system idle iowait irq softirq steal guest guest_nice"
+)
+scpustats = namedtuple("scpustats", "ctx_switches interrupts soft_interrupts syscalls")
+svmem = namedtuple(
+    "svmem", "total available percent used free active inactive buffers cached shared slab"
+)
+sswap = namedtuple("sswap", "total used free percent sin sout")
+# pylint: enable=invalid-name
+MEMINFO_KEYS = (
+    b"MemTotal:", b"MemFree:", b"MemAvailable:", b"Buffers:", b"Cached:", b"SReclaimable:",
+    b"Shmem:", b"Active:", b"Inactive:", b"Slab:", b"SwapTotal:", b"SwapFree:",
+)
+
+
+def _percent(part, total):
+    """part of total in percent with one decimal, 0 for an empty total"""
+    return round(part / total * 100, 1) if total > 0 else 0.0
+
+
+def _cpu_total(times):
+    """total cpu time, guest time is already accounted in user and nice on linux"""
+    return sum(times) - getattr(times, "guest", 0) - getattr(times, "guest_nice", 0)
+
+
+def _cpu_deltas(prev, cur):
+    """field wise cpu time deltas, counters can step back a little so clamp at 0"""
+    return type(cur)(*(max(after - before, 0) for before, after in zip(prev, cur)))
+
+
+def cpu_percent(prev, cur):
+    """busy percent between two cpu_times tuples, same math as psutil.cpu_percent"""
+    deltas = _cpu_deltas(prev, cur)
+    busy = _cpu_total(deltas) - deltas.idle - getattr(deltas, "iowait", 0)
+    return min(max(_percent(busy, _cpu_total(deltas)), 0.0), 100.0)
+
+
+def cpu_times_percent(prev, cur):
+    """per field percent between two cpu_times tuples, same math as psutil.cpu_times_percent"""
+    deltas = _cpu_deltas(prev, cur)
+    scale = 100.0 / max(1, _cpu_total(deltas))
+    return type(cur)(*(min(max(round(val * scale, 1), 0.0), 100.0) for val in deltas))
+
+
+class ProcFile:
+    """a /proc or cgroup file kept open and re-read from offset 0 with pread"""
+
+    def __init__(self, path, size=8192):
+        self.path = path
+        self.size = size
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+
+    def read(self) -> bytes:
+        """the whole current content"""
+        data = os.pread(self.fd, self.size, 0)
+        # grow until the file fits, /proc/stat is long on big hosts
+        while len(data) >= self.size:
+            self.size *= 2
+            data = os.pread(self.fd, self.size, 0)
+        return data
+
+    def close(self):
+        """close the descriptor"""
+        os.close(self.fd)
+
+
+def _cgroup_dir():
+    """this process's cgroup v2 directory or None"""
+    try:
+        with open("/proc/self/cgroup", "rb") as fh:
+            paths = [line.strip()[3:] for line in fh if line.startswith(b"0::")]
+        with open("/proc/self/mountinfo", "rb") as fh:
+            mounts = [
+                line.split()[4]
+                for line in fh
+                if line.split(b" - ", 1)[-1].startswith(b"cgroup2 ")
+            ]
+    except OSError:
+        return None
+    for mount in mounts:
+        # inside a cgroup namespace the own cgroup is the mount root
+        for candidate in [mount + path for path in paths if path != b"/"] + [mount]:
+            if os.path.exists(os.path.join(candidate, b"memory.current")) or os.path.exists(
+                os.path.join(candidate, b"cpu.stat")
+            ):
+                return candidate.decode()
+    return None
+
+
+def _int_or_none(value):
+    """cgroup limit value, 'max' is no limit"""
+    return None if value == b"max" else int(value)
+
+
+class PsutilCollector:
+    """portable collector on top of psutil"""
+
+    name = "psutil"
+
+    def cpu_times(self):
+        """(system wide, [per cpu]) cpu times in seconds"""
+        return psutil.cpu_times(), psutil.cpu_times(percpu=True)
+
+    def cpu_stats(self):
+        """context switch and interrupt counters"""
+        return psutil.cpu_stats()
+
+    def loadavg(self):
+        """1, 5 and 15 minute load averages"""
+        return psutil.getloadavg()
+
+    def memory(self):
+        """(virtual memory, swap memory) tuples"""
+        return psutil.virtual_memory(), psutil.swap_memory()
+
+    def cgroup_cpu(self):
+        """cgroup v2 cpu limit and throttling, empty when unknown"""
+        return {}
+
+    def cgroup_memory(self):
+        """cgroup v2 memory usage, limit and pressure, empty when unknown"""
+        return {}
+
+    def close(self):
+        """nothing to release"""
+
+
+class ProcCollector:
+    """linux collector reading /proc and the cgroup v2 files over descriptors kept open
+
+    Every read is a single pread of a procfs or cgroupfs file and the
+    parsing is plain bytes splitting, cheaper than psutil which opens
+    and parses each file per call and knows nothing about the pod's
+    cgroup limits.
+    """
+
+    name = "proc"
+    CGROUP_FILES = ("cpu.max", "cpu.stat", "memory.current", "memory.max", "memory.pressure")
+
+    def __init__(self):
+        self.log = get_logger()
+        self.clk_tck = os.sysconf("SC_CLK_TCK")
+        self.files = {}
+        try:
+            for name in ("stat", "meminfo", "vmstat"):
+                self.files[name] = ProcFile(f"/proc/{name}")
+        except OSError:
+            self.close()
+            raise
+        self.cgroup_dir = _cgroup_dir()
+        if self.cgroup_dir:
+            for name in self.CGROUP_FILES:
+                try:
+                    self.files[name] = ProcFile(os.path.join(self.cgroup_dir, name))
+                except OSError:
+                    # controller not enabled for this cgroup
+                    pass
+
+    @staticmethod
+    def available():
+        """whether this platform has the files and pread"""
+        return sys.platform.startswith("linux") and hasattr(os, "pread") and os.path.exists(
+            "/proc/stat"
+        )
+
+    def _read(self, name):
+        """content of a kept open file, None when it is not available"""
+        proc_file = self.files.get(name)
+        return proc_file.read() if proc_file else None
+
+    def _keyed(self, name, keys):
+        """{key: int} of the lines starting with key, for meminfo, vmstat and cpu.stat"""
+        # find each wanted line instead of splitting all of them, vmstat has ~180
+        data = b"\n" + self._read(name)
+        values = {}
+        for key in keys:
+            pos = data.find(b"\n" + key)
+            if pos < 0:
+                continue
+            end = data.find(b"\n", pos + 1)
+            fields = data[pos + len(key) + 1:end if end > 0 else len(data)].split()
+            if fields:
+                values[key.rstrip(b": ")] = int(fields[0])
+        return values
+
+    def cpu_times(self):
+        """(system wide, [per cpu]) cpu times in seconds from /proc/stat"""
+        total = None
+        percpu = []
+        for line in self._read("stat").split(b"\n"):
+            if not line.startswith(b"cpu"):
+                # the cpu lines come first
+                break
+            fields = line.split()
+            vals = [int(val) / self.clk_tck for val in fields[1:11]]
+            times = scputimes(*(vals + [0.0] * (10 - len(vals))))
+            if fields[0] == b"cpu":
+                total = times
+            else:
+                percpu.append(times)
+        return total, percpu
+
+    def cpu_stats(self):
+        """context switch and interrupt counters from /proc/stat"""
+        counters = {}
+        for line in self._read("stat").split(b"\n"):
+            fields = line.split(None, 2)
+            if len(fields) >= 2 and fields[0] in (b"ctxt", b"intr", b"softirq"):
+                counters[fields[0]] = int(fields[1])
+        return scpustats(
+            counters.get(b"ctxt", 0), counters.get(b"intr", 0), counters.get(b"softirq", 0), 0
+        )
+
+    def loadavg(self):
+        """1, 5 and 15 minute load averages"""
+        # libc's getloadavg parses /proc/loadavg in C, quicker than a pread plus split here
+        return os.getloadavg()
+
+    def memory(self):
+        """(virtual memory, swap memory) from /proc/meminfo, same math as psutil"""
+        mem = {key: val * 1024 for key, val in self._keyed("meminfo", MEMINFO_KEYS).items()}
+        total = mem.get(b"MemTotal", 0)
+        free = mem.get(b"MemFree", 0)
+        available = mem.get(b"MemAvailable", free)
+        if available > total:
+            available = free
+        vmem = svmem(
+            total,
+            available,
+            _percent(total - available, total),
+            total - available,
+            free,
+            mem.get(b"Active", 0),
+            mem.get(b"Inactive", 0),
+            mem.get(b"Buffers", 0),
+            mem.get(b"Cached", 0) + mem.get(b"SReclaimable", 0),
+            mem.get(b"Shmem", 0),
+            mem.get(b"Slab", 0),
+        )
+        vmstat = self._keyed("vmstat", (b"pswpin ", b"pswpout "))
+        swap_total = mem.get(b"SwapTotal", 0)
+        swap_free = mem.get(b"SwapFree", 0)
+        swap = sswap(
+            swap_total,
+            swap_total - swap_free,
+            swap_free,
+            _percent(swap_total - swap_free, swap_total),
+            # psutil counts swapped pages as 4 KiB too
+            vmstat.get(b"pswpin", 0) * 4096,
+            vmstat.get(b"pswpout", 0) * 4096,
+        )
+        return vmem, swap
+
+    def cgroup_cpu(self):
+        """cgroup v2 cpu limit in cpus and throttling counters, empty when unknown"""
+        out = {}
+        cpu_max = self._read("cpu.max")
+        if cpu_max:
+            quota, period = cpu_max.split()[:2]
+            out["cpu_limit"] = None if quota == b"max" else round(int(quota) / int(period), 3)
+        if "cpu.stat" in self.files:
+            stat = self._keyed(
+                "cpu.stat", (b"usage_usec ", b"nr_periods ", b"nr_throttled ", b"throttled_usec ")
+            )
+            out["cpu_usage_seconds"] = stat.get(b"usage_usec", 0) / 1e6
+            out["cpu_nr_periods"] = stat.get(b"nr_periods", 0)
+            out["cpu_nr_throttled"] = stat.get(b"nr_throttled", 0)
+            out["cpu_throttled_seconds"] = stat.get(b"throttled_usec", 0) / 1e6
+        return out
+
+    def cgroup_memory(self):
+        """cgroup v2 memory usage, limit and pressure, empty when unknown"""
+        out = {}
+        current = self._read("memory.current")
+        if current:
+            out["memory_current"] = int(current)
+        limit = self._read("memory.max")
+        if limit:
+            out["memory_max"] = _int_or_none(limit.strip())
+        pressure = self._read("memory.pressure")
+        if pressure:
+            # some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+            for line in pressure.split(b"\n"):
+                fields = line.split()
+                if not fields:
+                    continue
+                kind = fields[0].decode()
+                for field in fields[1:]:
+                    key, _, val = field.partition(b"=")
+                    if key.startswith(b"avg"):
+                        out[f"memory_pressure_{kind}_{key.decode()}"] = float(val)
+        return out
+
+    def close(self):
+        """close every kept open descriptor"""
+        for proc_file in self.files.values():
+            proc_file.close()
+        self.files = {}
+
+
+def get_collector(kind="auto"):
+    """the /proc collector on linux unless kind is psutil, psutil elsewhere"""
+    if kind != "psutil" and ProcCollector.available():
+        try:
+            return ProcCollector()
+        except OSError as err:
+            get_logger().warning("stats: /proc collector unavailable, using psutil: %s", err)
+    return PsutilCollector()
+
+
+class CpuSampler:
+    """samples cpu usage deltas on a fixed interval in a background thread"""
+
+    def __init__(self, interval=1.0, history=None, collector=None):
+        self.interval = max(float(interval), 0.1)
+        self.history = history
+        self.collector = collector or PsutilCollector()
+        self.sample = None
+        self.generation = 0
+        self._stop = threading.Event()
+        # the first sample covers one full interval from here
+        self._times = self.collector.cpu_times()
+        self.thread = threading.Thread(
+            target=self._run, name="pystats-cpu-sampler", daemon=True
+        )
+        self.thread.start()
+
+    def _run(self):
+        """sampler thread main loop"""
+        while not self._stop.wait(self.interval):
+            prev_total, prev_percpu = self._times
+            total, percpu = self._times = self.collector.cpu_times()
+            # the dict is swapped in whole so readers never see a partial sample
+            self.sample = {
+                "cpu_percent": cpu_percent(prev_total, total),
+                "cpu_percent_percpu": [
+                    cpu_percent(before, after) for before, after in zip(prev_percpu, percpu)
+                ],
+                "cpu_times_percent": cpu_times_percent(prev_total, total),
+                "monotonic": time.monotonic(),
+            }
+            self.generation += 1
+            if self.history:
+                self._record(self.sample)
+
+    def _record(self, sample):
+        """add the sample plus load and memory to the history"""
+        percpu = sample["cpu_percent_percpu"]
+        # names are fixed at startup: 3 load averages, cpu_percent, one per cpu
+        # and 2 memory series, pad or cut the per cpu values if cpus come and go
+        ncpu = len(self.history.names) - 6
+        percpu = (list(percpu) + [0.0] * ncpu)[:ncpu]
+        vmem, _ = self.collector.memory()
+        self.history.add(
+            time.time(),
+            list(self.collector.loadavg())
+            + [sample["cpu_percent"]]
+            + percpu
+            + [vmem.used / MiB, vmem.free / MiB],
+        )
+
+    def get_sample(self):
+        """return the latest sample and its age in seconds"""
+        sample = self.sample
+        if sample is None:
+            return None, None
+        return sample, round(time.monotonic() - sample["monotonic"], 3)
+
+    def stop(self):
+        """stop the sampler thread"""
+        self._stop.set()
+        self.thread.join()
 
 
 class Stats:
     """manages a dictionary of system stats"""
 
-    def __init__(self):
+    def __init__(
+        self,
+        cpu_interval=1.0,
+        uptime_ttl=1.0,
+        mem_ttl=1.0,
+        cpu_ttl=1.0,
+        history_tiers=DEFAULT_TIERS,
+        collector="auto",
+    ):
         self.stats = {}
         self.log = get_logger()
+        self.collector = get_collector(collector)
+        self.history = None
+        tiers = parse_tiers(history_tiers)
+        if tiers:
+            names = ["load_1m", "load_5m", "load_15m", "cpu_percent"]
+            names += [f"cpu{idx}_percent" for idx in range(psutil.cpu_count(logical=True) or 1)]
+            names += ["mem_used_MiB", "mem_free_MiB"]
+            self.history = History(names, tiers)
+        self.cpu_sampler = CpuSampler(cpu_interval, self.history, self.collector)
+        self.ttls = {
+            "uptime": float(uptime_ttl),
+            "mem": float(mem_ttl),
+            "cpu": float(cpu_ttl),
+        }
+        self.collectors = {
+            "uptime": self._collect_uptime,
+            "mem": self._collect_mem,
+            "cpu": self._collect_cpu,
+        }
+        # group name -> (expires monotonic, group version, data)
+        self._groups = {}
+        # (fast, labels) -> (versions of the groups it was built from, snapshot)
+        self._snapshots = {}
+        self.version = 0
+        self.last_modified = time.time()
+        self.etag_prefix = f"{os.getpid():x}{time.time_ns():x}"
+        self._lock = threading.Lock()
+        self._create_time = psutil.Process(os.getpid()).create_time()
+        self._boot_time = psutil.boot_time()
+        self._static = self._collect_static()
+        self._memory = self.collector.memory() + ({},)
 
-    def _refresh_stats(self, fast=False, labels=[]):
-        """fetch the system stats"""
-        self.stats = {}
-        self.stats["info"] = {}
-        self.stats["uptime"] = {}
-        self.stats["cpu"] = {}
-        self.stats["mem"] = {}
-        for label in labels:
-            if len(label.split("=")) == 2:
-                self.stats["info"][str(label.split("=")[0])] = str(label.split("=")[1])
-        self.stats["info"]["hostname"] = os.uname()[1]
-        self.stats["info"]["platform"] = self._get_platform_var(platform.platform)
-        self.stats["info"]["uname"] = str(self._get_platform_var(platform.uname))
-        self.stats["uptime"]["process_seconds"] = self._get_proc_uptime_sec()
-        self.stats["uptime"]["process_uptime"] = self._get_uptime_human_readable(
-            self.stats["uptime"]["process_seconds"]
+    def close(self):
+        """stop the background cpu sampler and release the collector"""
+        self.cpu_sampler.stop()
+        self.collector.close()
+
+    @TIMINGS.timed("stats", "static")
+    def _collect_static(self):
+        """values that never change for the lifetime of the process"""
+        static = {"info": {}, "info_full": {}, "cpu": {}}
+        static["info"]["hostname"] = os.uname()[1]
+        static["info"]["platform"] = self._get_platform_var(platform.platform)
+        static["info"]["uname"] = str(self._get_platform_var(platform.uname))
+        static["cpu"]["cpu_count_logical"] = psutil.cpu_count(logical=True)
+        static["cpu"]["cpu_count"] = psutil.cpu_count(logical=False)
+        full = static["info_full"]
+        full["architecture"] = str(self._get_platform_var(platform.architecture))
+        full["machine"] = self._get_platform_var(platform.machine)
+        full["node"] = self._get_platform_var(platform.node)
+        full["processor"] = self._get_platform_var(platform.processor)
+        full["python_build"] = str(self._get_platform_var(platform.python_build))
+        full["python_compiler"] = self._get_platform_var(platform.python_compiler)
+        full["python_branch"] = self._get_platform_var(platform.python_branch)
+        full["python_implementation"] = self._get_platform_var(
+            platform.python_implementation
         )
-        self.stats["uptime"]["system_seconds"] = self._get_sys_uptime_sec()
-        self.stats["uptime"]["system_uptime"] = self._get_uptime_human_readable(
-            self.stats["uptime"]["system_seconds"]
+        full["python_revision"] = self._get_platform_var(platform.python_revision)
+        full["python_version"] = self._get_platform_var(platform.python_version)
+        full["release"] = self._get_platform_var(platform.release)
+        full["system"] = self._get_platform_var(platform.system)
+        full["version"] = self._get_platform_var(platform.version)
+        full["freedesktop_os_release"] = self._get_platform_var(
+            platform.freedesktop_os_release
         )
-        if not fast:
-            self.stats["cpu"]["load_1m"] = psutil.getloadavg()[0]
-            self.stats["cpu"]["load_5m"] = psutil.getloadavg()[1]
-            self.stats["cpu"]["load_15m"] = psutil.getloadavg()[2]
-            self.stats["cpu"]["cpu_count_logical"] = psutil.cpu_count(logical=True)
-            self.stats["cpu"]["cpu_count"] = psutil.cpu_count(logical=False)
-            self.stats["cpu"]["cpu_times"] = str(psutil.cpu_times())
-            self.stats["cpu"]["cpu_times_percent"] = str(psutil.cpu_times_percent())
-            self.stats["cpu"]["cpu_percent"] = psutil.cpu_percent(interval=1)
-            self.stats["cpu"]["cpu_percent_percpu"] = psutil.cpu_percent(
-                interval=1, percpu=True
-            )
-            self.stats["cpu"]["cpu_stats"] = str(psutil.cpu_stats())
+        full["system_alias"] = self._get_platform_system_alias()
+        return static
 
-            self.stats["mem"]["virtual_memory"] = str(psutil.virtual_memory())
-            self.stats["mem"]["swap_memory"] = str(psutil.swap_memory())
-            self.stats["mem"]["mem_total_MiB"] = int(
-                psutil.virtual_memory()[0] / (1024 * 1024)
-            )
-            self.stats["mem"]["mem_used_MiB"] = int(
-                psutil.virtual_memory()[3] / (1024 * 1024)
-            )
-            self.stats["mem"]["mem_free_MiB"] = int(
-                psutil.virtual_memory()[4] / (1024 * 1024)
-            )
-            self.stats["mem"]["mem_swap_total_MiB"] = int(
-                psutil.virtual_memory()[0] / (1024 * 1024)
-            )
-            self.stats["mem"]["mem_swap_used_MiB"] = int(
-                psutil.virtual_memory()[1] / (1024 * 1024)
-            )
-            self.stats["mem"]["mem_swap_free_MiB"] = int(
-                psutil.virtual_memory()[2] / (1024 * 1024)
-            )
+    @TIMINGS.timed("stats", "uptime")
+    def _collect_uptime(self):
+        """uptime group"""
+        uptime = {}
+        uptime["process_seconds"] = self._get_proc_uptime_sec()
+        uptime["process_uptime"] = self._get_uptime_human_readable(
+            uptime["process_seconds"]
+        )
+        uptime["system_seconds"] = self._get_sys_uptime_sec()
+        uptime["system_uptime"] = self._get_uptime_human_readable(
+            uptime["system_seconds"]
+        )
+        return uptime
 
+    @TIMINGS.timed("stats", "cpu")
+    def _collect_cpu(self):
+        """cpu group"""
+        cpu = {}
+        load = self.collector.loadavg()
+        cpu["load_1m"] = load[0]
+        cpu["load_5m"] = load[1]
+        cpu["load_15m"] = load[2]
+        cpu["cpu_count_logical"] = self._static["cpu"]["cpu_count_logical"]
+        cpu["cpu_count"] = self._static["cpu"]["cpu_count"]
+        cpu["cpu_times"] = str(self.collector.cpu_times()[0])
+        cpu_sample, cpu_sample_age = self.cpu_sampler.get_sample()
+        if cpu_sample:
+            cpu["cpu_times_percent"] = str(cpu_sample["cpu_times_percent"])
+            cpu["cpu_percent"] = cpu_sample["cpu_percent"]
+            cpu["cpu_percent_percpu"] = cpu_sample["cpu_percent_percpu"]
+        else:
+            cpu["cpu_times_percent"] = None
+            cpu["cpu_percent"] = None
+            cpu["cpu_percent_percpu"] = None
+        cpu["cpu_sample_age_seconds"] = cpu_sample_age
+        cpu["cpu_stats"] = str(self.collector.cpu_stats())
+        cgroup = self.collector.cgroup_cpu()
+        cpu["cgroup_cpu_limit"] = cgroup.get("cpu_limit")
+        cpu["cgroup_cpu_nr_throttled"] = cgroup.get("cpu_nr_throttled")
+        cpu["cgroup_cpu_throttled_seconds"] = cgroup.get("cpu_throttled_seconds")
+        return cpu
 
-            self.stats["info"]["architecture"] = str(self._get_platform_var(
-                platform.architecture
-            ))
-            self.stats["info"]["machine"] = self._get_platform_var(platform.machine)
-            self.stats["info"]["node"] = self._get_platform_var(platform.node)
-            self.stats["info"]["processor"] = self._get_platform_var(platform.processor)
-            self.stats["info"]["python_build"] = str(self._get_platform_var(
-                platform.python_build
-            ))
-            self.stats["info"]["python_compiler"] = self._get_platform_var(
-                platform.python_compiler
-            )
-            self.stats["info"]["python_branch"] = self._get_platform_var(
-                platform.python_branch
-            )
-            self.stats["info"]["python_implementation"] = self._get_platform_var(
-                platform.python_implementation
-            )
-            self.stats["info"]["python_revision"] = self._get_platform_var(
-                platform.python_revision
-            )
-            self.stats["info"]["python_version"] = self._get_platform_var(
-                platform.python_version
-            )
-            self.stats["info"]["release"] = self._get_platform_var(platform.release)
-            self.stats["info"]["system"] = self._get_platform_var(platform.system)
-            self.stats["info"]["version"] = self._get_platform_var(platform.version)
-            self.stats["info"]["freedesktop_os_release"] = self._get_platform_var(
-                platform.freedesktop_os_release
-            )
-            self.stats["info"]["system_alias"] = self._get_platform_system_alias()
+    @TIMINGS.timed("stats", "mem")
+    def _collect_mem(self):
+        """mem group"""
+        mem = {}
+        vmem, swap = self.collector.memory()
+        mem["virtual_memory"] = str(vmem)
+        mem["swap_memory"] = str(swap)
+        mem["mem_total_MiB"] = int(vmem.total / MiB)
+        mem["mem_used_MiB"] = int(vmem.used / MiB)
+        mem["mem_free_MiB"] = int(vmem.free / MiB)
+        mem["mem_swap_total_MiB"] = int(swap.total / MiB)
+        mem["mem_swap_used_MiB"] = int(swap.used / MiB)
+        mem["mem_swap_free_MiB"] = int(swap.free / MiB)
+        cgroup = self.collector.cgroup_memory()
+        current = cgroup.get("memory_current")
+        limit = cgroup.get("memory_max")
+        mem["cgroup_mem_current_MiB"] = int(current / MiB) if current is not None else None
+        mem["cgroup_mem_max_MiB"] = int(limit / MiB) if limit is not None else None
+        mem["cgroup_mem_pressure_some_avg10"] = cgroup.get("memory_pressure_some_avg10")
+        mem["cgroup_mem_pressure_full_avg10"] = cgroup.get("memory_pressure_full_avg10")
+        # kept for get_memory so /metrics does not read meminfo again
+        self._memory = (vmem, swap, cgroup)
+        return mem
+
+    def _get_group(self, name):
+        """return (version, data) of a group, refreshing it once its ttl expired"""
+        now = time.monotonic()
+        group = self._groups.get(name)
+        if group and group[0] > now:
+            return group[1], group[2]
+        data = self.collectors[name]()
+        if group and group[2] == data:
+            version = group[1]
+        else:
+            self.version += 1
+            self.last_modified = time.time()
+            version = self.version
+        self._groups[name] = (now + self.ttls[name], version, data)
+        return version, data
+
+    def _refresh_stats(self, fast=False, labels=[]):
+        """return the (version, stats) snapshot, rebuilding it only when a group changed"""
+        key = (fast, tuple(labels))
+        with self._lock:
+            names = ("uptime",) if fast else ("uptime", "cpu", "mem")
+            groups = {name: self._get_group(name) for name in names}
+            versions = tuple(groups[name][0] for name in names)
+            cached = self._snapshots.get(key)
+            if cached and cached[0] == versions:
+                return max(versions), cached[1]
+            stats = {"info": {}, "uptime": {}, "cpu": {}, "mem": {}}
+            for label in labels:
+                if len(label.split("=")) == 2:
+                    stats["info"][str(label.split("=")[0])] = str(label.split("=")[1])
+            stats["info"].update(self._static["info"])
+            stats["uptime"] = groups["uptime"][1]
+            if not fast:
+                stats["cpu"] = groups["cpu"][1]
+                stats["mem"] = groups["mem"][1]
+                stats["info"].update(self._static["info_full"])
+            self._snapshots[key] = (versions, stats)
+            return max(versions), stats
+
+    def get_snapshot(self, fast=False, labels=[]):
+        """return (etag, last_modified epoch, stats) for conditional responses"""
+        version, stats = self._refresh_stats(fast, labels)
+        etag = f"{self.etag_prefix}-{int(fast)}-{version}"
+        return etag, self.last_modified, stats
+
+    def get_generation(self):
+        """return a counter that changes every time a new cpu sample is taken"""
+        return self.cpu_sampler.generation
+
+    def get_memory(self):
+        """return the virtual and swap memory named tuples of the last mem refresh"""
+        return self._memory[:2]
+
+    def get_cgroup(self):
+        """return the cgroup v2 cpu and memory values, empty when not in a cgroup v2"""
+        cgroup = self.collector.cgroup_cpu()
+        cgroup.update(self._memory[2])
+        return cgroup
 
     def get_stats(self, fast=False, labels=[]):
-        """return the stats dictionary"""
-        self._refresh_stats(fast, labels)
+        """return the cached stats snapshot, treat it as read only"""
+        self.stats = self._refresh_stats(fast, labels)[1]
         return self.stats
 
     def _get_platform_var(self, func):
@@ -127,12 +621,14 @@ class Stats:
         return var if var else None
 
     def _get_proc_uptime_sec(self):
-        return int(time.time()) - int(psutil.Process(os.getpid()).create_time())
+        return int(time.time()) - int(self._create_time)
 
     def _get_sys_uptime_sec(self):
-        return int(time.time() - psutil.boot_time())
+        return int(time.time() - self._boot_time)
 
     def _get_uptime_human_readable(self, in_seconds):
         """Takes seconds and turns it into a human readable string"""
+        # imported on first use to keep it off the startup path
+        from dateutil.relativedelta import relativedelta  # pylint: disable=import-outside-toplevel
         fmt = "{0.days} days {0.hours} hours {0.minutes} minutes {0.seconds} seconds"
         return fmt.format(relativedelta(seconds=in_seconds))
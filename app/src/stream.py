@@ -0,0 +1,159 @@
+""" server-sent events of the stats snapshot, sampled once and fanned out to every subscriber """
+import json
+import queue
+import threading
+from .logger import get_logger
+
+
+# events a subscriber may fall behind before it is dropped
+QUEUE_EVENTS = 8
+# seconds between comment lines on an idle stream, they also notice gone clients
+KEEPALIVE = 15.0
+
+
+def merge_patch(old, new):
+    """ RFC 7396 merge patch turning old into new, lists are replaced whole """
+    patch = {}
+    for key, value in new.items():
+        before = old.get(key)
+        if isinstance(value, dict) and isinstance(before, dict):
+            sub = merge_patch(before, value)
+            if sub:
+                patch[key] = sub
+        elif key not in old or before != value:
+            patch[key] = value
+    for key in old.keys() - new.keys():
+        patch[key] = None
+    return patch
+
+
+def _event(name, seq, data):
+    """ one encoded server-sent event """
+    body = json.dumps(data, separators=(",", ":"), sort_keys=True)
+    return f"id: {seq}\nevent: {name}\ndata: {body}\n\n".encode("utf-8")
+
+
+class StatsStream:
+    """Samples the stats snapshot every interval and fans the changes out to /stream subscribers
+
+    A subscriber first gets the whole snapshot as a snapshot event, then
+    update events carrying a merge patch of what changed. Each event is
+    encoded once for all subscribers and queued to each without
+    blocking; a subscriber whose queue is full is dropped so a slow
+    client never holds up the others. The sampler thread idles while
+    there are no subscribers.
+    """
+
+    def __init__(self, stats, interval=1.0, max_clients=2):
+        """Initialize the stream and start the sampler thread"""
+        self.log = get_logger()
+        self.stats = stats
+        self.interval = max(float(interval), 0.1)
+        self.max_clients = max(int(max_clients), 1)
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._etag = None
+        self._last = None
+        self._seq = 0
+        self._full = None
+        self.connects = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.events = 0
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="pystats-stream", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """sampler thread main loop"""
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                if self._subscribers:
+                    self._publish()
+
+    def _publish(self):
+        """ take the current snapshot and queue its changes to every subscriber, caller holds the lock """
+        etag, _, stats = self.stats.get_snapshot()
+        if etag == self._etag:
+            return
+        patch = merge_patch(self._last, stats) if self._last is not None else None
+        self._etag, self._last, self._full = etag, stats, None
+        self._seq += 1
+        if not patch or not self._subscribers:
+            return
+        event = _event("update", self._seq, patch)
+        self.events += 1
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                self._drop(subscriber)
+                self.dropped += 1
+                self.log.info("stream: dropped a subscriber %s events behind", QUEUE_EVENTS)
+
+    def _drop(self, subscriber):
+        """ forget a subscriber and make its events() end, caller holds the lock """
+        self._subscribers.discard(subscriber)
+        # only the lock holder puts, so emptying makes room for the end marker
+        while True:
+            try:
+                subscriber.get_nowait()
+            except queue.Empty:
+                break
+        subscriber.put_nowait(None)
+
+    def subscribe(self):
+        """ a queue of encoded events starting with the whole snapshot, None when max_clients are connected """
+        with self._lock:
+            if self._stop.is_set() or len(self._subscribers) >= self.max_clients:
+                self.rejected += 1
+                return None
+            self._publish()
+            if self._full is None:
+                self._full = _event("snapshot", self._seq, self._last)
+            subscriber = queue.Queue(QUEUE_EVENTS)
+            subscriber.put_nowait(self._full)
+            self._subscribers.add(subscriber)
+            self.connects += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """ forget a subscriber that went away """
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def iter_events(self, subscriber):
+        """ yield the encoded events of a subscriber until it is dropped or the stream stops """
+        try:
+            while True:
+                try:
+                    event = subscriber.get(timeout=KEEPALIVE)
+                except queue.Empty:
+                    yield b": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                yield event
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stop(self):
+        """stop the sampler thread and end every subscriber's events"""
+        self._stop.set()
+        self.thread.join()
+        with self._lock:
+            for subscriber in list(self._subscribers):
+                self._drop(subscriber)
+
+    def as_dict(self):
+        """ subscriber and event counters for /debug/timings and /metrics """
+        with self._lock:
+            clients = len(self._subscribers)
+        return {
+            "clients": clients,
+            "max_clients": self.max_clients,
+            "connects": self.connects,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "events": self.events,
+        }
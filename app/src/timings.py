@@ -0,0 +1,186 @@
+""" latency histograms for routes, sql calls and stats collectors, startup phases """
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+
+# upper bounds in seconds, the last bucket is +Inf
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Timings:
+    """Per thread latency histograms merged on read, so recording never takes a lock"""
+
+    def __init__(self):
+        self.enabled = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stores = []
+
+    def _store(self):
+        """ this thread's {(kind, name): [bucket counts, sum, count, max]} """
+        store = getattr(self._local, "store", None)
+        if store is None:
+            store = self._local.store = {}
+            # the only lock: once per thread to make its store visible to readers
+            with self._lock:
+                self._stores.append(store)
+        return store
+
+    def record(self, kind, name, seconds):
+        """ add one observation """
+        store = self._store()
+        hist = store.get((kind, name))
+        if hist is None:
+            hist = store[(kind, name)] = [[0] * (len(BUCKETS) + 1), 0.0, 0, 0.0]
+        hist[0][bisect_left(BUCKETS, seconds)] += 1
+        hist[1] += seconds
+        hist[2] += 1
+        if seconds > hist[3]:
+            hist[3] = seconds
+
+    def timed(self, kind, name=None):
+        """ decorator recording the wall time of every call when enabled """
+        def decorator(func):
+            label = name or func.__name__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(kind, label, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """ merge every thread's store: {(kind, name): [bucket counts, sum, count, max]} """
+        with self._lock:
+            stores = list(self._stores)
+        merged = {}
+        for store in stores:
+            # copy first, the owning thread may add keys while we read
+            for key, hist in list(store.items()):
+                total = merged.get(key)
+                if total is None:
+                    total = merged[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0, 0.0]
+                for idx, count in enumerate(hist[0]):
+                    total[0][idx] += count
+                total[1] += hist[1]
+                total[2] += hist[2]
+                total[3] = max(total[3], hist[3])
+        return merged
+
+    def as_dict(self):
+        """ json friendly {kind: {name: summary}} """
+        out = {}
+        for (kind, name), (counts, total, count, slowest) in sorted(self.snapshot().items()):
+            buckets = {}
+            running = 0
+            for bound, bucket in zip(BUCKETS + ("+Inf",), counts):
+                running += bucket
+                buckets[str(bound)] = running
+            out.setdefault(kind, {})[name] = {
+                "count": count,
+                "sum_seconds": round(total, 6),
+                "mean_ms": round(total / count * 1000, 4) if count else 0,
+                "max_ms": round(slowest * 1000, 4),
+                "buckets": buckets,
+            }
+        return out
+
+    def as_prometheus(self):
+        """ prometheus histogram text exposition """
+        lines = [
+            "# HELP pystats_timing_seconds Latency of pystats routes, sql calls and stats collectors.",
+            "# TYPE pystats_timing_seconds histogram",
+        ]
+        for (kind, name), (counts, total, count, _) in sorted(self.snapshot().items()):
+            name = str(name).replace("\\", "\\\\").replace('"', '\\"')
+            labels = f'kind="{kind}",name="{name}"'
+            running = 0
+            for bound, bucket in zip(BUCKETS + ("+Inf",), counts):
+                running += bucket
+                lines.append(f'pystats_timing_seconds_bucket{{{labels},le="{bound}"}} {running}')
+            lines.append(f"pystats_timing_seconds_sum{{{labels}}} {total}")
+            lines.append(f"pystats_timing_seconds_count{{{labels}}} {count}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+class Startup:
+    """Wall time of the startup phases as offsets from origin, phases may overlap across threads"""
+
+    def __init__(self, origin=None):
+        self.origin = time.perf_counter() if origin is None else origin
+        self.ready_at = None
+        self._lock = threading.Lock()
+        self._phases = []
+
+    def add(self, name, started, ended=None):
+        """ record a phase from perf_counter values """
+        ended = time.perf_counter() if ended is None else ended
+        with self._lock:
+            self._phases.append(
+                (name, threading.current_thread().name, started - self.origin, ended - started)
+            )
+
+    @contextmanager
+    def phase(self, name):
+        """ context manager recording the wall time of the block """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, started)
+
+    def ready(self):
+        """ mark the moment the app became ready """
+        self.ready_at = time.perf_counter() - self.origin
+
+    def as_dict(self):
+        """ json friendly phases in start order """
+        with self._lock:
+            phases = sorted(self._phases, key=lambda phase: phase[2])
+        return {
+            "ready_ms": round(self.ready_at * 1000, 3) if self.ready_at is not None else None,
+            "phases": [
+                {
+                    "name": name,
+                    "thread": thread,
+                    "start_ms": round(start * 1000, 3),
+                    "duration_ms": round(duration * 1000, 3),
+                }
+                for name, thread, start, duration in phases
+            ],
+        }
+
+    def report(self):
+        """ one line summary for the log """
+        out = self.as_dict()
+        parts = [f"{phase['name']} {phase['duration_ms']:.1f}ms" for phase in out["phases"]]
+        if out["ready_ms"] is not None:
+            parts.append(f"ready at {out['ready_ms']:.1f}ms")
+        return "startup: " + ", ".join(parts)
+
+
+_TIMINGS = Timings()
+_STARTUP = Startup()
+
+
+def get_timings():
+    """Returns the process wide Timings store"""
+    return _TIMINGS
+
+
+def get_startup():
+    """Returns the process wide Startup phase recorder"""
+    return _STARTUP
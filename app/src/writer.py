@@ -0,0 +1,81 @@
+""" background group-commit writer for the requests table """
+import queue
+import sqlite3
+import threading
+import time
+from .logger import get_logger
+
+
+class RequestWriter:
+    """Drains queued request rows into sqlite with one transaction per batch"""
+
+    _STOP = object()
+
+    def __init__(self, write_rows, batch_size=100, flush_interval=1.0, queue_size=10000):
+        """Initialize the writer and start the background thread
+
+        write_rows is called from the writer thread with each batch and
+        must commit it in one transaction.
+        """
+        self.log = get_logger()
+        self.write_rows = write_rows
+        self.batch_size = max(int(batch_size), 1)
+        self.flush_interval = max(float(flush_interval), 0.01)
+        self.queue = queue.Queue(maxsize=max(int(queue_size), 1))
+        self.thread = threading.Thread(
+            target=self._run, name="pystats-writer", daemon=True
+        )
+        self.thread.start()
+
+    def put(self, req_data) -> bool:
+        """queue a request row, returns False when the queue is full"""
+        try:
+            self.queue.put_nowait(req_data)
+        except queue.Full:
+            return False
+        return True
+
+    def close(self):
+        """flush everything still queued and stop the writer thread"""
+        if not self.thread.is_alive():
+            return
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+    def _next_batch(self):
+        """block for the first row then collect until batch_size or flush_interval"""
+        first = self.queue.get()
+        if first is self._STOP:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                row = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if row is self._STOP:
+                return batch, True
+            batch.append(row)
+        return batch, False
+
+    def _write(self, batch):
+        """write one batch of rows in a single transaction"""
+        try:
+            self.write_rows(batch)
+        except sqlite3.Error as err:
+            self.log.warning("RequestWriter: dropped %s rows: %s", len(batch), err)
+        except Exception:  # pylint: disable=broad-except
+            # a bug must not end the thread, later rows would pile up unwritten
+            self.log.error("RequestWriter: dropped %s rows", len(batch), exc_info=True)
+
+    def _run(self):
+        """writer thread main loop"""
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if batch:
+                self._write(batch)
@@ -0,0 +1,59 @@
+""" shared fixtures: Requests backends on a temporary --db-file """
+import os
+import sys
+import time
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.requests import Requests  # pylint: disable=wrong-import-position
+
+
+def make_rows(count, server_id=1, epoch=None, start=0):
+    """ count request dicts as put_request queues them """
+    epoch = time.time() if epoch is None else epoch
+    return [
+        {
+            "epoch": epoch + idx * 0.001,
+            "remote_address": f"10.0.0.{idx % 7}",
+            "remote_user_agent": f"ua-{idx % 3}",
+            "request_url": f"http://pystats/p{idx % 11}",
+            "server_id": server_id,
+        }
+        for idx in range(start, start + count)
+    ]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """ path of a fresh DB file """
+    return str(tmp_path / "requests.db")
+
+
+@pytest.fixture
+def open_requests(db_path):
+    """ factory of Requests on db_path, closed after the test """
+    opened = []
+
+    def _open(**options):
+        options.setdefault("analytics_interval", 0)
+        reqs = Requests(db_path, **options)
+        opened.append(reqs)
+        return reqs
+
+    yield _open
+    for reqs in opened:
+        reqs.close()
+
+
+@pytest.fixture(scope="session")
+def client(tmp_path_factory):
+    """ flask test client of pystat.py on a temporary --db-file """
+    argv = sys.argv
+    # pystat parses its command line at import
+    sys.argv = ["pystat.py", "-f", str(tmp_path_factory.mktemp("pystat") / "requests.db")]
+    try:
+        import pystat  # pylint: disable=import-outside-toplevel
+    finally:
+        sys.argv = argv
+    return pystat.app.test_client()
@@ -0,0 +1,27 @@
+""" the RequestsBackend interface """
+import pytest
+from src.backend import RequestsBackend, get_backend
+
+
+def test_incomplete_backend_fails_at_creation():
+    """ a backend missing a method is refused before it can serve a route """
+
+    class PartialRequests(RequestsBackend):
+        """ implements only the writes """
+
+        def _insert_rows(self, batch):
+            """ drop the rows """
+
+    with pytest.raises(TypeError, match="get_last_id"):
+        PartialRequests()
+
+
+@pytest.mark.parametrize("kind", ["sqlite", "memory"])
+def test_backends_implement_the_interface(kind, db_path):
+    """ both backends can be created and close cleanly """
+    reqs = get_backend(kind, db_path, analytics_interval=0)
+    try:
+        assert isinstance(reqs, RequestsBackend)
+        assert reqs.get_last_id() == 0
+    finally:
+        reqs.close()
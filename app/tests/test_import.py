@@ -0,0 +1,48 @@
+""" bulk imports against server_totals """
+from conftest import make_rows
+
+
+def _srv_totals(reqs):
+    """ {ServerID: (RequestCount, LastRequestID)} """
+    with reqs.db.connection() as con:
+        return {
+            row[0]: (row[1], row[2])
+            for row in con.execute("SELECT ServerID, RequestCount, LastRequestID FROM server_totals")
+        }
+
+
+def _import_rows(count, start):
+    """ request dicts as src/importer.py yields them, without server info """
+    rows = make_rows(count, server_id=None, start=start)
+    for req_data in rows:
+        req_data.update(hostname=None, ip=None)
+    return rows
+
+
+def test_import_after_retention_keeps_totals(open_requests):
+    """ an import adds its rows on top of the counts of pruned rows """
+    reqs = open_requests(retention_max_rows=100, retention_interval=3600)
+    reqs._insert_rows(make_rows(250, reqs.server_id))
+    assert reqs.retention.run_once() == 150
+    assert _srv_totals(reqs) == {reqs.server_id: (250, 250)}
+    assert reqs.import_requests([_import_rows(10, 250)]) == 10
+    assert _srv_totals(reqs) == {reqs.server_id: (260, 260)}
+    # the trigger is back for the live inserts
+    reqs._insert_rows(make_rows(5, reqs.server_id, start=260))
+    assert _srv_totals(reqs) == {reqs.server_id: (265, 265)}
+
+
+def test_reimport_without_ip_reuses_the_server(open_requests):
+    """ records with a Hostname but no IP map onto one servers row across imports """
+    reqs = open_requests()
+    for start in (0, 10):
+        rows = _import_rows(10, start)
+        for req_data in rows:
+            req_data["hostname"] = "exported-host"
+        assert reqs.import_requests([rows]) == 10
+    with reqs.db.connection() as con:
+        servers = con.execute(
+            "SELECT ServerID, IP FROM servers WHERE Hostname = 'exported-host'"
+        ).fetchall()
+    assert len(servers) == 1 and servers[0][1] == ""
+    assert reqs.get_srv_req_tot(servers[0][0]) == 20
@@ -0,0 +1,59 @@
+""" moving a baseline DB over to dictionary ids """
+import sqlite3
+from contextlib import closing
+from conftest import make_rows
+from src.interning import normalize_requests
+
+
+def _baseline_db(db_path):
+    """ a DB as the first pystats release wrote it, with text columns, returns its rows """
+    with closing(sqlite3.connect(db_path)) as con:
+        with con:
+            con.execute(
+                """CREATE TABLE servers(
+                    ServerID INTEGER PRIMARY KEY AUTOINCREMENT,
+                    Hostname TEXT NOT NULL,
+                    IP TEXT  NOT NULL,
+                    Platform TEXT
+                )"""
+            )
+            con.execute(
+                """CREATE TABLE requests(
+                    RequestID INTEGER PRIMARY KEY AUTOINCREMENT,
+                    Epoch REAL NOT NULL,
+                    RemoteAddress TEXT,
+                    RemoteUserAgent TEXT,
+                    RequestURL TEXT,
+                    ServerID INTEGER,
+                    FOREIGN KEY(ServerID) REFERENCES servers(ServerID)
+                )"""
+            )
+            con.execute("INSERT INTO servers (Hostname, IP, Platform) VALUES ('old', '10.0.0.1', 'x')")
+            con.executemany(
+                """INSERT INTO requests (
+                    Epoch, RemoteAddress, RemoteUserAgent, RequestURL, ServerID
+                ) VALUES (
+                    :epoch, :remote_address, :remote_user_agent, :request_url, :server_id
+                )""",
+                make_rows(30, server_id=1, epoch=1700000000.0),
+            )
+            con.execute("UPDATE requests SET RemoteUserAgent = NULL WHERE RequestID = 3")
+            # the newest ids were handed out and deleted, they must not come back
+            con.execute("DELETE FROM requests WHERE RequestID > 25")
+        return con.execute("SELECT * FROM requests ORDER BY RequestID").fetchall()
+
+
+def test_normalize_round_trip(open_requests, db_path):
+    """ rows read back the same after the move, ids keep counting past the old sequence """
+    rows = _baseline_db(db_path)
+    reqs = open_requests()
+    con = reqs.db.connection()
+    columns = {row[1] for row in con.execute("PRAGMA table_info(requests)")}
+    assert {"AddressID", "UserAgentID", "URLID"} <= columns
+    assert "RemoteAddress" not in columns
+    assert reqs.get_requests_page(after_id=0, pn_count=100) == rows
+    assert con.execute("SELECT COUNT(*) FROM request_urls").fetchone()[0] == 11
+    assert normalize_requests(con) is None
+    reqs._insert_rows(make_rows(1, reqs.server_id))
+    assert reqs.get_last_id() == 31
+    assert reqs.get_srv_req_tot(1) == 25
@@ -0,0 +1,28 @@
+""" rate limiting of repeated log records """
+import logging
+import sqlite3
+from src.logger import RateLimitFilter
+
+
+def _record(msg, *args, lineno=10):
+    """ a warning record logged from lineno """
+    return logging.LogRecord("pystats_logger", logging.WARNING, __file__, lineno, msg, args, None)
+
+
+def test_rate_limit_keeps_distinct_errors_apart():
+    """ the same template with another error or call site gets its own window """
+    limit = RateLimitFilter(interval=60)
+    locked = sqlite3.OperationalError("database is locked")
+    full = sqlite3.OperationalError("database or disk is full")
+    assert limit.filter(_record("dropped %s rows: %s", 5, locked))
+    assert not limit.filter(_record("dropped %s rows: %s", 7, locked))
+    assert limit.filter(_record("dropped %s rows: %s", 5, full))
+    assert limit.filter(_record("dropped %s rows: %s", 5, locked, lineno=20))
+    # arguments that are not errors still share a window
+    assert limit.filter(_record("No DB Connection: %s", "/a"))
+    assert not limit.filter(_record("No DB Connection: %s", "/b"))
+    assert sorted(limit.take_suppressed()) == [
+        (logging.WARNING, "No DB Connection: /b", 1),
+        (logging.WARNING, "dropped 7 rows: database is locked", 1),
+    ]
+    assert limit.take_suppressed() == []
@@ -0,0 +1,32 @@
+""" the in-memory backend """
+from random import Random
+from conftest import make_rows
+from src.memory import MemoryRequests
+
+
+def test_analytics_window_matches_a_full_scan():
+    """ the bisected window counts the same rows as a scan, with a wrapped ring and late rows """
+    reqs = MemoryRequests(rows=50)
+    rand = Random(7)
+    epoch = 1700000000.0
+    rows = make_rows(80, reqs.server_id, epoch=epoch)
+    for req_data in rows:
+        req_data["epoch"] = epoch + rand.uniform(0, 600)
+    rows.sort(key=lambda req_data: req_data["epoch"])
+    # imported rows from before the ones already stored
+    rows[60:65] = make_rows(5, reqs.server_id, epoch=epoch + 30)
+    reqs._insert_rows(rows)
+    stored = [row for chunk in reqs.iter_requests() for row in chunk]
+    assert len(stored) == 50
+    for since, until in ((epoch, epoch + 600), (epoch + 60, epoch + 180), (epoch + 300, epoch + 301)):
+        result = reqs.get_analytics("url", since=since, until=until)
+        low, high = result["since"], result["until"]
+        assert result["total"] == sum(1 for row in stored if low <= row[1] < high)
+
+
+def test_srv_requests_page_count_is_clamped():
+    """ old pnpage links can not ask for more than 100 rows """
+    reqs = MemoryRequests(rows=500)
+    reqs._insert_rows(make_rows(300, reqs.server_id))
+    assert len(reqs.get_srv_requests(reqs.server_id, 1, 1000)) == 100
+    assert len(reqs.get_srv_requests(reqs.server_id, 0, -5)) == 1
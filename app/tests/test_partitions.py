@@ -0,0 +1,72 @@
+""" partitioned inserts against the catalog """
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from conftest import make_rows
+
+
+def _catalog(reqs):
+    """ everything an insert writes to the catalog """
+    con = reqs.db.connection()
+    return (
+        con.execute("SELECT seq FROM sqlite_sequence WHERE name = 'requests'").fetchall(),
+        reqs.partitions.get_partitions(con),
+        con.execute("SELECT * FROM server_totals").fetchall(),
+        con.execute("SELECT * FROM analytics_rollup ORDER BY 1, 2, 3, 4, 5").fetchall(),
+    )
+
+
+def test_partition_insert_failure_leaves_catalog(open_requests):
+    """ a failed partition write rolls back the ids, ranges, totals and rollups with it """
+    reqs = open_requests(partition_by="rows", partition_rows=10)
+    reqs._insert_rows(make_rows(5, reqs.server_id))
+    con = reqs.db.connection()
+    with con:
+        con.execute(
+            """CREATE TRIGGER p_r00000000.fail BEFORE INSERT ON requests
+            BEGIN SELECT RAISE(ABORT, 'partition write failed'); END"""
+        )
+    before = _catalog(reqs)
+    with pytest.raises(sqlite3.IntegrityError):
+        reqs._insert_rows(make_rows(3, reqs.server_id, start=5))
+    assert _catalog(reqs) == before
+    assert not con.in_transaction
+    with con:
+        con.execute("DROP TRIGGER p_r00000000.fail")
+    reqs._insert_rows(make_rows(3, reqs.server_id, start=5))
+    assert [row[0] for row in reqs.get_requests_page(after_id=0, pn_count=20)] == list(range(1, 9))
+    assert reqs.get_srv_req_tot(reqs.server_id) == 8
+
+
+def test_partition_insert_spans_more_than_attached(open_requests):
+    """ a batch over more partitions than can be attached is written in slices """
+    reqs = open_requests(partition_by="rows", partition_rows=2)
+    reqs._insert_rows(make_rows(25, reqs.server_id))
+    assert len(reqs.partitions.get_partitions(reqs.db.connection())) == 13
+    assert [row[0] for row in reqs.get_requests_page(after_id=0, pn_count=30)] == list(range(1, 26))
+    assert reqs.get_srv_req_tot(reqs.server_id) == 25
+
+
+def test_dropped_partition_detached_on_other_threads(open_requests):
+    """ a thread that had a dropped partition attached lets go of it on its next read """
+    reqs = open_requests(
+        partition_by="rows", partition_rows=10, retention_max_rows=10, retention_interval=3600
+    )
+    reqs._insert_rows(make_rows(30, reqs.server_id))
+
+    def attached():
+        """ partitions attached to this thread's connection """
+        con = reqs.db.connection()
+        return sorted(row[1][2:] for row in con.execute("PRAGMA database_list") if row[1] != "main")
+
+    def read():
+        """ every stored RequestID, read on this thread """
+        return [row[0] for row in reqs.partitions.fetch(None, False, 0, 100)]
+
+    # one worker thread, so its connection and attachments persist between calls
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        assert reader.submit(read).result() == list(range(1, 31))
+        assert reader.submit(attached).result() == ["r00000000", "r00000001", "r00000002"]
+        assert reqs.retention.run_once() == 20
+        assert reader.submit(read).result() == list(range(21, 31))
+        assert reader.submit(attached).result() == ["r00000002"]
@@ -0,0 +1,49 @@
+""" retention against the analytics fold and server_totals """
+import time
+from conftest import make_rows
+
+
+def test_retention_keeps_analytics_totals(open_requests):
+    """ rows are folded into analytics_rollup before retention deletes them """
+    reqs = open_requests(retention_max_rows=100, retention_interval=3600)
+    reqs._insert_rows(make_rows(250, reqs.server_id))
+    since = time.time() - 3600
+    assert reqs.retention.run_once() == 150
+    assert reqs.get_first_id() == 151
+    assert reqs.get_analytics("server", since=since)["total"] == 250
+    assert reqs.get_analytics("url", since=since)["total"] == 250
+
+
+def test_retention_waits_for_the_fold(open_requests):
+    """ the expiry bound never passes FoldedID """
+    reqs = open_requests(retention_max_rows=100, retention_interval=3600)
+    reqs._insert_rows(make_rows(250, reqs.server_id))
+    reqs.analytics.fold()
+    # rows that land between a pass's fold and its expiry
+    reqs._insert_rows(make_rows(250, reqs.server_id, start=250))
+    with reqs.db.connection() as con:
+        assert reqs.retention._expired_bound(con.cursor()) == 250
+
+
+def test_rebuild_srv_totals_after_retention(open_requests):
+    """ the recount takes the pruned rows from analytics_rollup """
+    reqs = open_requests(retention_max_rows=100, retention_interval=3600)
+    reqs._insert_rows(make_rows(250, reqs.server_id))
+    assert reqs.retention.run_once() == 150
+    # stored rows the fold has not reached yet
+    reqs._insert_rows(make_rows(20, reqs.server_id, start=250))
+    with reqs.db.connection() as con:
+        con.execute("UPDATE server_totals SET RequestCount = 0")
+    assert reqs.rebuild_srv_totals()
+    assert reqs.get_srv_req_tot(reqs.server_id) == 270
+
+
+def test_rebuild_srv_totals_refuses_legacy_rollup(open_requests):
+    """ rows the old retention rolled into requests_rollup may be missing from analytics_rollup """
+    reqs = open_requests()
+    reqs._insert_rows(make_rows(10, reqs.server_id))
+    with reqs.db.connection() as con:
+        con.execute("CREATE TABLE requests_rollup(ServerID, RequestURL, Minute, RequestCount)")
+        con.execute("INSERT INTO requests_rollup VALUES (1, 'http://pystats/', 0, 5)")
+    assert not reqs.rebuild_srv_totals()
+    assert reqs.get_srv_req_tot(reqs.server_id) == 10
@@ -0,0 +1,36 @@
+""" conditional GETs of the pages """
+import pytest
+
+
+@pytest.mark.parametrize("path", ["/", "/?fast=true", "/json"])
+def test_repeated_get_is_not_modified(client, path):
+    """ the hit a page logs does not change its validator """
+    # a stats group may expire between the two gets, that one is a real change
+    for _ in range(3):
+        first = client.get(path)
+        assert first.status_code == 200
+        again = client.get(path, headers={"If-None-Match": first.headers["ETag"]})
+        if again.status_code == 304:
+            break
+    assert again.status_code == 304
+    assert again.headers["ETag"] == first.headers["ETag"]
+
+
+@pytest.mark.parametrize("path", ["/json", "/yaml"])
+def test_serialized_once_per_snapshot(client, path):
+    """ /json and /yaml bodies are encoded once per stats snapshot, not per request """
+    import pystat  # pylint: disable=import-outside-toplevel
+    fmt = path[1:]
+    render = pystat.SERIALIZED.renderers[fmt]
+    calls = []
+
+    def counted(stats):
+        calls.append(None)
+        return render(stats)
+
+    pystat.SERIALIZED.renderers[fmt] = counted
+    try:
+        etags = {client.get(path).headers["ETag"] for _ in range(5)}
+    finally:
+        pystat.SERIALIZED.renderers[fmt] = render
+    assert len(calls) <= len(etags) < 5
@@ -0,0 +1,19 @@
+""" write-behind writer thread """
+from src.writer import RequestWriter
+
+
+def test_writer_survives_a_failed_batch():
+    """ a non sqlite error drops its batch, the thread goes on with the next ones """
+    written = []
+
+    def write_rows(batch):
+        if not written:
+            written.append(None)
+            raise KeyError("server_id")
+        written.extend(batch)
+
+    writer = RequestWriter(write_rows, batch_size=1, flush_interval=0.01)
+    for row in range(3):
+        assert writer.put(row)
+    writer.close()
+    assert written == [None, 1, 2]
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+pystats benchmarks: time every public Requests method, put_request
+throughput, Stats.get_stats and the rendered pages against synthetic
+databases. Runs offline and writes machine readable JSON with
+p50/p95/p99 per benchmark so runs can be compared across versions.
+
+    python benchmarks/bench.py --rows 10000,100000 --servers 1,100 -o new.json
+    python benchmarks/bench.py --rows 10000000 --servers 1000 --baseline old.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "app")
+sys.path.insert(0, APP_DIR)
+
+from synth import synth_db  # noqa: E402
+from src.requests import Requests  # noqa: E402
+from src.stats import Stats  # noqa: E402
+
+
+def percentile(sorted_vals, pct):
+    """ nearest rank percentile of an already sorted list """
+    if not sorted_vals:
+        return 0
+    rank = max(int(round(pct / 100 * len(sorted_vals) + 0.5)) - 1, 0)
+    return sorted_vals[min(rank, len(sorted_vals) - 1)]
+
+
+def timeit(func, iterations, warmup=3):
+    """ call func warmup + iterations times, returns the timed durations in ns """
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter_ns()
+        func()
+        samples.append(time.perf_counter_ns() - started)
+    return samples
+
+
+def summarize(group, name, samples_ns, **extra):
+    """ one result record """
+    vals = sorted(samples_ns)
+    total = sum(vals)
+    rec = {
+        "group": group,
+        "name": name,
+        "n": len(vals),
+        "mean_ms": round(total / len(vals) / 1e6, 4) if vals else 0,
+        "p50_ms": round(percentile(vals, 50) / 1e6, 4),
+        "p95_ms": round(percentile(vals, 95) / 1e6, 4),
+        "p99_ms": round(percentile(vals, 99) / 1e6, 4),
+        "max_ms": round(vals[-1] / 1e6, 4) if vals else 0,
+    }
+    rec.update(extra)
+    return rec
+
+
+def bench_requests(reqs, size, iterations):
+    """ every public read method of Requests """
+    rnd = random.Random(2)
+    srv_total = reqs.get_srv_total()
+    req_total = reqs.get_req_total()
+
+    def srv_id():
+        return rnd.randint(1, srv_total)
+
+    cases = {
+        "get_req_total": reqs.get_req_total,
+        "get_srv_total": reqs.get_srv_total,
+        "get_srvs": lambda: reqs.get_srvs(rnd.randint(1, srv_total), 10),
+        "get_srv_req_totals": reqs.get_srv_req_totals,
+        "get_requests_first": lambda: reqs.get_requests(1, 10),
+        "get_requests_last": lambda: reqs.get_requests(req_total, 10),
+        "get_requests_page_first": lambda: reqs.get_requests_page(0, None, 10),
+        "get_requests_page_deep": lambda: reqs.get_requests_page(req_total // 2, None, 10),
+        "get_requests_page_last": lambda: reqs.get_requests_page(None, req_total + 1, 10),
+        "get_srv_req_tot": lambda: reqs.get_srv_req_tot(srv_id()),
+        "get_srv_socket": lambda: reqs.get_srv_socket(srv_id()),
+        "get_srv_last_rec": lambda: reqs.get_srv_last_rec(srv_id()),
+        "get_srv_requests_first": lambda: reqs.get_srv_requests(srv_id(), 1, 10),
+        "get_srv_requests_deep": lambda: reqs.get_srv_requests(srv_id(), 50, 10),
+        "get_srv_requests_page_first": lambda: reqs.get_srv_requests_page(srv_id(), 0, None, 10),
+        "get_srv_requests_page_last": lambda: reqs.get_srv_requests_page(
+            srv_id(), None, req_total + 1, 10
+        ),
+    }
+    return [
+        summarize("requests", name, timeit(func, iterations), **size)
+        for name, func in cases.items()
+    ]
+
+
+def bench_put(db_path, count, threads, size, write_behind=False):
+    """ put_request throughput from one or more threads """
+    reqs = Requests(db_path, write_behind=write_behind, batch_size=500, flush_interval=0.05)
+    per_thread = max(count // threads, 1)
+    samples = []
+    lock = threading.Lock()
+
+    def worker():
+        local = []
+        for idx in range(per_thread):
+            started = time.perf_counter_ns()
+            reqs.put_request("10.0.0.1", "bench/1.0", f"http://pystats.local/bench/{idx}")
+            local.append(time.perf_counter_ns() - started)
+        with lock:
+            samples.extend(local)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    # the rows are only durable once the writer flushed them
+    reqs.close()
+    elapsed = time.perf_counter() - started
+    name = f"put_request_{'write_behind_' if write_behind else ''}{threads}_threads"
+    return summarize(
+        "put", name, samples, rows_per_sec=round(len(samples) / elapsed, 1), **size
+    )
+
+
+def bench_stats(iterations):
+    """ Stats.get_stats cached and uncached, fast and full """
+    results = []
+    cached = Stats()
+    uncached = Stats(uptime_ttl=0, mem_ttl=0, cpu_ttl=0)
+    for label, stats in (("cached", cached), ("uncached", uncached)):
+        for fast in (True, False):
+            results.append(summarize(
+                "stats",
+                f"get_stats_{'fast' if fast else 'full'}_{label}",
+                timeit(lambda: stats.get_stats(fast), iterations),
+            ))
+        stats.close()
+    return results
+
+
+def load_app(db_path):
+    """ import pystat with a throw away command line """
+    sys.argv = ["pystat.py", "--db-file", db_path]
+    os.chdir(APP_DIR)
+    import pystat  # pylint: disable=import-outside-toplevel
+    return pystat
+
+
+def bench_pages(pystat, reqs, size, iterations):
+    """ render every page through flask's test client """
+    # point the app at the benchmark DB
+    pystat.REQS = reqs
+    pystat.METRICS.reqs = reqs
+    pystat.METRICS._generation = None
+    client = pystat.app.test_client()
+    req_total = reqs.get_req_total()
+    paths = [
+        "/",
+        "/?fast=true",
+        "/json",
+        "/yaml",
+        "/metrics",
+        "/servers",
+        "/requests",
+        f"/requests?before_id={req_total + 1}",
+        "/srv_requests?srv_id=1",
+        "/srv_requests?srv_id=1&pnpage=50",
+        "/missing",
+    ]
+    results = []
+    for path in paths:
+        results.append(summarize(
+            "pages", f"GET {path}", timeit(lambda: client.get(path), iterations), **size
+        ))
+    return results
+
+
+def git_rev():
+    """ current git revision if available """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCH_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """ print p50 ratios against an earlier results file """
+    with open(baseline_path, encoding="utf-8") as fh:
+        baseline = json.load(fh)
+
+    def key(rec):
+        return (rec["group"], rec["name"], rec.get("rows"), rec.get("servers"))
+
+    old = {key(rec): rec for rec in baseline["results"]}
+    print(f"{'benchmark':70} {'old p50':>10} {'new p50':>10} {'ratio':>7}")
+    for rec in results:
+        prev = old.get(key(rec))
+        if not prev or not prev["p50_ms"]:
+            continue
+        label = f"{rec['group']}:{rec['name']} rows={rec.get('rows')} srvs={rec.get('servers')}"
+        ratio = rec["p50_ms"] / prev["p50_ms"]
+        print(f"{label:70} {prev['p50_ms']:10.4f} {rec['p50_ms']:10.4f} {ratio:7.2f}")
+
+
+def parse_args():
+    """ benchmark options """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--rows", default="10000,100000", help="comma separated request counts")
+    parser.add_argument("--servers", default="1,100", help="comma separated server counts")
+    parser.add_argument("--iterations", type=int, default=200, help="timed calls per read benchmark")
+    parser.add_argument("--put-count", type=int, default=2000, help="put_request calls per throughput run")
+    parser.add_argument("--threads", default="1,4", help="comma separated put_request thread counts")
+    parser.add_argument("--workdir", default=None, help="where to keep the synthetic DBs")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic DBs")
+    parser.add_argument("--output", "-o", default="-", help="results file, - for stdout")
+    parser.add_argument("--baseline", default=None, help="earlier results file to compare with")
+    return parser.parse_args()
+
+
+def main():
+    """ run the benchmark matrix """
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pystats-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    pystat = load_app(os.path.join(workdir, "app.db"))
+    results = bench_stats(args.iterations)
+    for rows in [int(val) for val in args.rows.split(",")]:
+        for servers in [int(val) for val in args.servers.split(",")]:
+            size = {"rows": rows, "servers": servers}
+            db_path = os.path.join(workdir, f"requests-{rows}-{servers}.db")
+            started = time.perf_counter()
+            synth_db(db_path, rows, servers)
+            synth_secs = time.perf_counter() - started
+            started = time.perf_counter()
+            reqs = Requests(db_path)
+            results.append(summarize(
+                "requests", "open_existing_db", [int((time.perf_counter() - started) * 1e9)],
+                synth_secs=round(synth_secs, 2), **size
+            ))
+            results.extend(bench_requests(reqs, size, args.iterations))
+            results.extend(bench_pages(pystat, reqs, size, max(args.iterations // 4, 10)))
+            reqs.close()
+            for threads in [int(val) for val in args.threads.split(",")]:
+                results.append(bench_put(db_path, args.put_count, threads, size))
+                results.append(bench_put(db_path, args.put_count, threads, size, write_behind=True))
+            if not args.keep:
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(db_path + suffix):
+                        os.remove(db_path + suffix)
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "git_rev": git_rev(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "iterations": args.iterations,
+        },
+        "results": results,
+    }
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+""" synthetic pystats databases for the benchmarks """
+import os
+import random
+import sqlite3
+import time
+from contextlib import closing
+
+
+USER_AGENTS = [
+    "curl/8.5.0",
+    "kube-probe/1.29",
+    "Prometheus/2.51.0",
+    "python-requests/2.31.0",
+    "Go-http-client/1.1",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "k6/0.50.0 (https://k6.io/)",
+    "hey/0.0.1",
+]
+URL_PATHS = [
+    "/",
+    "/?fast=true",
+    "/json",
+    "/yaml",
+    "/servers",
+    "/requests",
+    "/srv_requests?srv_id=1",
+    "/metrics",
+    "/missing",
+]
+
+
+def synth_db(db_path, rows, servers, seed=1, chunk=50000):
+    """ write a baseline schema DB with servers and rows requests spread over them
+
+    The tables are created the way a pre-existing pystats DB looks so
+    Requests() runs its normal init and backfills on first open.
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    rnd = random.Random(seed)
+    with closing(sqlite3.connect(db_path)) as con:
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.execute("PRAGMA journal_mode = WAL")
+        con.execute("PRAGMA synchronous = OFF")
+        con.execute(
+            """CREATE TABLE servers(
+                ServerID INTEGER PRIMARY KEY AUTOINCREMENT,
+                Hostname TEXT NOT NULL,
+                IP TEXT  NOT NULL,
+                Platform TEXT
+            )"""
+        )
+        con.execute(
+            """CREATE TABLE requests(
+                RequestID INTEGER PRIMARY KEY AUTOINCREMENT,
+                Epoch REAL NOT NULL,
+                RemoteAddress TEXT,
+                RemoteUserAgent TEXT,
+                RequestURL TEXT,
+                ServerID INTEGER,
+                FOREIGN KEY(ServerID) REFERENCES servers(ServerID)
+            )"""
+        )
+        with con:
+            con.executemany(
+                "INSERT INTO servers (Hostname, IP, Platform) VALUES (?, ?, ?)",
+                [
+                    (f"pystats-{idx}", f"10.{idx // 65536}.{idx // 256 % 256}.{idx % 256}", "Linux")
+                    for idx in range(servers)
+                ],
+            )
+        clients = [f"10.200.{idx // 256}.{idx % 256}" for idx in range(512)]
+        epoch = time.time() - rows * 0.01
+        written = 0
+        while written < rows:
+            batch = []
+            for _ in range(min(chunk, rows - written)):
+                epoch += 0.01
+                batch.append((
+                    round(epoch, 4),
+                    rnd.choice(clients),
+                    rnd.choice(USER_AGENTS),
+                    "http://pystats.local:8080" + rnd.choice(URL_PATHS),
+                    rnd.randint(1, servers),
+                ))
+            with con:
+                con.executemany(
+                    """INSERT INTO requests (
+                        Epoch, RemoteAddress, RemoteUserAgent, RequestURL, ServerID
+                    ) VALUES (?, ?, ?, ?, ?)""",
+                    batch,
+                )
+            written += len(batch)
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return db_path